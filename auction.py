@@ -1,16 +1,46 @@
 import random
+import copy
+import concurrent.futures
+import numpy as np
+from record import bidRecordStore, legacyRecordView, competitorRecordView, legacyBidRecord, legacyCensoredRecord, censorRecord, censorRecords, checkBidRecord, recordColumns, recordWriter
 
 class competitor:
 
-    def __init__(self, competitor_id, num_attributes, is_myself = False, budget = float('inf')):
+    def __init__(self, competitor_id, num_attributes, is_myself = False, budget = float('inf'), rng = random):
+        '''
+        Input type:
+            rng: random.Random instance used for the weights and the running bids. The global random module by default
+        '''
         self.competitor_id = competitor_id
         self.num_attributes = num_attributes
         self.remaining_budget = budget
-        self.attribute_weights = [random.random() for _ in range(num_attributes)]
+        self.rng = rng
+        self.attribute_weights = [rng.random() for _ in range(num_attributes)]
         self.bidprice_record = []
         self.is_myself = is_myself
 
     def bidprice(self, attributes):
+        '''
+        Compute the bid price for attributes, charge it and record it in self.bidprice_record
+        The competitors of an adExchange have a read-only view of the exchange record instead: their bids are made
+        and recorded by the exchange, so bidprice raises ValueError before charging anything. Use generateBid to price
+        a bid without recording it.
+        '''
+        if not isinstance(self.bidprice_record, list):
+            raise ValueError("Competitor " + str(self.competitor_id) + " belongs to an adExchange, which records its bids: use the adExchange to generate auctions or generateBid")
+        price, pctr, running_bid = self.generateBid(attributes)
+        self.bidprice_record.append((price, pctr, running_bid))
+        return price
+
+    def generateBid(self, attributes):
+        '''
+        Compute the bid price for attributes and charge it to the remaining budget without recording it
+
+        Return type: tuple
+            price: float
+            pctr: float
+            running_bid: float
+        '''
         running_bid = self.generateRunningBid() if not self.is_myself else self.generateRunningBidSelf()
         pctr = self.generatePctr(attributes)
         price = running_bid * pctr
@@ -21,31 +51,117 @@ class competitor:
             self.remaining_budget = 0
         else:
             self.remaining_budget -= price
-        self.bidprice_record.append((price, pctr, running_bid))
-        return price
+        return price, pctr, running_bid
 
     def clearBidPriceRecord(self):
         self.bidprice_record = []
 
     # TODO: Add other noise type
     def generateNoise(self):
-        return random.random()
+        return self.rng.random()
 
     def generatePctr(self, attributes):
         return sum([self.attribute_weights[i] * attributes[i] for i in range(self.num_attributes)])
     
     def generateRunningBid(self, range = 10):
-        return random.random() * range
+        return self.rng.random() * range
     
     def generateRunningBidSelf(self):
-        return random.choice([1, 2] * 20 + [4, 7, 10])
+        return self.rng.choice([1, 2] * 20 + [4, 7, 10])
+
+
+class competitorPopulation:
+
+    def __init__(self, num_competitors, num_attributes, myself_idx = -1, budget = float('inf'), rng = random):
+        '''
+        All competitors of an exchange as arrays instead of competitor objects, for exchanges with thousands of bidders
+
+        Attributes:
+            attribute_weights: (num_competitors, num_attributes) float64
+            remaining_budget: (num_competitors,) float64
+            is_myself: (num_competitors,) bool
+        '''
+        self.num_competitors = num_competitors
+        self.num_attributes = num_attributes
+        self.attribute_weights = np.random.default_rng(rng.getrandbits(64)).random((num_competitors, num_attributes))
+        self.remaining_budget = np.full(num_competitors, float(budget))
+        self.is_myself = np.zeros(num_competitors, dtype = bool)
+        if 0 <= myself_idx < num_competitors:
+            self.is_myself[myself_idx] = True
+
+
+    def drawBids(self, attributes, rng):
+        '''
+        Draw the bids of every competitor for every row of attributes, before budgets are applied
+
+        Return type: tuple of (num_records, num_competitors) numpy arrays
+            bidprices, pctrs, running_bids
+        '''
+        pctrs = attributes @ self.attribute_weights.T
+        running_bids = rng.random((len(attributes), self.num_competitors)) * 10
+        myself = np.flatnonzero(self.is_myself)
+        if len(myself):
+            running_bid_choices = np.array([1, 2] * 20 + [4, 7, 10], dtype = float)
+            running_bids[:, myself] = rng.choice(running_bid_choices, size = (len(attributes), len(myself)))
+        return running_bids * pctrs, pctrs, running_bids
+
+
+    def chargeBudgets(self, bidprices):
+        '''
+        Cap bidprices in place by the remaining budgets and charge them, row by row as competitor.bidprice does
+        Bids are left as they are until the running total passes the budget. The bid of that auction gets what is left
+        of the budget and the later bids are 0.
+        '''
+        finite = np.flatnonzero(np.isfinite(self.remaining_budget))
+        if len(finite) == 0 or len(bidprices) == 0:
+            return
+        budget = self.remaining_budget[finite]
+        bids = bidprices[:, finite]
+        spent = np.cumsum(bids, axis = 0)
+        over = spent > budget
+        exhausted = over.any(axis = 0)
+        if exhausted.any():
+            columns = np.flatnonzero(exhausted)
+            first = np.argmax(over[:, columns], axis = 0)
+            spent_before = np.where(first > 0, spent[np.maximum(first - 1, 0), columns], 0)
+            bids[:, columns] = np.where(np.arange(len(bids))[:, np.newaxis] > first, 0, bids[:, columns])
+            bids[first, columns] = budget[columns] - spent_before
+            bidprices[:, finite] = bids
+        self.remaining_budget[finite] = np.where(exhausted, 0, budget - spent[-1])
+
+
+    def copy(self, remaining_budget = None):
+        population = copy.copy(self)
+        population.remaining_budget = np.array(self.remaining_budget if remaining_budget is None else remaining_budget, dtype = float)
+        return population
+
+
+def populationFromCompetitors(competitors):
+    '''
+    Return type: competitorPopulation with the weights, budgets and is_myself of a list of competitor objects
+    '''
+    population = competitorPopulation(len(competitors), competitors[0].num_attributes if competitors else 0, rng = random.Random(0))
+    population.attribute_weights = np.array([k.attribute_weights for k in competitors], dtype = float).reshape(len(competitors), population.num_attributes)
+    population.remaining_budget = np.array([k.remaining_budget for k in competitors], dtype = float)
+    population.is_myself = np.array([k.is_myself for k in competitors], dtype = bool)
+    return population
 
 
 class adExchange:
 
     # TODO: Add time attribute
     # num_competitors >= 2
-    def __init__(self, num_competitors = 20, num_integer_attributes = 3, integer_attributes_range = [2, 5, 10], num_float_attributes = 7, float_attributes_range = [], auction_type = 'first', myself_idx = -1):
+    def __init__(self, num_competitors = 20, num_integer_attributes = 3, integer_attributes_range = [2, 5, 10], num_float_attributes = 7, float_attributes_range = [], auction_type = 'first', myself_idx = -1, seed = None, use_population = False, keep_bids = None, population = None):
+        '''
+        Input type:
+            seed(int): Seed of the random streams of this exchange. None uses the global random module as before.
+            use_population(Boolean): Represent the competitors as one competitorPopulation instead of competitor objects.
+                Auctions are then always generated in vectorized blocks. Use it for thousands of competitors.
+            keep_bids(Boolean): Keep the bids of every competitor in self.record. If False, only the attributes, the winner
+                and the clearing price are kept and the bids are dropped after each block.
+                None keeps them for competitor objects only: with use_population the bids are kept only if keep_bids is True.
+            population(competitorPopulation): The competitors of the exchange instead of new random ones. Implies use_population.
+        '''
         if len(integer_attributes_range) == 0:
             integer_attributes_range = [4 for _ in range(num_integer_attributes)]
         elif len(integer_attributes_range) != num_integer_attributes:
@@ -65,8 +181,33 @@ class adExchange:
         self.float_attributes_range = float_attributes_range
         self.num_attributes = num_integer_attributes + num_float_attributes
         self.auction_type = auction_type
-        self.competitors = [competitor(i, self.num_attributes) if i != myself_idx else competitor(i, self.num_attributes, is_myself = True) for i in range(self.num_competitors)]
-        self.bid_record = []
+        self.seed = seed
+        self.rng = random.Random(seed) if seed is not None else random
+        # Random stream of the vectorized generators. If None, each block is seeded from self.rng
+        self.np_rng = np.random.default_rng(seed) if seed is not None else None
+        use_population = use_population or population is not None
+        self.keep_bids = (not use_population) if keep_bids is None else keep_bids
+        if population is not None:
+            self.population = population
+            self.competitors = []
+        elif use_population:
+            self.population = competitorPopulation(self.num_competitors, self.num_attributes, myself_idx, rng = self.rng)
+            self.competitors = []
+        else:
+            self.population = None
+            self.competitors = [competitor(i, self.num_attributes, is_myself = (i == myself_idx), rng = self.rng) for i in range(self.num_competitors)]
+        self.record = bidRecordStore(self.num_attributes, self.num_competitors if self.keep_bids else 0, self.num_integer_attributes)
+        # The bid prices of the competitors are kept only once, in self.record
+        for i, k in enumerate(self.competitors):
+            k.bidprice_record = competitorRecordView(self.record, i)
+
+
+    @property
+    def bid_record(self):
+        '''
+        List view of self.record in the layout of generateOneBid, for old callers
+        '''
+        return legacyRecordView(self.record)
 
 
     def generateOneBid(self):
@@ -77,6 +218,38 @@ class adExchange:
             attributes: list
             competitor_bidprices: list
         '''
+        if self.population is not None:
+            return legacyBidRecord(self.generateBidBlock(1, keep_bids = True), self.num_integer_attributes)[0]
+        winning_price, winning_id, attributes, bids = self.simulateOneAuction()
+        return [winning_price, winning_id, attributes, [(price, i) for i, (price, _, _) in enumerate(bids)]]
+
+
+    def getPopulation(self):
+        '''
+        Return type: competitorPopulation
+            self.population, or a population built from the competitor objects
+        '''
+        if self.population is not None:
+            return self.population
+        return populationFromCompetitors(self.competitors)
+
+
+    def setRemainingBudgets(self, remaining_budget):
+        if self.population is not None:
+            self.population.remaining_budget = np.array(remaining_budget, dtype = float)
+        else:
+            for k, budget in zip(self.competitors, np.asarray(remaining_budget).tolist()):
+                k.remaining_budget = budget
+
+
+    def simulateOneAuction(self):
+        '''
+        Return type: tuple
+            winning_price: float
+            winning_id: int
+            attributes: list
+            bids: list of (price, pctr, running_bid) of each competitor
+        '''
         # Generate attributes
         attributes = []
         for i in range(self.num_attributes):
@@ -87,30 +260,240 @@ class adExchange:
 
         # Generate bid price for each competitor
         # TODO: Floor price
-        competitor_bidprices = [(k.bidprice(attributes), i) for i, k in enumerate(self.competitors)]
-        sorted_bidprice = sorted(competitor_bidprices, reverse = True)
+        bids = [k.generateBid(attributes) for k in self.competitors]
+        sorted_bidprice = sorted([(price, i) for i, (price, _, _) in enumerate(bids)], reverse = True)
         if self.auction_type == 'first':
             winning_price, winning_id = sorted_bidprice[0]
         elif self.auction_type == 'second':
             winning_price = sorted_bidprice[1][0]
             winning_id = sorted_bidprice[0][1]
 
-        return [winning_price, winning_id, attributes, competitor_bidprices]
+        return winning_price, winning_id, attributes, bids
+
+
+    def generateBidBlock(self, num_records, keep_bids = None):
+        '''
+        Generate num_records auctions at once with NumPy instead of calling generateOneBid in a loop
+        Budgets are depleted in the same sequential order as competitor.bidprice
+
+        Input type:
+            keep_bids(Boolean): Return the bids of every competitor. Defaults to self.keep_bids.
+                If False, the bids are generated in row chunks of about max_bid_cells values and dropped
+                once the winners are chosen, and the bid columns have width 0.
+
+        Return type: dict of numpy arrays
+            attributes: (num_records, num_attributes)
+            bidprices: (num_records, num_competitors)
+            pctrs: (num_records, num_competitors)
+            running_bids: (num_records, num_competitors)
+            winning_price: (num_records,)
+            winning_id: (num_records,)
+        '''
+        if keep_bids is None:
+            keep_bids = self.keep_bids
+        if keep_bids:
+            return self.settleBidBlock(self.drawBidBlock(num_records))
+
+        chunk_size = max(1, self.max_bid_cells // self.num_competitors)
+        chunks = []
+        for start in range(0, num_records, chunk_size):
+            chunk = self.settleBidBlock(self.drawBidBlock(min(chunk_size, num_records - start)))
+            chunks.append({name: chunk[name] for name in ('attributes', 'winning_price', 'winning_id')})
+        if not chunks:
+            chunks.append({name: column[:0] for name, column in self.settleBidBlock(self.drawBidBlock(0)).items()})
+        block = {name: np.concatenate([k[name] for k in chunks]) for name in ('attributes', 'winning_price', 'winning_id')}
+        for name in ('bidprices', 'pctrs', 'running_bids'):
+            block[name] = np.empty((num_records, 0))
+        return block
+
+    # Upper bound of the number of bids held at once by generateBidBlock(keep_bids = False)
+    max_bid_cells = 1 << 22
+
+
+    def drawBidBlock(self, num_records):
+        '''
+        Draw the attributes and the bids of num_records auctions before budgets are applied and winners are chosen
+
+        Return type: dict of numpy arrays
+            attributes, bidprices, pctrs, running_bids, see generateBidBlock
+        '''
+        rng = self.np_rng if self.np_rng is not None else np.random.default_rng(self.rng.getrandbits(64))
+        attributes = np.empty((num_records, self.num_attributes))
+        for i in range(self.num_integer_attributes):
+            attributes[:, i] = rng.integers(1, self.integer_attributes_range[i] + 1, size = num_records)
+        for i in range(self.num_float_attributes):
+            attributes[:, self.num_integer_attributes + i] = rng.random(num_records) * self.float_attributes_range[i]
+
+        bidprices, pctrs, running_bids = self.getPopulation().drawBids(attributes, rng)
+        return {
+            'attributes': attributes,
+            'bidprices': bidprices,
+            'pctrs': pctrs,
+            'running_bids': running_bids
+        }
+
+
+    def settleBidBlock(self, block):
+        '''
+        Apply the remaining budgets to the bids of a block from drawBidBlock, in order, and choose the winner of every auction
+        The block is updated in place with the capped bidprices, winning_price and winning_id
+        '''
+        bidprices = block['bidprices']
+        num_records = len(bidprices)
+
+        population = self.getPopulation()
+        population.chargeBudgets(bidprices)
+        if self.population is None:
+            self.setRemainingBudgets(population.remaining_budget)
+
+        # Only the top one (first price) or top two (second price) bids are needed, so there is no sort.
+        # Ties go to the largest competitor index, the same as sorted(..., reverse = True)
+        winning_id = self.num_competitors - 1 - np.argmax(bidprices[:, ::-1], axis = 1)
+        if self.auction_type == 'first':
+            winning_price = bidprices[np.arange(num_records), winning_id]
+        elif self.auction_type == 'second':
+            winning_price = np.partition(bidprices, self.num_competitors - 2, axis = 1)[:, self.num_competitors - 2]
+
+        block['winning_price'] = winning_price
+        block['winning_id'] = winning_id
+        return block
 
 
-    def generateMultipleBidRecord(self, num_records, save = False, save_path = "./bid_record"):
+    def generateMultipleBidRecord(self, num_records, save = False, save_path = "./bid_record", vectorized = False, block_size = 65536):
         '''
+        Input type:
+            save(Boolean): Save all records to save_path + ".rec" with saveRecord
+            vectorized(Boolean): Generate the auctions in NumPy blocks of block_size instead of one by one.
+                Always True with use_population. When saving, every block is appended to the file as soon as it is generated.
+
         Return type: list of list
             winning_price: float
             winning_id: int
             attributes: list
             competitor_bidprices: list
         '''
-        for _ in range(num_records):
-            self.bid_record.append(self.generateOneBid())
+        if vectorized or self.population is not None:
+            writer = self.saveRecord(self.record, save_path + ".rec", close = False) if save else None
+            for start in range(0, num_records, block_size):
+                block = self.generateBidBlock(min(block_size, num_records - start))
+                self.record.appendBlock(block)
+                if writer:
+                    writer.append(block)
+            if writer:
+                writer.close()
+        else:
+            for _ in range(num_records):
+                winning_price, winning_id, attributes, bids = self.simulateOneAuction()
+                self.record.appendRow(winning_price, winning_id, attributes, *zip(*bids))
+            if save:
+                self.saveRecord(self.record, save_path + ".rec")
+        return self.bid_record
+
+
+    def streamBidBlocks(self, block_size = 65536, num_records = None):
+        '''
+        Yield blocks of generateBidBlock without keeping them in self.record, so memory does not grow with the number of auctions.
+        Budgets are still depleted across blocks. The blocks can be given to recordWriter.append directly.
 
-        if save:
-            self.saveRecord(self.bid_record, save_path + ".txt")
+        Input type:
+            block_size(int): The number of auctions in each block
+            num_records(int): The total number of auctions. None for an unbounded stream
+
+        Return type: generator of dict of numpy arrays, see generateBidBlock
+        '''
+        generated = 0
+        while num_records is None or generated < num_records:
+            size = block_size if num_records is None else min(block_size, num_records - generated)
+            yield self.generateBidBlock(size)
+            generated += size
+
+
+    def streamBids(self, num_records = None, block_size = 4096):
+        '''
+        Yield auctions one by one in the layout of generateOneBid without recording them
+
+        Return type: generator of list
+            winning_price: float
+            winning_id: int
+            attributes: list
+            competitor_bidprices: list
+        '''
+        for block in self.streamBidBlocks(block_size, num_records):
+            yield from legacyBidRecord(block, self.num_integer_attributes)
+
+
+    def streamCensoredBlocks(self, competitor_idx, block_size = 65536, num_records = None):
+        '''
+        Censored version of streamBidBlocks for one competitor, computed on the fly
+
+        Return type: generator of dict of numpy arrays, see getCensoredColumns
+        '''
+        if competitor_idx >= self.num_competitors:
+            print("Wrong competitor_idx!")
+            return
+        if not self.keep_bids:
+            print("Bids are not kept by this exchange (keep_bids = False)!")
+            return
+        for block in self.streamBidBlocks(block_size, num_records):
+            yield censorRecord(block, competitor_idx)
+
+
+    def streamCensoredRecord(self, competitor_idx, num_records = None, block_size = 4096):
+        '''
+        Yield the records of getCensoredRecord(competitor_idx) one by one without recording the auctions
+
+        Return type: generator of list
+            win or lose: 1 is win, 0 is lose
+            winning_price: -1 if lose
+            bidprice: float
+            attributes: list
+        '''
+        for block in self.streamCensoredBlocks(competitor_idx, block_size, num_records):
+            yield from legacyCensoredRecord(block, self.num_integer_attributes)
+
+
+    def generateParallelBidRecord(self, num_records, num_workers = 4, seed = None, budget_policy = 'partition', block_size = 65536):
+        '''
+        Simulate num_records auctions in num_workers processes and append them to self.record in shard order
+        Shard i covers a contiguous range of the auctions and draws from the i-th child of np.random.SeedSequence(seed),
+        so for a given seed and num_workers the result is identical on every run.
+
+        Input type:
+            seed(int): None draws the seed from self.rng, which is reproducible if the exchange was built with a seed
+            budget_policy(str): How finite budgets are shared by the shards
+                'partition': every shard gets remaining_budget / num_workers of each competitor
+                'reconcile': the shards bid without budgets, then the budgets are applied to the merged auctions
+                    in order and the winners are chosen again, which matches a serial simulation
+
+        Return type: list of list, see generateMultipleBidRecord
+        '''
+        if budget_policy not in ('partition', 'reconcile'):
+            print("budget_policy must be 'partition' or 'reconcile'!")
+            return
+        if budget_policy == 'reconcile' and not self.keep_bids:
+            print("budget_policy 'reconcile' needs keep_bids!")
+            return
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        shard_sizes = [num_records // num_workers + (1 if i < num_records % num_workers else 0) for i in range(num_workers)]
+        seed_sequences = np.random.SeedSequence(seed).spawn(num_workers)
+        population = self.getPopulation()
+        if budget_policy == 'partition':
+            shard_population = population.copy(population.remaining_budget / num_workers)
+        else:
+            shard_population = population.copy(np.full(self.num_competitors, float('inf')))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as executor:
+            shards = list(executor.map(simulateShard, [self.getConfig()] * num_workers, [shard_population] * num_workers, shard_sizes, seed_sequences, [block_size] * num_workers))
+
+        merged = {name: np.concatenate([block[name] for block, _ in shards]) for name in ('attributes', 'bidprices', 'pctrs', 'running_bids')}
+        if budget_policy == 'partition':
+            for name in ('winning_price', 'winning_id'):
+                merged[name] = np.concatenate([block[name] for block, _ in shards])
+            self.setRemainingBudgets(np.sum([remaining_budget for _, remaining_budget in shards], axis = 0))
+        else:
+            self.settleBidBlock(merged)
+        self.record.appendBlock(merged)
         return self.bid_record
 
 
@@ -125,17 +508,26 @@ class adExchange:
         if competitor_idx >= self.num_competitors:
             print("Wrong competitor_idx!")
             return
-        censored_record = []
-        for winning_price, winning_id, attributes, competitor_bidprices in self.bid_record:
-            if competitor_idx == winning_id:
-                censored_record.append([1, winning_price, competitor_bidprices[competitor_idx][0], attributes])
-            else:
-                censored_record.append([0, -1, competitor_bidprices[competitor_idx][0], attributes])
-        
-        # TODO: Save censored_record
+        if not self.keep_bids:
+            print("Bids are not kept by this exchange (keep_bids = False)!")
+            return
+        censored_columns = self.getCensoredColumns(competitor_idx)
         if save:
-            self.saveRecord(censored_record, save_path + str(competitor_idx) + ".txt")
-        return censored_record
+            self.saveRecord(censored_columns, save_path + str(competitor_idx) + ".rec")
+        return legacyCensoredRecord(censored_columns, self.num_integer_attributes)
+
+
+    def getCensoredColumns(self, competitor_idx):
+        '''
+        Columnar version of getCensoredRecord. attributes is a view of self.record, not a copy.
+
+        Return type: dict of numpy arrays
+            win: (n,) int8, 1 is win, 0 is lose
+            winning_price: (n,) float64, -1 if lose
+            bidprice: (n,) float64
+            attributes: (n, num_attributes) float64
+        '''
+        return censorRecord(self.record.view(), competitor_idx)
 
     
     def getFullInfoOfCompetitor(self, competitor_idx):
@@ -151,36 +543,115 @@ class adExchange:
         if competitor_idx >= self.num_competitors:
             print("Wrong competitor_idx!")
             return
-        full_info = []
-        for i in range(len(self.bid_record)):
-            winning_price, winning_id, attributes, competitor_bidprices = self.bid_record[i]
-            price, pctr, running_bid = self.competitors[competitor_idx].bidprice_record[i]
-            if competitor_bidprices[competitor_idx][0] != price:
-                print("Error!")
-            if competitor_idx == winning_id:
-                full_info.append([1, winning_price, competitor_bidprices[competitor_idx][0], attributes, pctr, running_bid])
-            else:
-                full_info.append([0, -1, competitor_bidprices[competitor_idx][0], attributes, pctr, running_bid])
-        return full_info
+        if not self.keep_bids:
+            print("Bids are not kept by this exchange (keep_bids = False)!")
+            return
+        full_info = self.getCensoredDatasets([competitor_idx], full_info = True)[competitor_idx]
+        pctrs = full_info['pctr'].tolist()
+        running_bids = full_info['running_bid'].tolist()
+        return [k + [pctr, running_bid] for k, pctr, running_bid in zip(legacyCensoredRecord(full_info, self.num_integer_attributes), pctrs, running_bids)]
+
+
+    def getCensoredDatasets(self, competitor_idxs = None, full_info = False, check = True):
+        '''
+        Censored records of several competitors, computed in one pass over self.record instead of one getCensoredRecord per competitor
+
+        Input type:
+            competitor_idxs(list of int): None for all competitors
+            full_info(Boolean): Add the pctr and running_bid columns of getFullInfoOfCompetitor
+            check(Boolean): Check the bids and the winners of the whole record first, see record.checkBidRecord.
+                It raises AssertionError if the record is inconsistent.
+
+        Return type: dict
+            competitor_idx -> dict of numpy arrays, see record.censorRecords. Every dict can be given to buildDecisionTree.
+        '''
+        if not self.keep_bids:
+            raise ValueError("Bids are not kept by this exchange (keep_bids = False)")
+        if competitor_idxs is None:
+            competitor_idxs = range(self.num_competitors)
+        competitor_idxs = list(competitor_idxs)
+        if any(not 0 <= idx < self.num_competitors for idx in competitor_idxs):
+            raise ValueError("Wrong competitor_idx: " + str([idx for idx in competitor_idxs if not 0 <= idx < self.num_competitors]))
+        columns = self.record.view()
+        if check:
+            checkBidRecord(columns, self.auction_type)
+        return censorRecords(columns, competitor_idxs, full_info)
 
 
     def clearRecord(self):
-        self.bid_record = []
-        for k in self.competitors:
-            k.clearBidPriceRecord()
+        self.record.clear()
 
 
     def getRecordLength(self):
-        return len(self.bid_record)
+        return len(self.record)
 
 
-    # TODO: Save records
-    def saveRecord(self, record, path):
-        pass
+    def getConfig(self):
+        '''
+        Return type: dict
+            The configuration of the exchange, stored in the header of saved records
+        '''
+        is_myself = self.getPopulation().is_myself
+        return {
+            'num_competitors': self.num_competitors,
+            'num_integer_attributes': self.num_integer_attributes,
+            'integer_attributes_range': list(self.integer_attributes_range),
+            'num_float_attributes': self.num_float_attributes,
+            'float_attributes_range': list(self.float_attributes_range),
+            'auction_type': self.auction_type,
+            'myself_idx': int(np.argmax(is_myself)) if is_myself.any() else -1,
+            'keep_bids': self.keep_bids
+        }
+
+
+    def saveRecord(self, record, path, append = False, close = True):
+        '''
+        Save record in the chunked binary format of record.recordWriter, to be loaded with record.loadRecord
+        The header stores self.getConfig()
+
+        Input type:
+            record: self.record for the bid record, or the output of getCensoredColumns for a censored record
+            path(str): The directory to write to
+            append(Boolean): Append to the record already at path
+            close(Boolean): If False, return the open recordWriter so that more chunks can be appended
+
+        Return type: recordWriter
+        '''
+        columns = record.view() if isinstance(record, bidRecordStore) else record
+        kind = 'censored' if 'win' in columns else 'bid'
+        # Without keep_bids the store holds no bids and the record is saved without the bid columns
+        writer = recordWriter(path, kind, recordColumns(kind, self.num_attributes, self.record.num_competitors), self.getConfig(), append = append)
+        if len(columns['winning_price']):
+            writer.append(columns)
+        if close:
+            writer.close()
+        return writer
 
 
     def generateRandomAttribute(self, attribute_idx, attribute_type):
         if attribute_type == "integer":
-            return random.randint(1, self.integer_attributes_range[attribute_idx])
+            return self.rng.randint(1, self.integer_attributes_range[attribute_idx])
         elif attribute_type == "float":
-            return random.random() * self.float_attributes_range[attribute_idx]
\ No newline at end of file
+            return self.rng.random() * self.float_attributes_range[attribute_idx]
+
+
+def simulateShard(config, population, num_records, seed_sequence, block_size):
+    '''
+    Worker of adExchange.generateParallelBidRecord. Builds an exchange from config and population and simulates one shard.
+
+    Input type:
+        config(dict): adExchange.getConfig()
+        population(competitorPopulation): The competitors with the budgets of this shard
+        seed_sequence(np.random.SeedSequence): The random stream of this shard
+
+    Return type: tuple
+        block(dict of numpy arrays): see adExchange.generateBidBlock
+        remaining_budget(numpy array)
+    '''
+    exchange = adExchange(config['num_competitors'], config['num_integer_attributes'], config['integer_attributes_range'], config['num_float_attributes'], config['float_attributes_range'], config['auction_type'], keep_bids = config['keep_bids'], population = population)
+    exchange.np_rng = np.random.default_rng(seed_sequence)
+    blocks = [exchange.generateBidBlock(min(block_size, num_records - start)) for start in range(0, num_records, block_size)]
+    if not blocks:
+        blocks = [exchange.generateBidBlock(0)]
+    block = {name: np.concatenate([k[name] for k in blocks]) for name in blocks[0]}
+    return block, population.remaining_budget
@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from auction import adExchange
+from decisiontree import buildDecisionTree
+from utils import turnbull
+
+
+def benchmarkPopulation(num_competitors_list = [20, 1000, 10000], num_records = 20000, num_list_records = 200, auction_type = 'second'):
+    '''
+    Function to compare the throughput of the competitor list path (generateMultipleBidRecord one auction at a time)
+    with the competitorPopulation path (use_population = True, keep_bids = False)
+    The list path is much slower, so it runs fewer auctions: num_list_records instead of num_records
+
+    Return type: list of dict
+        num_competitors(int)
+        list_auctions_per_second(float)
+        population_auctions_per_second(float)
+        speedup(float)
+    '''
+    results = []
+    for num_competitors in num_competitors_list:
+        list_exchange = adExchange(num_competitors = num_competitors, auction_type = auction_type, seed = 0)
+        start_time = time.perf_counter()
+        list_exchange.generateMultipleBidRecord(num_list_records)
+        list_speed = num_list_records / (time.perf_counter() - start_time)
+
+        population_exchange = adExchange(num_competitors = num_competitors, auction_type = auction_type, seed = 0, use_population = True, keep_bids = False)
+        start_time = time.perf_counter()
+        population_exchange.generateMultipleBidRecord(num_records)
+        population_speed = num_records / (time.perf_counter() - start_time)
+
+        results.append({
+            'num_competitors': num_competitors,
+            'list_auctions_per_second': list_speed,
+            'population_auctions_per_second': population_speed,
+            'speedup': population_speed / list_speed
+        })
+        print("competitors: " + str(num_competitors) + ", list: " + str(round(list_speed)) + " auctions/s, population: " + str(round(population_speed)) + " auctions/s, speedup: " + str(round(population_speed / list_speed, 1)) + "x")
+    return results
+
+
+
+BENCHMARK_SCALES = [10000, 100000, 1000000, 10000000]
+
+
+def censoredColumns(num_rows, seed, auction_type = 'second', num_competitors = 20):
+    '''
+    Function to simulate the censored record of competitor 0 block by block, without keeping the bids of every auction
+
+    Return type: dict of numpy arrays, see adExchange.getCensoredColumns
+    '''
+    exchange = adExchange(num_competitors = num_competitors, auction_type = auction_type, seed = seed, use_population = True, keep_bids = True)
+    blocks = list(exchange.streamCensoredBlocks(0, 65536, num_rows))
+    return {name: np.concatenate([k[name] for k in blocks]) for name in blocks[0]}
+
+
+def trainedTree(num_rows, seed):
+    builder = buildDecisionTree(censoredColumns(num_rows, seed))
+    builder.train(max_height = 5, seed = seed, verbose = False)
+    return builder
+
+
+# Every case returns a function running the timed part. The setup done before returning it is not timed.
+def caseGenerate(num_rows, seed, auction_type):
+    exchange = adExchange(num_competitors = 20, auction_type = auction_type, seed = seed, use_population = True, keep_bids = False)
+    return lambda: exchange.generateMultipleBidRecord(num_rows)
+
+
+def caseCensored(num_rows, seed):
+    exchange = adExchange(num_competitors = 20, seed = seed, use_population = True, keep_bids = True)
+    exchange.generateMultipleBidRecord(num_rows)
+    return lambda: exchange.getCensoredRecord(0)
+
+
+def caseTurnbull(num_rows, seed):
+    columns = censoredColumns(num_rows, seed, 'first')
+    builder = buildDecisionTree(columns, second_price_auction = False)
+    data = np.stack([builder.prices, builder.win], axis = 1).tolist()
+    return lambda: turnbull(data, bins = builder.price_bins)
+
+
+def caseKME(num_rows, seed):
+    columns = censoredColumns(num_rows, seed)
+    builder = buildDecisionTree(columns)
+    # Rows in the layout of buildDecisionTree.flatten_data without the attributes: [win, winning_price, bidprice]
+    data = [[win, price, price] for win, price in zip(builder.win.tolist(), builder.prices.tolist())]
+    return lambda: builder.computeDataDistributionByKME(data)
+
+
+def caseTrain(num_rows, seed, wasserstein):
+    builder = buildDecisionTree(censoredColumns(num_rows, seed))
+    return lambda: builder.train(max_height = 5, seed = seed, wasserstein = wasserstein, verbose = False)
+
+
+def caseInference(num_rows, seed):
+    builder = trainedTree(num_rows, seed)
+    data = [[attributes] for attributes in builder.attributes.tolist()]
+    root = builder.root
+    return lambda: [root.inference(k) for k in data]
+
+
+def casePredict(num_rows, seed):
+    builder = trainedTree(num_rows, seed)
+    model = builder.compile()
+    return lambda: model.predictLeaf(builder.attributes)
+
+
+# name -> (function(num_rows, seed), the largest number of rows). Larger scales are skipped, the cases building
+# Python lists of every record would need tens of GB at 10M rows.
+BENCHMARK_CASES = {
+    'generate_first': (lambda n, seed: caseGenerate(n, seed, 'first'), 10000000),
+    'generate_second': (lambda n, seed: caseGenerate(n, seed, 'second'), 10000000),
+    'censored_record': (caseCensored, 1000000),
+    'turnbull': (caseTurnbull, 1000000),
+    'kme': (caseKME, 1000000),
+    'train_euclidean': (lambda n, seed: caseTrain(n, seed, False), 10000000),
+    'train_wasserstein': (lambda n, seed: caseTrain(n, seed, True), 10000000),
+    'inference': (caseInference, 1000000),
+    'compiled_predict': (casePredict, 10000000)
+}
+
+
+def maxRSS():
+    '''
+    Return type: float, the peak resident set size of this process in MB
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+
+def runCase(name, num_rows, seed):
+    '''
+    Function to run one case in this process
+
+    Return type: dict
+        case, rows, seed(int or str)
+        time(float): seconds of the timed part
+        rows_per_second(float)
+        setup_rss_mb(float): The peak RSS after the setup
+        peak_rss_mb(float): The peak RSS after the timed part
+    '''
+    run = BENCHMARK_CASES[name][0](num_rows, seed)
+    setup_rss = maxRSS()
+    start_time = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start_time
+    return {
+        'case': name,
+        'rows': num_rows,
+        'seed': seed,
+        'time': elapsed,
+        'rows_per_second': num_rows / elapsed,
+        'setup_rss_mb': setup_rss,
+        'peak_rss_mb': maxRSS()
+    }
+
+
+def benchmarkSuite(cases = None, scales = BENCHMARK_SCALES, seed = 0, max_rows = None):
+    '''
+    Function to run every case at every scale, each in a fresh process so that its peak RSS is its own
+
+    Input type:
+        cases(list of str): Names in BENCHMARK_CASES, None for all
+        max_rows(int): If given, it replaces the largest number of rows of every case
+
+    Return type: dict
+        meta(dict): The machine and the versions
+        results(list of dict): see runCase. A failed run has an 'error' instead of the measures.
+    '''
+    results = []
+    for name in cases or list(BENCHMARK_CASES):
+        case_max_rows = max_rows or BENCHMARK_CASES[name][1]
+        for num_rows in scales:
+            if num_rows > case_max_rows:
+                continue
+            command = [sys.executable, os.path.abspath(__file__), '--case', name, '--rows', str(num_rows), '--seed', str(seed)]
+            process = subprocess.run(command, capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+            if process.returncode == 0:
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+                print(name + " " + str(num_rows) + " rows: " + str(round(result['time'], 3)) + "s, " + str(round(result['rows_per_second'])) + " rows/s, peak RSS " + str(round(result['peak_rss_mb'])) + "MB")
+            else:
+                result = {'case': name, 'rows': num_rows, 'seed': seed, 'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "exit code " + str(process.returncode)}
+                print(name + " " + str(num_rows) + " rows: failed, " + result['error'])
+            results.append(result)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')
+        },
+        'results': results
+    }
+
+
+def compareResults(results, baseline, threshold = 0.2):
+    '''
+    Function to compare the times of results with the times of baseline, both outputs of benchmarkSuite
+    A case is a regression if its time is more than (1 + threshold) times its baseline time
+
+    Return type: list of dict
+        case, rows, time, baseline_time, ratio(float): time / baseline_time
+    '''
+    baseline_times = {(k['case'], k['rows']): k['time'] for k in baseline['results'] if 'time' in k}
+    regressions = []
+    for result in results['results']:
+        key = (result['case'], result['rows'])
+        if 'time' not in result or key not in baseline_times:
+            continue
+        ratio = result['time'] / baseline_times[key]
+        if ratio > 1 + threshold:
+            regressions.append({'case': key[0], 'rows': key[1], 'time': result['time'], 'baseline_time': baseline_times[key], 'ratio': ratio})
+            print("Regression: " + key[0] + " " + str(key[1]) + " rows is " + str(round(ratio, 2)) + "x the baseline time")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks of the simulation, the estimators, training and inference")
+    parser.add_argument('--suite', action = 'store_true', help = "Run the benchmark suite instead of benchmarkPopulation")
+    parser.add_argument('--cases', nargs = '+', choices = list(BENCHMARK_CASES), help = "Cases of the suite, all by default")
+    parser.add_argument('--scales', nargs = '+', type = int, default = BENCHMARK_SCALES, help = "Numbers of rows")
+    parser.add_argument('--max-rows', type = int, help = "Largest number of rows of every case")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = "Write the results to this JSON file")
+    parser.add_argument('--baseline', help = "Compare with the results in this JSON file")
+    parser.add_argument('--threshold', type = float, default = 0.2, help = "Relative slowdown counted as a regression")
+    parser.add_argument('--case', help = argparse.SUPPRESS)
+    parser.add_argument('--rows', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # One case run by benchmarkSuite in its own process
+        print(json.dumps(runCase(args.case, args.rows, args.seed)))
+    elif args.suite:
+        results = benchmarkSuite(args.cases, args.scales, args.seed, args.max_rows)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent = 1)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compareResults(results, json.load(f), args.threshold)
+            sys.exit(1 if regressions else 0)
+    else:
+        benchmarkPopulation()
@@ -1,10 +1,18 @@
 import collections
+import json
+import os
 import random
-import copy
 import bisect
 import time
-from scipy.stats import wasserstein_distance
-from utils import turnbull
+import math
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from utils import kaplanMeierFromCounts, turnbullCache, quantileBins, quantileSketch
+import divergence as divergence_kernels
+from record import legacyRecordView, mappedRecord
+
+MODEL_FORMAT_VERSION = 1
 
 class decisionTree:
 
@@ -18,6 +26,7 @@ class decisionTree:
         self.dist = dist
         self.attribute_name = attribute_name
         self.data_length = data_length
+        self.leaf_id = -1
 
 
     # Print decision tree
@@ -63,9 +72,578 @@ class decisionTree:
         return next_node.inference(data)
 
 
+    def inferenceLeaf(self, data):
+        '''
+        Same as inference, but return the id of the leaf instead of its distribution
+
+        Return type: int
+        '''
+        node = self
+        while not node.is_leaf:
+            if node.is_discrete:
+                node = node.left if data[0][node.attribute] in node.sc else node.right
+            else:
+                node = node.left if node.sc[1][bisect.bisect_left(node.sc[0], data[0][node.attribute])] else node.right
+        return node.leaf_id
+
+
+    def numberLeaves(self):
+        '''
+        Function to give every leaf an integer id, 0 to the number of leaves - 1, in preorder
+        The ids only depend on the shape of the tree, so they are the same as the ids of compiledDecisionTree
+
+        Return type: int, the number of leaves
+        '''
+        num_leaves = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf:
+                node.leaf_id = num_leaves
+                num_leaves += 1
+            else:
+                stack.append(node.right)
+                stack.append(node.left)
+        return num_leaves
+
+
+    def compile(self, price_bins = None, second_price_auction = True):
+        '''
+        Function to flatten the tree into arrays for batch inference
+        With price_bins (buildDecisionTree.price_bins), the price lookup tables used by winProb, bidForWinRate,
+        expectedCost and expectedSurplus are built too
+
+        Return type: compiledDecisionTree
+        '''
+        return compiledDecisionTree(self, price_bins, second_price_auction)
+
+
+class compiledDecisionTree:
+
+    # Rows are walked through the tree in blocks of this many records
+    block_size = 65536
+
+    # The arrays written by save, the price tables only exist if the tree was compiled with price_bins
+    node_arrays = ['binning', 'left', 'right', 'left_mask', 'leaf_id', 'children', 'leaf_dist']
+    price_arrays = ['price_bins', 'price_edges', 'cdf_table', 'quantile_table', 'cost_table']
+
+    def __init__(self, tree, price_bins = None, second_price_auction = True, num_quantiles = 100):
+        '''
+        A trained decisionTree flattened into node arrays. Nodes are numbered in preorder and leaves get ids in preorder,
+        the same ids as decisionTree.numberLeaves.
+
+        Every node tests one "binning": a continuous attribute with its bins, or a discrete attribute with all the values
+        used in its splits. A record goes to the left child if left_mask[node, bin of the record] is True.
+        Values of a discrete attribute that no split uses fall in an extra bin that always goes right, like in inference.
+
+        Attributes:
+            binning(numpy array): (num_nodes,) int32, the binning tested by each node. 0 for leaves
+            left, right(numpy array): (num_nodes,) int32, the children. A leaf points to itself
+            left_mask(numpy array): (num_nodes, max number of bins + 1) bool
+            leaf_id(numpy array): (num_nodes,) int32, -1 for internal nodes
+            leaf_dist(numpy array): (num_leaves, number of price bins) float64, the distribution of each leaf
+            binnings(list of tuple): (attribute, is_discrete, bins or sorted values) of each binning
+            depth(int): The height of the tree
+
+        If price_bins is given, the price tables of buildPriceTables are built too.
+        '''
+        tree.numberLeaves()
+        nodes = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if not node.is_leaf:
+                stack.append(node.right)
+                stack.append(node.left)
+        position = {id(node): i for i, node in enumerate(nodes)}
+
+        # Collect the binnings: continuous splits on the same bins share one, discrete splits share the union of their values
+        binning_keys = {}
+        discrete_values = collections.defaultdict(set)
+        for node in nodes:
+            if node.is_leaf:
+                continue
+            if node.is_discrete:
+                discrete_values[node.attribute] |= set(node.sc)
+                key = (node.attribute, True)
+            else:
+                key = (node.attribute, False, tuple(node.sc[0]))
+            binning_keys.setdefault(key, len(binning_keys))
+        self.binnings = [None] * len(binning_keys)
+        for key, i in binning_keys.items():
+            if key[1]:
+                self.binnings[i] = (key[0], True, np.array(sorted(discrete_values[key[0]]), dtype = float))
+            else:
+                self.binnings[i] = (key[0], False, np.array(key[2], dtype = float))
+        self.findBinWidths()
+        max_bins = max([len(bins) + 1 for _, _, bins in self.binnings], default = 1)
+
+        num_nodes = len(nodes)
+        self.binning = np.zeros(num_nodes, dtype = np.int32)
+        self.left = np.arange(num_nodes, dtype = np.int32)
+        self.right = np.arange(num_nodes, dtype = np.int32)
+        self.left_mask = np.zeros((num_nodes, max_bins), dtype = bool)
+        self.max_bins = max_bins
+        self.leaf_id = np.full(num_nodes, -1, dtype = np.int32)
+        leaf_dist = []
+        for i, node in enumerate(nodes):
+            if node.is_leaf:
+                self.leaf_id[i] = node.leaf_id
+                leaf_dist.append(node.dist)
+                continue
+            self.left[i] = position[id(node.left)]
+            self.right[i] = position[id(node.right)]
+            if node.is_discrete:
+                self.binning[i] = binning_keys[(node.attribute, True)]
+                values = self.binnings[self.binning[i]][2]
+                self.left_mask[i, np.searchsorted(values, sorted(node.sc))] = True
+            else:
+                self.binning[i] = binning_keys[(node.attribute, False, tuple(node.sc[0]))]
+                self.left_mask[i, :len(node.sc[1])] = np.asarray(node.sc[1], dtype = bool)
+        self.leaf_dist = np.array(leaf_dist, dtype = float)
+        # children[2 * node] is the right child and children[2 * node + 1] the left one
+        self.children = np.stack([self.right, self.left], axis = 1).ravel().astype(np.intp)
+        self.depth = self.findDepth(tree)
+        self.attribute_name = tree.attribute_name
+        self.second_price_auction = second_price_auction
+        # Set by buildDecisionTree.compile, only kept as metadata of the model
+        self.attribute_bins = None
+        self.is_discrete = None
+        self.price_bins = None
+        if price_bins is not None:
+            self.buildPriceTables(price_bins, num_quantiles)
+
+
+    def save(self, path):
+        '''
+        Function to save the model to the directory path
+        The directory holds header.json and one raw little-endian file <array>.bin per array, see loadCompiledTree.
+        header.json is written last, so a directory without it is an incomplete save.
+        '''
+        os.makedirs(path, exist_ok = True)
+        arrays = self.node_arrays + (self.price_arrays if self.price_bins is not None else [])
+        header = {
+            'version': MODEL_FORMAT_VERSION,
+            'kind': 'compiled_tree',
+            'arrays': {},
+            'binnings': [[int(attribute), bool(is_discrete), bins.tolist()] for attribute, is_discrete, bins in self.binnings],
+            'depth': self.depth,
+            'max_bins': self.max_bins,
+            'attribute_name': list(self.attribute_name),
+            'second_price_auction': self.second_price_auction,
+            'num_quantiles': getattr(self, 'num_quantiles', None),
+            'attribute_bins': None if self.attribute_bins is None else [np.asarray(bins).tolist() for bins in self.attribute_bins],
+            'is_discrete': None if self.is_discrete is None else [bool(k) for k in self.is_discrete]
+        }
+        for name in arrays:
+            array = np.asarray(getattr(self, name))
+            dtype = array.dtype.newbyteorder('<').str
+            header['arrays'][name] = {'dtype': dtype, 'shape': list(array.shape)}
+            with open(os.path.join(path, name + ".bin"), "wb") as f:
+                f.write(np.ascontiguousarray(array, dtype = dtype).tobytes())
+        tmp_path = os.path.join(path, "header.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, os.path.join(path, "header.json"))
+
+
+    def findDepth(self, tree):
+        if tree.is_leaf:
+            return 0
+        return 1 + max(self.findDepth(tree.left), self.findDepth(tree.right))
+
+
+    def findBinWidths(self):
+        '''
+        Equal-width bins are found by arithmetic instead of a binary search, see findEqualWidthBins
+        '''
+        self.bin_width = [None] * len(self.binnings)
+        for i, (_, is_discrete, bins) in enumerate(self.binnings):
+            if not is_discrete and len(bins) > 1 and np.allclose(np.diff(bins), bins[1] - bins[0]):
+                self.bin_width[i] = bins[1] - bins[0]
+
+
+    def findBins(self, X):
+        '''
+        Function to find the bin of every record for every binning
+
+        Return type: numpy array (len(X), number of binnings) int
+        '''
+        bin_idx = np.zeros((len(X), max(len(self.binnings), 1)), dtype = np.intp)
+        for i, (attribute, is_discrete, bins) in enumerate(self.binnings):
+            values = np.ascontiguousarray(X[:, attribute])
+            if is_discrete:
+                position = np.minimum(np.searchsorted(bins, values), len(bins) - 1)
+                bin_idx[:, i] = np.where(bins[position] == values, position, len(bins))
+            elif self.bin_width[i] is None:
+                bin_idx[:, i] = np.searchsorted(bins, values, side = 'left')
+            else:
+                bin_idx[:, i] = self.findEqualWidthBins(bins, self.bin_width[i], values)
+        return bin_idx
+
+
+    def findEqualWidthBins(self, bins, width, values):
+        '''
+        Same result as np.searchsorted(bins, values, side = 'left') for equally spaced bins.
+        The arithmetic guess is off by at most one because of rounding, so it is corrected against the bins.
+        '''
+        position = np.ceil((values - bins[0]) / width)
+        np.clip(position, 0, len(bins), out = position)
+        position = position.astype(np.intp)
+        # padded[position] is bins[position - 1] and padded[position + 1] is bins[position]
+        padded = np.concatenate([[-np.inf], bins, [np.inf]])
+        position -= padded[position] >= values
+        position += padded[position + 1] < values
+        return position
+
+
+    def predictLeaf(self, X):
+        '''
+        Function to find the leaf of every row of X with one vectorized pass per tree level
+
+        Input type:
+            X(array): (n, number of attributes)
+
+        Return type: numpy array (n,) int32, the leaf ids
+        '''
+        X = np.asarray(X, dtype = float)
+        leaf_ids = np.empty(len(X), dtype = np.int32)
+        # Work on blocks of rows that stay in cache
+        for start in range(0, len(X), self.block_size):
+            block = X[start:start + self.block_size]
+            bin_idx = self.findBins(block)
+            # Flat indices into bin_idx and left_mask avoid building 2-d index arrays
+            row_offset = np.arange(len(block)) * bin_idx.shape[1]
+            flat_bin_idx = bin_idx.ravel()
+            flat_left_mask = self.left_mask.ravel()
+            node = np.zeros(len(block), dtype = np.intp)
+            for _ in range(self.depth):
+                go_left = flat_left_mask[node * self.max_bins + flat_bin_idx[row_offset + self.binning[node]]]
+                node = self.children[2 * node + go_left]
+            leaf_ids[start:start + len(block)] = self.leaf_id[node]
+        return leaf_ids
+
+
+    def predict(self, X, return_distribution = True):
+        '''
+        Batch version of decisionTree.inference
+
+        Input type:
+            X(array): (n, number of attributes)
+
+        Return type: tuple
+            leaf_ids(numpy array): (n,) int32
+            distributions(numpy array): (n, number of price bins), the distribution of the leaf of each row.
+                None if return_distribution is False
+        '''
+        leaf_ids = self.predictLeaf(X)
+        return leaf_ids, (self.leaf_dist[leaf_ids] if return_distribution else None)
+
+
+    def buildPriceTables(self, price_bins, num_quantiles = 100):
+        '''
+        Function to precompute the per-leaf tables behind the price queries
+        Inside a price bin, the winning price is taken as uniformly distributed, so the CDF is linear between bin edges.
+        The first and the last bin get the width of their neighbour.
+
+        Attributes:
+            price_edges(numpy array): (number of price bins + 1,) the edges of the price bins
+            cdf_table(numpy array): (num_leaves, number of price bins + 1) the CDF of each leaf at the price edges
+            quantile_table(numpy array): (num_leaves, num_quantiles + 1) the lowest price reaching the win rates
+                0, 1 / num_quantiles, ..., 1. The highest edge if the CDF of the leaf stays below the win rate.
+            cost_table(numpy array): (num_leaves, number of price bins + 1) the expected payment of a second price
+                auction when bidding each price edge: E[winning price; winning price <= edge]
+        '''
+        self.price_bins = np.asarray(price_bins, dtype = float)
+        if len(self.price_bins) > 1:
+            low_width = self.price_bins[1] - self.price_bins[0]
+            high_width = self.price_bins[-1] - self.price_bins[-2]
+        else:
+            low_width = high_width = 1.0
+        self.price_edges = np.concatenate([[self.price_bins[0] - low_width], self.price_bins, [self.price_bins[-1] + high_width]])
+        num_leaves = len(self.leaf_dist)
+        self.cdf_table = np.concatenate([np.zeros((num_leaves, 1)), np.maximum.accumulate(self.leaf_dist, axis = 1)], axis = 1)
+
+        self.num_quantiles = num_quantiles
+        win_rates = np.linspace(0, 1, num_quantiles + 1)
+        self.quantile_table = np.empty((num_leaves, num_quantiles + 1))
+        for leaf in range(num_leaves):
+            self.quantile_table[leaf] = self.invertCDF(self.cdf_table[leaf], win_rates)
+
+        masses = np.diff(self.cdf_table, axis = 1)
+        midpoints = (self.price_edges[:-1] + self.price_edges[1:]) / 2
+        self.cost_table = np.concatenate([np.zeros((num_leaves, 1)), np.cumsum(masses * midpoints, axis = 1)], axis = 1)
+
+
+    def invertCDF(self, cdf, win_rates):
+        '''
+        Return type: numpy array, the lowest price of the piecewise linear cdf (given at self.price_edges) reaching each win rate
+        '''
+        upper = np.searchsorted(cdf, win_rates, side = 'left')
+        reached = upper < len(cdf)
+        upper = np.clip(upper, 1, len(cdf) - 1)
+        lower_cdf = cdf[upper - 1]
+        step = cdf[upper] - lower_cdf
+        fraction = np.clip(np.divide(win_rates - lower_cdf, step, out = np.zeros_like(win_rates), where = step > 0), 0, 1)
+        prices = self.price_edges[upper - 1] + fraction * (self.price_edges[upper] - self.price_edges[upper - 1])
+        prices[win_rates <= cdf[0]] = self.price_edges[0]
+        prices[~reached] = self.price_edges[-1]
+        return prices
+
+
+    def findLeaves(self, X, leaf_ids):
+        if self.price_bins is None:
+            raise ValueError("The price tables are not built: compile the tree with price_bins")
+        if leaf_ids is None:
+            leaf_ids = self.predictLeaf(X)
+        return np.asarray(leaf_ids)
+
+
+    def locatePrices(self, prices):
+        '''
+        Return type: tuple
+            bin(numpy array): the price bin of each price, prices out of the edges are clipped
+            fraction(numpy array): the position of the price inside its bin, from 0 to 1
+        '''
+        prices = np.clip(np.asarray(prices, dtype = float), self.price_edges[0], self.price_edges[-1])
+        bin_idx = np.searchsorted(self.price_bins, prices, side = 'left')
+        fraction = (prices - self.price_edges[bin_idx]) / (self.price_edges[bin_idx + 1] - self.price_edges[bin_idx])
+        return bin_idx, fraction
+
+
+    def winProb(self, X, prices, leaf_ids = None):
+        '''
+        Function to find the probability of winning when bidding prices, the CDF of the winning price of the leaf
+
+        Input type:
+            X(array): (n, number of attributes). It can be None if leaf_ids is given
+            prices(float or array): (n,) one bid price per row, or one for every row
+            leaf_ids(array): (n,) the leaves of the rows, e.g. from predictLeaf, to skip the tree walk
+
+        Return type: numpy array (n,)
+        '''
+        leaf_ids = self.findLeaves(X, leaf_ids)
+        bin_idx, fraction = self.locatePrices(prices)
+        low = self.cdf_table[leaf_ids, bin_idx]
+        return low + fraction * (self.cdf_table[leaf_ids, bin_idx + 1] - low)
+
+
+    def bidForWinRate(self, X, target, leaf_ids = None):
+        '''
+        Function to find the lowest bid price reaching the win rate target, interpolated in the quantile table
+
+        Input type:
+            target(float or array): (n,) the win rate of each row, or one for every row, from 0 to 1
+
+        Return type: numpy array (n,)
+        '''
+        leaf_ids = self.findLeaves(X, leaf_ids)
+        position = np.clip(np.asarray(target, dtype = float), 0, 1) * self.num_quantiles
+        lower = np.minimum(position.astype(np.intp), self.num_quantiles - 1)
+        fraction = position - lower
+        low = self.quantile_table[leaf_ids, lower]
+        return low + fraction * (self.quantile_table[leaf_ids, lower + 1] - low)
+
+
+    def expectedCost(self, X, bids, leaf_ids = None):
+        '''
+        Function to find the expected payment when bidding bids: bid * P(win) in a first price auction,
+        E[winning price; winning price <= bid] in a second price auction
+
+        Return type: numpy array (n,)
+        '''
+        leaf_ids = self.findLeaves(X, leaf_ids)
+        bids = np.asarray(bids, dtype = float)
+        if not self.second_price_auction:
+            return bids * self.winProb(None, bids, leaf_ids)
+        bin_idx, fraction = self.locatePrices(bids)
+        mass = self.cdf_table[leaf_ids, bin_idx + 1] - self.cdf_table[leaf_ids, bin_idx]
+        low_edge = self.price_edges[bin_idx]
+        width = self.price_edges[bin_idx + 1] - low_edge
+        return self.cost_table[leaf_ids, bin_idx] + mass * fraction * (low_edge + fraction * width / 2)
+
+
+    def expectedSurplus(self, X, value, bids = None, leaf_ids = None):
+        '''
+        Function to find the expected surplus value * P(win) - expected payment of bidding bids for an impression worth value
+
+        Input type:
+            value(float or array): (n,) the value of the impression of each row, or one for every row
+            bids(float or array): (n,) the bid prices. If None, bid the value, the best bid of a second price auction
+
+        Return type: numpy array (n,)
+        '''
+        leaf_ids = self.findLeaves(X, leaf_ids)
+        value = np.asarray(value, dtype = float)
+        bids = value if bids is None else bids
+        return value * self.winProb(None, bids, leaf_ids) - self.expectedCost(None, bids, leaf_ids)
+
+
+def loadCompiledTree(path):
+    '''
+    Function to load a model written by compiledDecisionTree.save
+    The arrays are memory-mapped read-only, so loading does not depend on the size of the model
+    and processes loading the same model share its pages.
+
+    Return type: compiledDecisionTree
+    '''
+    with open(os.path.join(path, "header.json")) as f:
+        header = json.load(f)
+    if header.get('kind') != 'compiled_tree' or header['version'] != MODEL_FORMAT_VERSION:
+        raise ValueError("Unsupported model format: " + str(header.get('kind')) + " version " + str(header.get('version')))
+    model = compiledDecisionTree.__new__(compiledDecisionTree)
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if 0 in shape:
+            setattr(model, name, np.empty(shape, dtype = spec['dtype']))
+        else:
+            setattr(model, name, np.memmap(os.path.join(path, name + ".bin"), dtype = spec['dtype'], mode = "r", shape = shape))
+    model.binnings = [(attribute, is_discrete, np.array(bins, dtype = float)) for attribute, is_discrete, bins in header['binnings']]
+    model.findBinWidths()
+    model.depth = header['depth']
+    model.max_bins = header['max_bins']
+    model.attribute_name = header['attribute_name']
+    model.second_price_auction = header['second_price_auction']
+    model.attribute_bins = header['attribute_bins']
+    model.is_discrete = header['is_discrete']
+    if 'price_bins' not in header['arrays']:
+        model.price_bins = None
+    else:
+        model.num_quantiles = header['num_quantiles']
+    return model
+
+
+# The builder used by the worker processes of a parallel train(). They are forked, so they share its arrays.
+parallelBuilder = None
+
+
+def computeAttributeKLTask(start, end, attribute_idx, wasserstein, node_id):
+    parallelBuilder.executor = None
+    if parallelBuilder.trace is not None:
+        # The trace of this task is sent back with the result and merged into the trace of the main process
+        parallelBuilder.trace = trainingTrace()
+    indices = parallelBuilder.order[start:end]
+    result = parallelBuilder.computeAttributeKL(indices, attribute_idx, wasserstein, parallelBuilder.attributeRandom(node_id, attribute_idx), node_id)
+    return result, (None if parallelBuilder.trace is None else parallelBuilder.trace.toDict())
+
+
+def buildSubtreeTask(start, end, current_height, max_height, min_leaf_size, wasserstein, node_id):
+    parallelBuilder.executor = None
+    if parallelBuilder.trace is not None:
+        parallelBuilder.trace = trainingTrace()
+    subtree = parallelBuilder.build(start, end, current_height, max_height, min_leaf_size, wasserstein, node_id)
+    return subtree, (None if parallelBuilder.trace is None else parallelBuilder.trace.toDict())
+
+
+class trainingTrace:
+
+    def __init__(self):
+        '''
+        Record of what a buildDecisionTree.train(trace = True) did, see toDict
+
+        Attributes:
+            nodes(list of dict): One per node
+                node_id(int): Heap number of the node, the root is 1
+                height(int): The root is at height 1
+                size(int): The number of records
+                time(float): Seconds spent on the node itself, without its children
+                result(str): 'split', or why the node is a leaf: 'min_leaf_size', 'max_height' or 'no_split'
+                attribute(int): The split attribute, -1 for leaves
+                divergence(float): The divergence of the split, -1 for leaves
+                left_size(int): The number of records of the left child, -1 for leaves
+            attributes(list of dict): One per evaluated (node, attribute)
+                node_id, attribute(int)
+                size(int): The number of records of the node
+                num_bins(int): The number of attribute bins
+                time(float): Seconds
+                iterations(int): 2-means iterations
+                stop(str): 'converged', 'cycle' (2-means came back to an earlier assignment) or 'max_iterations'
+                found(Boolean): Whether the attribute can split the node
+                divergence(float): -1 if found is False
+            counters(dict): Calls and computed distributions of the estimators, calls and compared rows of the divergence kernel
+        '''
+        self.nodes = []
+        self.attributes = []
+        self.counters = collections.Counter()
+        # (iterations, stop) of the last splitHistogram call, read by computeAttributeKL
+        self.last_split = (0, 'converged')
+
+
+    def count(self, name, value = 1):
+        self.counters[name] += value
+
+
+    def addNode(self, node_id, height, size, elapsed, result, attribute = -1, divergence = -1, left_size = -1):
+        self.nodes.append({'node_id': node_id, 'height': height, 'size': size, 'time': elapsed, 'result': result, 'attribute': attribute, 'divergence': float(divergence), 'left_size': left_size})
+
+
+    def addAttribute(self, node_id, attribute, size, num_bins, elapsed, found, divergence):
+        iterations, stop = self.last_split
+        self.attributes.append({'node_id': node_id, 'attribute': attribute, 'size': size, 'num_bins': num_bins, 'time': elapsed, 'iterations': iterations, 'stop': stop, 'found': found, 'divergence': float(divergence)})
+
+
+    def merge(self, trace):
+        '''
+        Function to add the records of a trace given by toDict, e.g. from a worker process
+        '''
+        if trace is None:
+            return
+        self.nodes.extend(trace['nodes'])
+        self.attributes.extend(trace['attributes'])
+        self.counters.update(trace['counters'])
+
+
+    def toDict(self):
+        '''
+        Return type: dict with the keys nodes, attributes and counters, see __init__. Nodes are sorted by node_id.
+        '''
+        return {
+            'nodes': sorted(self.nodes, key = lambda k: k['node_id']),
+            'attributes': sorted(self.attributes, key = lambda k: (k['node_id'], k['attribute'])),
+            'counters': dict(self.counters)
+        }
+
+
+    def toJSON(self, path = None):
+        '''
+        Function to write the trace to the file path, or return it as a string if path is None
+        '''
+        text = json.dumps(self.toDict(), indent = 1)
+        if path is None:
+            return text
+        with open(path, "w") as f:
+            f.write(text)
+
+
+    def summary(self):
+        '''
+        Return type: str, a table with one row per node: its size, its time, the time and the 2-means iterations
+        of its attributes, and the result
+        '''
+        attribute_time = collections.Counter()
+        attribute_iterations = collections.Counter()
+        slowest = {}
+        for k in self.attributes:
+            attribute_time[k['node_id']] += k['time']
+            attribute_iterations[k['node_id']] += k['iterations']
+            if k['node_id'] not in slowest or k['time'] > slowest[k['node_id']]['time']:
+                slowest[k['node_id']] = k
+        lines = ["{:>8} {:>6} {:>10} {:>9} {:>10} {:>10} {:>9}  {}".format("node", "height", "size", "time(s)", "attrs(s)", "iterations", "slowest", "result")]
+        for k in self.toDict()['nodes']:
+            result = k['result'] if k['result'] != 'split' else "split on " + str(k['attribute']) + " (" + str(k['left_size']) + " / " + str(k['size'] - k['left_size']) + ")"
+            slowest_attribute = slowest[k['node_id']]['attribute'] if k['node_id'] in slowest else "-"
+            lines.append("{:>8} {:>6} {:>10} {:>9.4f} {:>10.4f} {:>10} {:>9}  {}".format(k['node_id'], k['height'], k['size'], k['time'], attribute_time[k['node_id']], attribute_iterations[k['node_id']], slowest_attribute, result))
+        lines.append("counters: " + ", ".join(name + " " + str(value) for name, value in sorted(self.counters.items())))
+        return "\n".join(lines)
+
+
 class buildDecisionTree:
 
-    def __init__(self, data, second_price_auction = True, num_categories = 100, num_price_bins = 100, is_discrete = [True, True, True, False, False, False, False, False, False, False]):
+    # In a parallel train(), the attributes of nodes with at least this many records are evaluated in parallel
+    parallel_attribute_min_size = 50000
+
+    def __init__(self, data, second_price_auction = True, num_categories = 100, num_price_bins = 100, is_discrete = [True, True, True, False, False, False, False, False, False, False], turnbull_cache_size = 4096, turnbull_warm_start = False, binning = 'uniform'):
         '''
         Input type:
             data(list): Training data
@@ -73,224 +651,488 @@ class buildDecisionTree:
                 winning_price: -1 if lose
                 bidprice: float
                 attributes: list
+                It can also be a censored record in columns: the output of adExchange.getCensoredColumns,
+                a record.mappedRecord or its toList() view. The columns are used without copying them.
             num_categories(int): The number of bins for each continuous value
             num_price_bins(int): The number of bins for the price
             is_discrete(list of Boolean): Length is equal to the number of attributes. It is used to indicate if each attribute is discrete or not.
+            turnbull_cache_size(int): The number of Turnbull estimates kept by self.turnbull_cache for first price auctions, 0 to disable it
+            turnbull_warm_start(Boolean): Start the Turnbull EM of the attribute bins from the estimate of the node and the
+                EM of the 2-means sides from the previous iteration. It needs far fewer EM steps, but EM stops once a step
+                changes the density by less than epsilon, so the estimates stay closer to the start and the tree can differ.
+            binning(str): 'uniform' for bins of the same width, 'quantile' for bins with the same number of records,
+                which keeps skewed prices and attributes from leaving most bins empty. Repeated quantiles are merged,
+                so there can be fewer bins than asked.
         '''
         self.root = None
         self.data = data
         self.second_price_auction = second_price_auction
-        self.flatten_data = [k[-1] + k[:-1] for k in data]
-        self.attributes_size = len(data[0][-1])
+        self.attributes, self.win, self.prices = self.findColumns(data)
+        self.data_size, self.attributes_size = self.attributes.shape
         self.num_categories = num_categories
         self.num_price_bins = num_price_bins
         self.is_discrete = is_discrete
+        self.binning = binning
         self.attribute_bins = self.findAttributeBins()
         self.price_bins = self.findPriceBins()
+        self.num_price_bins = len(self.price_bins) + 1
+        # Bin positions of every record, computed once. Nodes are ranges of self.order, which is partitioned in place.
+        self.attribute_bin_idx = self.binAttributes()
+        self.price_bin_idx = np.searchsorted(self.price_bins, self.prices, side = 'left')
+        self.order = np.arange(self.data_size)
+        self.seed = None
+        self.executor = None
+        self.turnbull_cache = turnbullCache(turnbull_cache_size)
+        self.turnbull_warm_start = turnbull_warm_start
+        # The divergence kernel chosen by train(), see computeDivergences
+        self.divergence = None
+        # The trainingTrace of the last train(trace = True), and the cap of the 2-means iterations
+        self.trace = None
+        self.max_iterations = None
+
+
+    def findColumns(self, data):
+        '''
+        Function to get the training data as columns
+
+        Return type: tuple
+            attributes(numpy array): (n, number of attributes)
+            win(numpy array): (n,) int8, 1 is win, 0 is lose
+            prices(numpy array): (n,), the winning price if win, else the bid price
+        '''
+        if isinstance(data, legacyRecordView):
+            data = data.store
+        if isinstance(data, mappedRecord) or isinstance(data, dict):
+            win = np.asarray(data['win'], dtype = np.int8)
+            return np.asarray(data['attributes']), win, np.where(win, data['winning_price'], data['bidprice'])
+        win = np.array([int(k[0]) for k in data], dtype = np.int8)
+        prices = np.array([k[1] if k[0] else k[2] for k in data], dtype = float)
+        return np.array([k[-1] for k in data], dtype = float), win, prices
+
+
+    @property
+    def flatten_data(self):
+        '''
+        Rows of attributes + [win, winning_price, bidprice], built on access for old callers
+        '''
+        data = self.data.store if isinstance(self.data, legacyRecordView) else self.data
+        if isinstance(data, mappedRecord) or isinstance(data, dict):
+            return [attributes + [win, winning_price, bidprice] for attributes, win, winning_price, bidprice in zip(self.attributes.tolist(), self.win.tolist(), np.asarray(data['winning_price']).tolist(), np.asarray(data['bidprice']).tolist())]
+        return [k[-1] + k[:-1] for k in self.data]
+
+
+    def binAttributes(self):
+        '''
+        Return type: numpy array (self.attributes_size, n), the bin position of every attribute value, see findAttributeBinIndex
+        '''
+        max_bins = max([self.numAttributeBins(attribute_idx) for attribute_idx in range(self.attributes_size)])
+        dtype = np.int16 if max_bins < np.iinfo(np.int16).max else np.int32
+        attribute_bin_idx = np.empty((self.attributes_size, self.data_size), dtype = dtype)
+        for attribute_idx in range(self.attributes_size):
+            attribute_bin_idx[attribute_idx] = self.findAttributeBinIndex(attribute_idx, self.attributes[:, attribute_idx])
+        return attribute_bin_idx
 
 
     def findAttributeBins(self):
         '''
         Function to find the bins for each attributes
         For discrete attribute, the bins are all distinct values
-        For continuous attribute, the bins are intervals that are divided equally
+        For continuous attribute, the bins are intervals that are divided equally,
+        or that hold the same number of records with quantile binning
 
         Return type: list of list
         '''
         attribute_bins = []
         for attribute_idx in range(self.attributes_size):
+            attribute_values = self.attributes[:, attribute_idx]
             if self.is_discrete[attribute_idx]:
-                attribute_bins.append(list(set([k[attribute_idx] for k in self.flatten_data])))
+                values = np.unique(attribute_values)
+                attribute_bins.append([int(k) if float(k).is_integer() else k for k in values.tolist()])
+            elif self.binning == 'quantile':
+                attribute_bins.append(quantileBins(attribute_values, self.num_categories))
             else:
-                attribute_values = [k[attribute_idx] for k in self.flatten_data]
-                min_attribute_value = min(attribute_values)
-                max_attribute_value = max(attribute_values)
-                bin_width = (max_attribute_value - min_attribute_value) / self.num_categories
-                bins = [min_attribute_value + bin_width]
-                for _ in range(1, self.num_categories - 1):
-                    bins.append(bins[-1] + bin_width)
-                attribute_bins.append(bins)
+                attribute_bins.append(self.equalWidthBins(float(attribute_values.min()), float(attribute_values.max()), self.num_categories))
         return attribute_bins
 
 
     def findPriceBins(self):
         '''
         Function to find the bins for each price
-        The bins are intervals that are divided equally
+        The bins are intervals that are divided equally, or that hold the same number of records with quantile binning
 
         Return type: list(length = self.num_price_bins - 1)
         represents the interval (-inf, x1], (x1, x2], ..., (xn, +inf)
         '''
-        prices = [k[-1] if not k[-3] else k[-2] for k in self.flatten_data]
-        min_price = min(prices)
-        max_price = max(prices)
-        bin_width = (max_price - min_price) / self.num_price_bins
-        bins = [min_price + bin_width]
-        for _ in range(1, self.num_price_bins - 1):
+        if self.binning == 'quantile':
+            return quantileBins(self.prices, self.num_price_bins)
+        return self.equalWidthBins(float(self.prices.min()), float(self.prices.max()), self.num_price_bins)
+
+
+    def equalWidthBins(self, min_value, max_value, num_bins):
+        '''
+        Return type: list(length = num_bins - 1), the inner edges of num_bins intervals of the same width
+        '''
+        bin_width = (max_value - min_value) / num_bins
+        bins = [min_value + bin_width]
+        for _ in range(1, num_bins - 1):
             bins.append(bins[-1] + bin_width)
         return bins
 
     
     def changePriceBins(self, min_price, max_price):
-        bin_width = (max_price - min_price) / self.num_price_bins
-        bins = [min_price + bin_width]
-        for _ in range(1, self.num_price_bins - 1):
-            bins.append(bins[-1] + bin_width)
-        self.price_bins = bins
+        self.price_bins = self.equalWidthBins(min_price, max_price, self.num_price_bins)
+        self.price_bin_idx = np.searchsorted(self.price_bins, self.prices, side = 'left')
 
 
-    def train(self, max_height = 5, min_leaf_size = 100, wasserstein = False):
+    def train(self, max_height = 5, min_leaf_size = 100, wasserstein = False, num_workers = 1, seed = None, divergence = None, rows = None, verbose = True, trace = False, max_iterations = None):
         '''
         Function to train with the given stop conditions: max_height and min_leaf_size
         Save the built tree to self.root
 
+        Input type:
+            wasserstein(Boolean): Use the Wasserstein distance instead of the Euclidean one
+            divergence(str or function): If given, it replaces wasserstein. 'euclidean', 'wasserstein', 'kl' or a kernel
+                kernel(dist, dists) returning the divergences of the rows of dists from dist, see divergence.py
+            num_workers(int): The number of processes. With more than one, the attributes of large nodes are evaluated
+                in parallel and the subtrees below the first level with at least num_workers nodes are built in parallel.
+                The workers are forked, so they share the training data instead of copying it.
+            seed: If given, the random initial assignments of computeAttributeKL are seeded by (seed, node, attribute),
+                so serial and parallel training give the same tree. If None, the global random module is used,
+                and a parallel train() draws a seed from it.
+            rows(array of int): Train on these records only. A record can appear more than once, e.g. in a bootstrap sample.
+            verbose(Boolean): Print the training time, and the summary of the trace if trace is True
+            trace(Boolean): Record timings, 2-means iterations and call counts in self.trace, a trainingTrace.
+                When it is False, the only cost is one check per node, attribute and estimator call.
+            max_iterations(int): Stop the 2-means of an attribute after this many iterations. None for no limit
+
         Return type: decisionTree
         '''
+        global parallelBuilder
         start_time = time.time()
-        self.root = self.build(self.flatten_data, 1, max_height, min_leaf_size, wasserstein)
+        if divergence is None:
+            divergence = 'wasserstein' if wasserstein else 'euclidean'
+        self.divergence = divergence_kernels.findDivergence(divergence, self.price_bins)
+        if num_workers > 1 and seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.trace = trainingTrace() if trace else None
+        self.max_iterations = max_iterations
+        cache_report = self.turnbull_cache.report()
+        # A previous train(rows = ...) leaves its sample in self.order
+        self.order = np.arange(self.data_size) if rows is None else np.array(rows, dtype = np.int64)
+        num_rows = len(self.order)
+        if num_workers > 1:
+            # Partitions done by the workers must be seen by the other processes
+            shared_order = np.frombuffer(multiprocessing.RawArray('q', num_rows), dtype = np.int64)
+            shared_order[:] = self.order
+            self.order = shared_order
+            self.parallel_subtree_height = 1 + math.ceil(math.log2(num_workers))
+            parallelBuilder = self
+            with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('fork')) as executor:
+                self.executor = executor
+                try:
+                    self.root = self.resolveSubtrees(self.build(0, num_rows, 1, max_height, min_leaf_size, wasserstein))
+                finally:
+                    self.executor = None
+                    parallelBuilder = None
+        else:
+            self.root = self.build(0, num_rows, 1, max_height, min_leaf_size, wasserstein)
+        self.root.numberLeaves()
         end_time = time.time()
-        print("Total training time: " + str(end_time - start_time) + "seconds")
+        if verbose:
+            print("Total training time: " + str(end_time - start_time) + "seconds")
+        if verbose and not self.second_price_auction:
+            report = self.turnbull_cache.report()
+            print("Turnbull cache hit rate: " + str(round(report['hit_rate'], 3)) + ", EM runs: " + str(report['num_em_runs']) + ", EM iterations: " + str(report['num_em_iterations']))
+        if self.trace is not None:
+            self.trace.counters['train_time'] = end_time - start_time
+            if not self.second_price_auction:
+                # The cache is kept between trainings, count this one only
+                report = self.turnbull_cache.report()
+                for name in ['hits', 'num_em_runs', 'num_em_iterations']:
+                    self.trace.counters['turnbull_cache_' + name] = report[name] - cache_report[name]
+            if verbose:
+                print(self.trace.summary())
         return self.root
 
 
-    def build(self, data, current_height, max_height, min_leaf_size, wasserstein):
+    def compile(self):
+        '''
+        Function to compile the trained tree with the price tables of this builder
+
+        Return type: compiledDecisionTree
+        '''
+        model = self.root.compile(self.price_bins, self.second_price_auction)
+        model.attribute_bins = self.attribute_bins
+        model.is_discrete = list(self.is_discrete)
+        return model
+
+
+    def build(self, start, end, current_height, max_height, min_leaf_size, wasserstein, node_id = 1):
         '''
         Function to use recursion to build decision tree
+        The node holds the records self.order[start:end]. Only the chosen split is partitioned, in place.
+        node_id numbers the nodes like a heap (root 1, children 2 * node_id and 2 * node_id + 1)
 
-        Return type: decisionTree
+        Return type: decisionTree, or a Future of the subtree in a parallel train()
         '''
-        if len(data) < min_leaf_size or current_height == max_height:
-            return decisionTree(-1, -1, True, True, self.computeDataDistribution(data), data_length = 
-            len(data))
+        start_time = time.perf_counter() if self.trace is not None else 0
+        indices = self.order[start:end]
+        if end - start < min_leaf_size or current_height == max_height:
+            if self.trace is not None:
+                self.trace.addNode(node_id, current_height, end - start, 0, 'min_leaf_size' if end - start < min_leaf_size else 'max_height')
+            return self.buildLeaf(indices, start_time)
+        elif self.executor is not None and current_height == self.parallel_subtree_height:
+            return self.executor.submit(buildSubtreeTask, start, end, current_height, max_height, min_leaf_size, wasserstein, node_id)
         else:
-            tf, attribute, sc, left_data, right_data = self.findSplittingCriteria(data, wasserstein)
+            tf, attribute, sc, left_bins = self.findSplittingCriteria(start, end, wasserstein, node_id)
             if not tf:
-                return decisionTree(-1, -1, True, True, self.computeDataDistribution(data), data_length = len(data))
-            node = decisionTree(attribute, sc, False, self.is_discrete[attribute], -1, data_length = len(data))
-            node.left = self.build(left_data, current_height + 1, max_height, min_leaf_size, wasserstein)
-            node.right = self.build(right_data, current_height + 1, max_height, min_leaf_size, wasserstein)
+                if self.trace is not None:
+                    self.trace.addNode(node_id, current_height, end - start, 0, 'no_split')
+                return self.buildLeaf(indices, start_time)
+            go_left = left_bins[self.attribute_bin_idx[attribute][indices]]
+            middle = start + int(np.count_nonzero(go_left))
+            self.order[start:end] = np.concatenate((indices[go_left], indices[~go_left]))
+            del indices, go_left
+            node = decisionTree(attribute, sc, False, self.is_discrete[attribute], -1, data_length = end - start)
+            if self.trace is not None:
+                self.trace.addNode(node_id, current_height, end - start, time.perf_counter() - start_time, 'split', attribute, self.split_divergence, middle - start)
+            node.left = self.build(start, middle, current_height + 1, max_height, min_leaf_size, wasserstein, node_id * 2)
+            node.right = self.build(middle, end, current_height + 1, max_height, min_leaf_size, wasserstein, node_id * 2 + 1)
             return node
-            
 
-    def findSplittingCriteria(self, data, wasserstein):
+
+    def buildLeaf(self, indices, start_time):
+        '''
+        Function to make the leaf holding the records indices. The time of the leaf is added to its trace record.
+        '''
+        leaf = decisionTree(-1, -1, True, True, self.computeDistributionFromCounts(self.computePriceHistogram(indices)).tolist(), data_length = len(indices))
+        if self.trace is not None:
+            self.trace.nodes[-1]['time'] = time.perf_counter() - start_time
+        return leaf
+
+
+    def resolveSubtrees(self, node):
+        '''
+        Function to replace the Futures left by a parallel build with the subtrees they return
+        '''
+        if isinstance(node, concurrent.futures.Future):
+            subtree, trace = node.result()
+            if self.trace is not None:
+                self.trace.merge(trace)
+            return subtree
+        if not node.is_leaf:
+            node.left = self.resolveSubtrees(node.left)
+            node.right = self.resolveSubtrees(node.right)
+        return node
+
+
+    def attributeRandom(self, node_id, attribute_idx):
+        '''
+        Return type: the random generator for the initial assignment of attribute_idx at node node_id
         '''
-        Function to find the largest divergence among all attributes
+        if self.seed is None:
+            return random
+        return random.Random(str(self.seed) + "/" + str(node_id) + "/" + str(attribute_idx))
+
+
+    def findAttributeBinIndex(self, attribute_idx, values, unseen = None):
+        '''
+        Function to map attribute values to bins, the same way computeAttributeKL groups records
+        For discrete attribute, it is the position of the value in self.attribute_bins[attribute_idx]
+        For continuous attribute, it is bisect_left of the value in self.attribute_bins[attribute_idx]
+
+        Input type:
+            unseen(int): The bin of discrete values that are not in self.attribute_bins[attribute_idx], e.g. -1.
+                None puts them in the bin of a neighbouring value, which is enough for the training data.
+
+        Return type: numpy array of int
+        '''
+        this_attribute_bins = self.attribute_bins[attribute_idx]
+        if self.is_discrete[attribute_idx]:
+            order = np.argsort(this_attribute_bins, kind = 'stable')
+            sorted_bins = np.asarray(this_attribute_bins, dtype = float)[order]
+            position = np.minimum(np.searchsorted(sorted_bins, values), len(order) - 1)
+            if unseen is None:
+                return order[position]
+            return np.where(sorted_bins[position] == values, order[position], unseen)
+        return np.searchsorted(this_attribute_bins, values, side = 'left')
+
+
+    def numAttributeBins(self, attribute_idx):
+        if self.is_discrete[attribute_idx]:
+            return len(self.attribute_bins[attribute_idx])
+        return len(self.attribute_bins[attribute_idx]) + 1
+
+
+    def computeAttributeHistogram(self, indices, attribute_idx):
+        '''
+        Function to count the records self.attributes[indices] of each (attribute bin, price bin, win/lose)
+
+        Return type: numpy array (number of attribute bins, self.num_price_bins, 2), the last axis is [win, lose]
+        '''
+        num_bins = self.numAttributeBins(attribute_idx)
+        flat_idx = self.attribute_bin_idx[attribute_idx][indices].astype(np.int64) * (self.num_price_bins * 2) + self.pricePosition(indices)
+        return np.bincount(flat_idx, minlength = num_bins * self.num_price_bins * 2).reshape(num_bins, self.num_price_bins, 2)
+
+
+    def computePriceHistogram(self, indices):
+        '''
+        Return type: numpy array (self.num_price_bins, 2), the win/lose count of each price bin of the records indices
+        '''
+        return np.bincount(self.pricePosition(indices), minlength = self.num_price_bins * 2).reshape(self.num_price_bins, 2)
+
+
+    def pricePosition(self, indices):
+        '''
+        Return type: numpy array, the position of each record in a flattened (self.num_price_bins, 2) histogram
+        '''
+        return self.price_bin_idx[indices] * 2 + (1 - self.win[indices])
+
+
+    def findSplittingCriteria(self, start, end, wasserstein, node_id = 1):
+        '''
+        Function to find the largest divergence among all attributes of the records self.order[start:end]
+        In a parallel train(), the attributes of large nodes are evaluated by the worker processes
         
         Return type: tuple
             find_or_not(Boolean): Whether we find a best criteria. If False, stop splitting the tree.
             attribute_idx(int): The index of the best attribute. -1 if find_or_not is False
             splittingcriteria:
                 If the attribute is discrete, it is a set of keys that are in left child
-                If the attribute is continuous, it is a list of length self.num_attribute_bins[attribute_idx] and the values of this list are 0 or 1
+                If the attribute is continuous, it is a tuple of the attribute bins and a list of length len(bins) + 1 whose values are 0 or 1
                 0 indicates right child and 1 indicates left child
                 -1 if find_or_not is False
-            left_data(list): Data of left child. [] if find_or_not is False
-            right_data(list): Data of right child. [] if find_or_not is False
+            left_bins(numpy array of Boolean): Whether each attribute bin goes to the left child. None if find_or_not is False
         '''
+        if self.executor is not None and end - start >= self.parallel_attribute_min_size:
+            futures = [self.executor.submit(computeAttributeKLTask, start, end, attribute_idx, wasserstein, node_id) for attribute_idx in range(self.attributes_size)]
+            results = []
+            for future in futures:
+                result, trace = future.result()
+                results.append(result)
+                if self.trace is not None:
+                    self.trace.merge(trace)
+        else:
+            indices = self.order[start:end]
+            results = [self.computeAttributeKL(indices, attribute_idx, wasserstein, self.attributeRandom(node_id, attribute_idx), node_id) for attribute_idx in range(self.attributes_size)]
         kl_values = []
-        for attribute_idx in range(self.attributes_size):
-            tf, kl_attribute, splittingcriteria, left_data, right_data = self.computeAttributeKL(data, attribute_idx, wasserstein)
+        for attribute_idx, (tf, kl_attribute, splittingcriteria, left_bins) in enumerate(results):
             if tf:
-                kl_values.append((kl_attribute, attribute_idx, splittingcriteria, left_data, right_data))
+                kl_values.append((kl_attribute, attribute_idx, splittingcriteria, left_bins))
         if kl_values:
-            max_kl_value = max(kl_values)
-            return True, max_kl_value[1], max_kl_value[2], max_kl_value[3], max_kl_value[4]
+            max_kl_value = max(kl_values, key = lambda k: (k[0], k[1]))
+            # For the trace of the node
+            self.split_divergence = max_kl_value[0]
+            return True, max_kl_value[1], max_kl_value[2], max_kl_value[3]
         else:
-            return False, -1, -1, [], []
+            return False, -1, -1, None
 
 
-    def computeAttributeKL(self, data, attribute_idx, wasserstein):
+    def computeAttributeKL(self, indices, attribute_idx, wasserstein, rng = random, node_id = -1):
         '''
         Function to find the best splitting criteria for attribute attribute_idx.
+        The records are counted once into a (attribute bin, price bin, win/lose) histogram.
+        The 2-means iterations only sum rows of this histogram to get the left and right distributions,
+        and the distribution of every attribute bin is computed once.
 
         Return type: tuple
             find_or_not(Boolean): Whether we find a best criteria. If False, stop splitting the tree.
             divergence(float): The max divergence value. -1 if find_or_not is False
             splittingcriteria:
-                If the attribute is discrete, it is a set whose keys are the possible attribute values and values are 0 or 1
-                If the attribute is continuous, it is a list of length self.num_attribute_bins[attribute_idx] and the values of this list are 0 or 1
+                If the attribute is discrete, it is a set of the attribute values that are in left child
+                If the attribute is continuous, it is a tuple of the attribute bins and a list of length len(bins) + 1 whose values are 0 or 1
                 0 indicates right child and 1 indicates left child
                 -1 if find_or_not is False
-            left_data(list): Data of left child. [] if find_or_not is False
-            right_data(list): Data of right child. [] if find_or_not is False
+            left_bins(numpy array of Boolean): Whether each attribute bin goes to the left child. None if find_or_not is False
+        '''
+        if self.trace is None:
+            return self.splitHistogram(self.computeAttributeHistogram(indices, attribute_idx), attribute_idx, wasserstein, rng)
+        start_time = time.perf_counter()
+        result = self.splitHistogram(self.computeAttributeHistogram(indices, attribute_idx), attribute_idx, wasserstein, rng)
+        self.trace.addAttribute(node_id, attribute_idx, len(indices), self.numAttributeBins(attribute_idx), time.perf_counter() - start_time, result[0], result[1])
+        return result
+
+
+    def splitHistogram(self, histogram, attribute_idx, wasserstein, rng = random):
         '''
+        Function to find the best splitting criteria for attribute attribute_idx from the
+        (attribute bin, price bin, win/lose) histogram of the records of a node, see computeAttributeKL
+
+        Return type: tuple, the same as computeAttributeKL
+        '''
+        this_attribute_bins = self.attribute_bins[attribute_idx]
+        num_bins = len(histogram)
+        bin_sizes = histogram.sum(axis = (1, 2))
+        # Turnbull estimates start from the estimate of the node, then from the previous 2-means iteration
+        warm_start = self.turnbull_warm_start and not self.second_price_auction
+        node_distribution = self.computeDistributionFromCounts(histogram.sum(axis = 0)) if warm_start else None
+        bin_distributions = self.computeDistributionFromCounts(histogram, node_distribution)
+
+        left_or_right = np.array([rng.randint(0, 1) for _ in range(num_bins)], dtype = bool)
+        left_distribution = right_distribution = node_distribution
+        seen = {left_or_right.tobytes()}
+        iterations = 0
+        stop = 'converged'
+        not_converge = True
+        while not_converge:
+            iterations += 1
+            pre_left_or_right = left_or_right
+            left_distribution = self.computeDistributionFromCounts(histogram[left_or_right].sum(axis = 0), left_distribution if warm_start else None)
+            right_distribution = self.computeDistributionFromCounts(histogram[~left_or_right].sum(axis = 0), right_distribution if warm_start else None)
+            left_div = self.computeDivergences(left_distribution, bin_distributions, wasserstein)
+            right_div = self.computeDivergences(right_distribution, bin_distributions, wasserstein)
+            left_or_right = np.where(left_div < right_div, True, np.where(left_div > right_div, False, left_or_right))
+            not_converge = not np.array_equal(left_or_right, pre_left_or_right)
+            if not_converge and left_or_right.tobytes() in seen:
+                # 2-means came back to an earlier assignment and would cycle. Keep the last one, its distributions are computed.
+                left_or_right = pre_left_or_right
+                stop = 'cycle'
+                break
+            if not_converge and self.max_iterations is not None and iterations >= self.max_iterations:
+                # Keep the assignment of the distributions computed last, as for a cycle
+                left_or_right = pre_left_or_right
+                stop = 'max_iterations'
+                break
+            seen.add(left_or_right.tobytes())
+        if self.trace is not None:
+            self.trace.last_split = (iterations, stop)
+
+        # Decide if split succeed
+        left_size = bin_sizes[left_or_right].sum()
+        if left_or_right.all() or (not left_or_right.any()) or left_size == 0 or left_size == bin_sizes.sum():
+            return False, -1, -1, None
+
+        kl_div = self.computeKLDivergence(left_distribution, right_distribution, wasserstein)
         if self.is_discrete[attribute_idx]:
-            this_attribute_bins = self.attribute_bins[attribute_idx]
-            val_data = collections.defaultdict(list)
-            for k in data:
-                val_data[k[attribute_idx]].append(k)
-            left_or_right = [random.randint(0, 1) for _ in range(len(this_attribute_bins))]
-            left = set()
-            for i in range(len(this_attribute_bins)):
-                if left_or_right[i]:
-                    left.add(this_attribute_bins[i])
-            
-            not_converge = True
-            while not_converge:
-                preleft = copy.deepcopy(left)
-                left_data, right_data = [], []
-                for k in this_attribute_bins:
-                    if k in left:
-                        left_data.extend(val_data[k])
-                    else:
-                        right_data.extend(val_data[k])
-                left_distribution, right_distribution = self.computeDataDistribution(left_data), self.computeDataDistribution(right_data)
-
-                for val in this_attribute_bins:
-                    bin_data = val_data[val]
-                    bin_distribution = self.computeDataDistribution(bin_data)
-                    left_div = self.computeKLDivergence(left_distribution, bin_distribution, wasserstein)
-                    right_div = self.computeKLDivergence(right_distribution, bin_distribution, wasserstein)
-                    if left_div < right_div and val not in left:
-                        left.add(val)
-                    elif left_div > right_div and val in left:
-                        left.remove(val)
-                
-                not_converge = (left != preleft)
-
-            # Decide if split succeed
-            if (len(left) == 0) or (len(left) == len(self.attribute_bins[attribute_idx])) or len(left_data) == 0 or len(right_data) == 0:
-                return False, -1, -1, [], []
-
-            kl_div = self.computeKLDivergence(left_distribution, right_distribution, wasserstein)
-            return True, kl_div, left, left_data, right_data
+            splittingcriteria = set(this_attribute_bins[i] for i in np.flatnonzero(left_or_right))
         else:
-            this_attribute_bins = self.attribute_bins[attribute_idx]
-            left_or_right = [random.randint(0, 1) for _ in range(len(this_attribute_bins) + 1)]
-            val_data = [[] for _ in range(len(left_or_right))]
-            for k in data:
-                pos = bisect.bisect_left(this_attribute_bins, k[attribute_idx])
-                val_data[pos].append(k)
-            not_converge = True
-
-            while not_converge:
-                pre_left_or_right = copy.deepcopy(left_or_right)
-                left_data, right_data = [], []
-                for i in range(len(left_or_right)):
-                    if left_or_right[i]:
-                        left_data.extend(val_data[i])
-                    else:
-                        right_data.extend(val_data[i])
-                left_distribution, right_distribution = self.computeDataDistribution(left_data), self.computeDataDistribution(right_data)
+            splittingcriteria = (this_attribute_bins, left_or_right.astype(int).tolist())
+        return True, kl_div, splittingcriteria, left_or_right
 
-                for i in range(len(left_or_right)):
-                    bin_data = val_data[i]
-                    bin_distribution = self.computeDataDistribution(bin_data)
-                    left_div = self.computeKLDivergence(left_distribution, bin_distribution, wasserstein)
-                    right_div = self.computeKLDivergence(right_distribution, bin_distribution, wasserstein)
-                    if left_div < right_div and left_or_right[i] == 0:
-                        left_or_right[i] = 1
-                    elif left_div > right_div and left_or_right[i] == 1:
-                        left_or_right[i] = 0
-                
-                not_converge = (left_or_right != pre_left_or_right)
 
-            # Decide if split succeed
-            if all(left_or_right) or (not any(left_or_right)) or len(left_data) == 0 or len(right_data) == 0:
-                return False, -1, -1, [], []
+    def computeDistributionFromCounts(self, counts, initial_distribution = None):
+        '''
+        Function to find the CDF distribution from win/lose counts per price bin
+        Turnbull estimates go through self.turnbull_cache
+
+        Input type:
+            counts(numpy array): (..., self.num_price_bins, 2)
+            initial_distribution(numpy array): (self.num_price_bins,) a CDF to warm-start the Turnbull EM iterations from
 
-            kl_div = self.computeKLDivergence(left_distribution, right_distribution, wasserstein)
-            return True, kl_div, (this_attribute_bins, left_or_right), left_data, right_data
+        Return type: numpy array (..., self.num_price_bins)
+        '''
+        counts = np.asarray(counts)
+        if self.trace is not None:
+            estimator = 'kme' if self.second_price_auction else 'turnbull'
+            self.trace.count(estimator + '_calls')
+            self.trace.count(estimator + '_distributions', counts.size // (self.num_price_bins * 2))
+        if self.second_price_auction:
+            return kaplanMeierFromCounts(counts)
+        initial_density = None if initial_distribution is None else np.diff(initial_distribution, prepend = 0)
+        if counts.ndim == 2:
+            return self.turnbull_cache.cdf(counts, initial_density)
+        return np.array([self.turnbull_cache.cdf(k, initial_density) for k in counts.reshape(-1, self.num_price_bins, 2)]).reshape(counts.shape[:-1])
 
 
     def computeDataDistribution(self, data):
@@ -306,50 +1148,458 @@ class buildDecisionTree:
 
         Return type: list of length self.num_price_bins
         '''
-        count = [[0, 0] for _ in range(self.num_price_bins)]
-        for k in data:
-            price = k[-2] if k[-3] else k[-1]
-            pos = bisect.bisect_left(self.price_bins, price)
-            count[pos][0] += int(k[-3])
-            count[pos][1] += 1 - int(k[-3])
-        loseprob = [1]
-        ni = len(data)
-        for i in range(len(count)):
-            di = count[i][0]
-            if i:
-                ni -= count[i - 1][0] + count[i - 1][1]
-            if ni != 0:
-                loseprob.append(loseprob[-1] * (1 - di / ni))
-            else:
-                loseprob.append(loseprob[-1])
-        winprob = [1 - k for k in loseprob]
-
         # Use CDF instead
-        dist = winprob[1:]
-        # dist = []
-        # for i in range(1, len(loseprob)):
-        #     dist.append(winprob[i] - winprob[i - 1])
-        return dist
+        return kaplanMeierFromCounts(self.countPrices(data)).tolist()
 
 
     def computeDataDistributionByTurnbull(self, data):
-        modified_data = []
-        for k in data:
-            price = k[-2] if k[-3] else k[-1]
-            modified_data.append([price, k[-3]])
-        return turnbull(modified_data, bins = self.price_bins)[1]
+        return self.turnbull_cache.cdf(self.countPrices(data)).tolist()
+
+
+    def countPrices(self, data):
+        '''
+        Function to count the rows of data (attributes + [win, winning_price, bidprice]) in each price bin
+
+        Return type: numpy array (self.num_price_bins, 2), the last axis is [win, lose]
+        '''
+        win = np.array([int(k[-3]) for k in data], dtype = np.int64)
+        price = np.array([k[-2] if k[-3] else k[-1] for k in data], dtype = float)
+        price_bin_idx = np.searchsorted(self.price_bins, price, side = 'left')
+        return np.bincount(price_bin_idx * 2 + (1 - win), minlength = self.num_price_bins * 2).reshape(self.num_price_bins, 2)
 
 
     def computeKLDivergence(self, dist1, dist2, wasserstein):
         '''
-        Function to compute the divergence
-        Right now we use Euclid divergence here to avoid q = 0
-        TODO: How to change back to KL divergence? Substitute 0 with a very small epsilon?
+        Function to compute the divergence of dist2 from dist1, see computeDivergences
+        The smoothed KL divergence is available with train(divergence = 'kl')
 
         Return type: float
         '''
-        if wasserstein:
-            div = wasserstein_distance(dist1, dist2)
-        else:
-            div = sum([(dist1[i] - dist2[i]) * (dist1[i] - dist2[i]) for i in range(len(dist1))])
-        return div
\ No newline at end of file
+        return float(self.computeDivergences(np.asarray(dist1, dtype = float), np.asarray(dist2, dtype = float)[np.newaxis], wasserstein)[0])
+
+
+    def computeDivergences(self, dist, dists, wasserstein):
+        '''
+        Function to compute the divergences of every row of dists from dist in one call
+        It uses the kernel chosen by train(), or the Euclidean or Wasserstein kernel of divergence.py
+        if the builder has not been trained
+
+        Return type: numpy array (len(dists),)
+        '''
+        kernel = self.divergence
+        if kernel is None:
+            kernel = divergence_kernels.findDivergence('wasserstein' if wasserstein else 'euclidean', self.price_bins)
+        if self.trace is not None:
+            self.trace.count('divergence_calls')
+            self.trace.count('divergence_rows', len(dists))
+        return kernel(dist, dists)
+
+
+class onlineDecisionTree:
+
+    def __init__(self, builder, keep_attribute_counts = False):
+        '''
+        A trained tree that is updated with new censored records instead of being retrained
+        Every leaf keeps its win/lose counts per price bin. They are the sufficient statistics of both estimators:
+        the Kaplan-Meier estimate uses them directly, and for Turnbull a win in bin p is the interval [0, p]
+        and a loss the interval [p, num_price_bins - 1], see turnbullFromCounts.
+        A leaf distribution is only recomputed when it is asked for after its counts changed.
+
+        Input type:
+            builder(buildDecisionTree): A builder after train(). Its bins and estimator are used for the new records,
+                and the counts start from its training data.
+            keep_attribute_counts(Boolean): Also keep the (attribute bin, price bin, win/lose) histogram of every
+                attribute in every leaf. It is needed by resplit and takes
+                number of leaves * number of attributes * number of attribute bins * number of price bins * 2 integers.
+
+        Attributes:
+            tree(decisionTree): builder.root, updated in place by resplit
+            model(compiledDecisionTree): The compiled tree used to route the records
+            counts(numpy array): (number of leaves, number of price bins, 2) int64, the last axis is [win, lose]
+            attribute_counts(list of numpy array): One (number of leaves, number of attribute bins, number of price bins, 2)
+                array per attribute. None if keep_attribute_counts is False
+        '''
+        self.builder = builder
+        self.tree = builder.root
+        self.keep_attribute_counts = keep_attribute_counts
+        self.num_price_bins = builder.num_price_bins
+        self.compile()
+        num_leaves = len(self.leaves)
+        leaf_ids = self.model.predictLeaf(builder.attributes)
+        self.counts = np.zeros((num_leaves, self.num_price_bins, 2), dtype = np.int64)
+        np.add.at(self.counts, (leaf_ids, builder.price_bin_idx, 1 - builder.win), 1)
+        self.attribute_counts = None
+        if keep_attribute_counts:
+            self.attribute_counts = []
+            for attribute_idx in range(builder.attributes_size):
+                attribute_counts = np.zeros((num_leaves, builder.numAttributeBins(attribute_idx), self.num_price_bins, 2), dtype = np.int64)
+                np.add.at(attribute_counts, (leaf_ids, builder.attribute_bin_idx[attribute_idx], builder.price_bin_idx, 1 - builder.win), 1)
+                self.attribute_counts.append(attribute_counts)
+        self.dirty = np.zeros(num_leaves, dtype = bool)
+        # Size and distribution of each leaf when it was built, used by resplit to find grown or drifted leaves
+        self.base_size = self.counts.sum(axis = (1, 2))
+        self.base_dist = np.array(self.model.leaf_dist)
+
+
+    def compile(self):
+        '''
+        Function to number the leaves of self.tree and compile it into self.model
+        '''
+        self.tree.numberLeaves()
+        self.leaves = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf:
+                self.leaves.append(node)
+            else:
+                stack.append(node.right)
+                stack.append(node.left)
+        self.model = self.tree.compile(self.builder.price_bins, self.builder.second_price_auction)
+        self.model.attribute_bins = self.builder.attribute_bins
+        self.model.is_discrete = list(self.builder.is_discrete)
+
+
+    def update(self, data):
+        '''
+        Function to add new censored records, in any format accepted by buildDecisionTree
+        Every record is routed to its leaf in O(height of the tree) and only the counts of that leaf change
+
+        Return type: numpy array (len(data),) int32, the leaf of each record
+        '''
+        attributes, win, prices = self.builder.findColumns(data)
+        attributes = np.asarray(attributes, dtype = float)
+        leaf_ids = self.model.predictLeaf(attributes)
+        price_idx = np.searchsorted(self.builder.price_bins, prices, side = 'left')
+        lose = 1 - win
+        np.add.at(self.counts, (leaf_ids, price_idx, lose), 1)
+        if self.keep_attribute_counts:
+            for attribute_idx, attribute_counts in enumerate(self.attribute_counts):
+                # Discrete values not seen in training have no bin, they are left out of the attribute counts
+                attribute_bin_idx = self.builder.findAttributeBinIndex(attribute_idx, attributes[:, attribute_idx], unseen = -1)
+                seen = attribute_bin_idx >= 0
+                np.add.at(attribute_counts, (leaf_ids[seen], attribute_bin_idx[seen], price_idx[seen], lose[seen]), 1)
+        self.dirty[leaf_ids] = True
+        return leaf_ids
+
+
+    def refresh(self):
+        '''
+        Function to recompute the distributions of the leaves whose counts changed since the last refresh
+        The leaf distributions of self.model, its price tables and the dist of the leaves of self.tree are updated
+
+        Return type: compiledDecisionTree, self.model
+        '''
+        dirty_leaves = np.flatnonzero(self.dirty)
+        if len(dirty_leaves) == 0:
+            return self.model
+        dists = self.builder.computeDistributionFromCounts(self.counts[dirty_leaves])
+        self.model.leaf_dist[dirty_leaves] = dists
+        for leaf, dist in zip(dirty_leaves, dists):
+            self.leaves[leaf].dist = dist.tolist()
+            self.leaves[leaf].data_length = int(self.counts[leaf].sum())
+        if self.model.price_bins is not None:
+            self.model.buildPriceTables(self.model.price_bins, self.model.num_quantiles)
+        self.dirty[:] = False
+        return self.model
+
+
+    def leafHeights(self):
+        '''
+        Return type: numpy array (number of leaves,), the height of each leaf, the root is at height 1
+        '''
+        heights = np.zeros(len(self.leaves), dtype = int)
+        stack = [(self.tree, 1)]
+        while stack:
+            node, height = stack.pop()
+            if node.is_leaf:
+                heights[node.leaf_id] = height
+            else:
+                stack.append((node.left, height + 1))
+                stack.append((node.right, height + 1))
+        return heights
+
+
+    def resplit(self, growth = 2.0, max_drift = None, max_height = None, min_leaf_size = 100, rng = random):
+        '''
+        Function to split again the leaves that grew or drifted since they were built
+        A leaf is split when its number of records reached growth times its size when it was built, or when the
+        divergence between its distribution and its distribution when it was built is above max_drift.
+        The split is found from the attribute counts of the leaf like buildDecisionTree does, with the divergence of builder.train().
+        The new leaves get the price counts of their side of the split, but their attribute counts start empty:
+        the counts of the other attributes cannot be divided by the split.
+        Leaf ids change after a split, they are the preorder ids of the new tree.
+
+        Input type:
+            growth(float): None to ignore the size of the leaves
+            max_drift(float): None to ignore the drift of the leaves
+            max_height(int): Leaves at this height are not split. None for no limit
+            min_leaf_size(int): Leaves with fewer records are not split
+
+        Return type: int, the number of leaves that were split
+        '''
+        if not self.keep_attribute_counts:
+            raise ValueError("resplit needs the attribute counts: create the onlineDecisionTree with keep_attribute_counts = True")
+        self.refresh()
+        sizes = self.counts.sum(axis = (1, 2))
+        candidates = np.zeros(len(self.leaves), dtype = bool)
+        if growth is not None:
+            candidates |= sizes >= growth * np.maximum(self.base_size, 1)
+        if max_drift is not None:
+            drift = np.array([self.builder.computeDivergences(self.base_dist[leaf], self.model.leaf_dist[leaf:leaf + 1], False)[0] for leaf in range(len(self.leaves))])
+            candidates |= drift > max_drift
+        candidates &= sizes >= min_leaf_size
+        if max_height is not None:
+            candidates &= self.leafHeights() < max_height
+
+        # Stats of the leaves of the new tree, keyed by node
+        new_stats = {}
+        num_split = 0
+        for leaf in np.flatnonzero(candidates):
+            results = [self.builder.splitHistogram(attribute_counts[leaf], attribute_idx, False, rng) for attribute_idx, attribute_counts in enumerate(self.attribute_counts)]
+            kl_values = [(kl, attribute_idx, sc, left_bins) for attribute_idx, (tf, kl, sc, left_bins) in enumerate(results) if tf]
+            if not kl_values:
+                continue
+            _, attribute, sc, left_bins = max(kl_values, key = lambda k: (k[0], k[1]))
+            histogram = self.attribute_counts[attribute][leaf]
+            node = self.leaves[leaf]
+            # Records with discrete values not seen in training are not in the attribute counts, the model sends them right
+            unbinned = self.counts[leaf] - histogram.sum(axis = 0)
+            children = []
+            for side, extra in ((left_bins, 0), (~left_bins, unbinned)):
+                counts = histogram[side].sum(axis = 0) + extra
+                dist = self.builder.computeDistributionFromCounts(counts)
+                child = decisionTree(-1, -1, True, True, dist.tolist(), node.attribute_name, int(counts.sum()))
+                new_stats[id(child)] = (counts, dist)
+                children.append(child)
+            node.left, node.right = children
+            node.attribute = attribute
+            node.sc = sc
+            node.is_leaf = False
+            node.is_discrete = self.builder.is_discrete[attribute]
+            node.dist = -1
+            node.leaf_id = -1
+            num_split += 1
+        if num_split == 0:
+            return 0
+
+        old_leaves = {id(node): leaf for leaf, node in enumerate(self.leaves) if node.is_leaf}
+        self.compile()
+        counts, base_size, base_dist = [], [], []
+        attribute_counts = [[] for _ in self.attribute_counts]
+        for node in self.leaves:
+            if id(node) in old_leaves:
+                leaf = old_leaves[id(node)]
+                counts.append(self.counts[leaf])
+                base_size.append(self.base_size[leaf])
+                base_dist.append(self.base_dist[leaf])
+                for k, attribute_counts_k in zip(attribute_counts, self.attribute_counts):
+                    k.append(attribute_counts_k[leaf])
+            else:
+                leaf_counts, dist = new_stats[id(node)]
+                counts.append(leaf_counts)
+                base_size.append(leaf_counts.sum())
+                base_dist.append(dist)
+                for k, attribute_counts_k in zip(attribute_counts, self.attribute_counts):
+                    k.append(np.zeros(attribute_counts_k.shape[1:], dtype = np.int64))
+        self.counts = np.array(counts)
+        self.base_size = np.array(base_size)
+        self.base_dist = np.array(base_dist)
+        self.attribute_counts = [np.array(k) for k in attribute_counts]
+        self.dirty = np.zeros(len(self.leaves), dtype = bool)
+        return num_split
+
+
+class outOfCoreDecisionTree(buildDecisionTree):
+
+    def __init__(self, source, second_price_auction = True, num_categories = 100, num_price_bins = 100, is_discrete = [True, True, True, False, False, False, False, False, False, False], turnbull_cache_size = 4096, turnbull_warm_start = False, binning = 'quantile', chunk_size = 1 << 20, sketch_size = 2048):
+        '''
+        buildDecisionTree for censored records that do not fit in memory
+        The records are read in chunks of chunk_size rows. The first pass finds the bins: the distinct values of
+        discrete attributes, and a quantileSketch of every continuous attribute and of the prices.
+        train() then makes one pass per tree level, which counts the (attribute bin, price bin, win/lose) histograms
+        of all the nodes of the level that can be split. Memory is bounded by these histograms and one chunk,
+        whatever the number of records.
+
+        Input type:
+            source: A censored record on disk, given as its path or as a record.mappedRecord. Any object with the
+                columns 'win', 'winning_price', 'bidprice' and 'attributes' of adExchange.getCensoredColumns also works.
+            binning(str): 'quantile' or 'uniform', see buildDecisionTree. Quantile bins come from the sketches,
+                so they are approximate. Uniform bins only use the exact minimum and maximum.
+            sketch_size(int): The k of the quantile sketches
+        Other parameters are the same as buildDecisionTree.
+        '''
+        self.root = None
+        self.source = mappedRecord(source) if isinstance(source, str) else source
+        self.second_price_auction = second_price_auction
+        self.data_size = len(self.source['win'])
+        self.attributes_size = self.source['attributes'].shape[1]
+        self.num_categories = num_categories
+        self.num_price_bins = num_price_bins
+        self.is_discrete = is_discrete
+        self.binning = binning
+        self.chunk_size = chunk_size
+        self.sketch_size = sketch_size
+        self.findStreamingBins()
+        self.num_price_bins = len(self.price_bins) + 1
+        self.seed = None
+        self.executor = None
+        self.turnbull_cache = turnbullCache(turnbull_cache_size)
+        self.turnbull_warm_start = turnbull_warm_start
+        self.divergence = None
+        self.trace = None
+        self.max_iterations = None
+
+
+    def readChunks(self):
+        '''
+        Function to read the records one chunk at a time
+
+        Return type: generator of tuple
+            attributes(numpy array): (chunk size, number of attributes)
+            win(numpy array): (chunk size,) int8
+            prices(numpy array): (chunk size,) the winning price if win, else the bid price
+        '''
+        for start in range(0, self.data_size, self.chunk_size):
+            end = min(start + self.chunk_size, self.data_size)
+            win = np.asarray(self.source['win'][start:end], dtype = np.int8)
+            prices = np.where(win, self.source['winning_price'][start:end], self.source['bidprice'][start:end])
+            yield np.asarray(self.source['attributes'][start:end], dtype = float), win, prices
+
+
+    def findStreamingBins(self):
+        '''
+        Function to find self.attribute_bins and self.price_bins in one pass over the records
+        '''
+        discrete_values = [set() for _ in range(self.attributes_size)]
+        sketches = [quantileSketch(self.sketch_size, seed) for seed in range(self.attributes_size + 1)]
+        for attributes, win, prices in self.readChunks():
+            for attribute_idx in range(self.attributes_size):
+                if self.is_discrete[attribute_idx]:
+                    discrete_values[attribute_idx].update(np.unique(attributes[:, attribute_idx]).tolist())
+                else:
+                    sketches[attribute_idx].update(attributes[:, attribute_idx])
+            sketches[-1].update(prices)
+        self.attribute_bins = []
+        for attribute_idx in range(self.attributes_size):
+            if self.is_discrete[attribute_idx]:
+                self.attribute_bins.append([int(k) if float(k).is_integer() else k for k in sorted(discrete_values[attribute_idx])])
+            else:
+                self.attribute_bins.append(self.sketchBins(sketches[attribute_idx], self.num_categories))
+        self.price_bins = self.sketchBins(sketches[-1], self.num_price_bins)
+
+
+    def sketchBins(self, sketch, num_bins):
+        if self.binning == 'quantile':
+            return sketch.bins(num_bins)
+        return self.equalWidthBins(sketch.min, sketch.max, num_bins)
+
+
+    def train(self, max_height = 5, min_leaf_size = 100, wasserstein = False, num_workers = 1, seed = None, divergence = None, rows = None, verbose = True, trace = False, max_iterations = None):
+        '''
+        Function to train level by level with one pass over the records per level
+        It gives the same tree as buildDecisionTree.train on the same records and bins when seed is given.
+        The parameters are those of buildDecisionTree.train. num_workers > 1, rows and trace are not supported
+        by the level-wise build and raise ValueError.
+
+        Return type: decisionTree
+        '''
+        if num_workers > 1 or rows is not None or trace:
+            raise ValueError("outOfCoreDecisionTree.train does not support num_workers > 1, rows or trace")
+        start_time = time.time()
+        self.max_iterations = max_iterations
+        if divergence is None:
+            divergence = 'wasserstein' if wasserstein else 'euclidean'
+        self.divergence = divergence_kernels.findDivergence(divergence, self.price_bins)
+        self.seed = seed
+        self.root = decisionTree(-1, -1, True, True, -1)
+        # The left_bins of every internal node, used to route the records
+        self.left_bins = {}
+        frontier = [(self.root, 1, 1)]
+        while frontier:
+            histograms = self.countFrontier([node for node, _, _ in frontier])
+            next_frontier = []
+            for slot, (node, node_id, height) in enumerate(frontier):
+                node_histograms = [k[slot] for k in histograms]
+                price_counts = node_histograms[0].sum(axis = 0)
+                size = int(price_counts.sum())
+                if size < min_leaf_size or height == max_height:
+                    self.makeLeaf(node, price_counts)
+                    continue
+                children = self.splitNode(node, node_id, node_histograms, wasserstein)
+                if children is None:
+                    self.makeLeaf(node, price_counts)
+                    continue
+                for child_id, (child, child_counts) in zip((node_id * 2, node_id * 2 + 1), children):
+                    # A child that will be a leaf already has its counts
+                    if child_counts.sum() < min_leaf_size or height + 1 == max_height:
+                        self.makeLeaf(child, child_counts)
+                    else:
+                        next_frontier.append((child, child_id, height + 1))
+            frontier = next_frontier
+        self.root.numberLeaves()
+        end_time = time.time()
+        if verbose:
+            print("Total training time: " + str(end_time - start_time) + "seconds")
+        return self.root
+
+
+    def countFrontier(self, frontier):
+        '''
+        Function to count the records of the nodes of frontier in one pass
+
+        Return type: list of numpy array, one (len(frontier), number of attribute bins, self.num_price_bins, 2)
+            histogram per attribute
+        '''
+        slots = {id(node): slot for slot, node in enumerate(frontier)}
+        num_bins = [self.numAttributeBins(attribute_idx) for attribute_idx in range(self.attributes_size)]
+        histograms = [np.zeros((len(frontier), k, self.num_price_bins, 2), dtype = np.int64) for k in num_bins]
+        for attributes, win, prices in self.readChunks():
+            attribute_bin_idx = np.array([self.findAttributeBinIndex(attribute_idx, attributes[:, attribute_idx]) for attribute_idx in range(self.attributes_size)])
+            slot = np.full(len(win), -1, dtype = np.int64)
+            self.route(self.root, np.arange(len(win)), attribute_bin_idx, slots, slot)
+            rows = np.flatnonzero(slot >= 0)
+            price_position = np.searchsorted(self.price_bins, prices[rows], side = 'left') * 2 + (1 - win[rows])
+            for attribute_idx, histogram in enumerate(histograms):
+                flat_idx = (slot[rows] * num_bins[attribute_idx] + attribute_bin_idx[attribute_idx][rows]) * (self.num_price_bins * 2) + price_position
+                histogram += np.bincount(flat_idx, minlength = histogram.size).reshape(histogram.shape)
+        return histograms
+
+
+    def route(self, node, rows, attribute_bin_idx, slots, slot):
+        '''
+        Function to find the frontier node of the records rows of a chunk, -1 for records in finished leaves
+        '''
+        if id(node) in slots:
+            slot[rows] = slots[id(node)]
+        elif not node.is_leaf and len(rows):
+            go_left = self.left_bins[id(node)][attribute_bin_idx[node.attribute][rows]]
+            self.route(node.left, rows[go_left], attribute_bin_idx, slots, slot)
+            self.route(node.right, rows[~go_left], attribute_bin_idx, slots, slot)
+
+
+    def splitNode(self, node, node_id, histograms, wasserstein):
+        '''
+        Function to split node in place with the best attribute, like findSplittingCriteria
+
+        Return type: tuple of two (child node, child price counts), None if the node cannot be split
+        '''
+        results = [self.splitHistogram(histograms[attribute_idx], attribute_idx, wasserstein, self.attributeRandom(node_id, attribute_idx)) for attribute_idx in range(self.attributes_size)]
+        kl_values = [(kl, attribute_idx, sc, left_bins) for attribute_idx, (tf, kl, sc, left_bins) in enumerate(results) if tf]
+        if not kl_values:
+            return None
+        _, attribute, sc, left_bins = max(kl_values, key = lambda k: (k[0], k[1]))
+        node.attribute = attribute
+        node.sc = sc
+        node.is_leaf = False
+        node.is_discrete = self.is_discrete[attribute]
+        node.data_length = int(histograms[attribute].sum())
+        node.left = decisionTree(-1, -1, True, True, -1)
+        node.right = decisionTree(-1, -1, True, True, -1)
+        self.left_bins[id(node)] = left_bins
+        return (node.left, histograms[attribute][left_bins].sum(axis = 0)), (node.right, histograms[attribute][~left_bins].sum(axis = 0))
+
+
+    def makeLeaf(self, node, price_counts):
+        node.dist = self.computeDistributionFromCounts(price_counts).tolist()
+        node.data_length = int(price_counts.sum())
@@ -0,0 +1,86 @@
+import functools
+import numpy as np
+
+# Divergence kernels between winning price CDFs on the price bins.
+# A kernel is called as kernel(dist, dists) with dist of shape (num_price_bins,) and dists of shape
+# (n, num_price_bins), and returns the (n,) divergences of every row of dists from dist in one vectorized call.
+
+def euclidean(dist, dists):
+    '''
+    Sum of squared differences of the CDFs
+    '''
+    dists = np.asarray(dists, dtype = float)
+    return ((dists - np.asarray(dist, dtype = float)) ** 2).sum(axis = -1)
+
+
+def priceBinWidths(price_bins):
+    '''
+    Return type: numpy array (len(price_bins) + 1,), the widths of the price bins normalized to sum to 1
+    The first and the last bin are open, they get the width of their neighbour
+    '''
+    price_bins = np.asarray(price_bins, dtype = float)
+    if len(price_bins) < 2:
+        return np.full(len(price_bins) + 1, 1 / (len(price_bins) + 1))
+    widths = np.concatenate([[price_bins[1] - price_bins[0]], np.diff(price_bins), [price_bins[-1] - price_bins[-2]]])
+    return widths / widths.sum()
+
+
+def wasserstein(dist, dists, bin_widths = None):
+    '''
+    1-D Wasserstein distance computed from the CDFs: the integral of |F1 - F2| over the price range,
+    with the range scaled to 1
+
+    Input type:
+        bin_widths(array): (num_price_bins,) normalized widths of the price bins, see priceBinWidths.
+            None for equal widths. Then it is the mean of |F1 - F2|, which is what
+            scipy.stats.wasserstein_distance(dist1, dist2) gives for two CDFs of the same length.
+    '''
+    differences = np.abs(np.asarray(dists, dtype = float) - np.asarray(dist, dtype = float))
+    if bin_widths is None:
+        return differences.mean(axis = -1)
+    return differences @ np.asarray(bin_widths, dtype = float)
+
+
+def smoothedKL(dist, dists, epsilon = 1e-6):
+    '''
+    KL divergence KL(row of dists || dist) of the price bin probabilities
+    The CDFs are turned into probabilities per bin, plus one bin for the mass above the last price bin when a CDF
+    does not reach 1. epsilon is added to every probability before normalizing, so empty bins do not give infinity.
+    '''
+    p = smoothedProbabilities(dists, epsilon)
+    q = smoothedProbabilities(dist, epsilon)
+    return (p * (np.log(p) - np.log(q))).sum(axis = -1)
+
+
+def smoothedProbabilities(cdf, epsilon):
+    cdf = np.clip(np.asarray(cdf, dtype = float), 0, 1)
+    edge_shape = cdf.shape[:-1] + (1,)
+    probabilities = np.maximum(np.diff(np.concatenate([np.zeros(edge_shape), cdf, np.ones(edge_shape)], axis = -1), axis = -1), 0) + epsilon
+    return probabilities / probabilities.sum(axis = -1, keepdims = True)
+
+
+def findDivergence(divergence, price_bins = None):
+    '''
+    Function to get a kernel from its name
+
+    Input type:
+        divergence(str or function): 'euclidean', 'wasserstein' or 'kl', or a kernel, which is returned as it is
+        price_bins(list): The price bins of the CDFs. The Wasserstein distance weights the bins by their widths,
+            without price_bins they are taken as equal.
+
+    Return type: function
+    '''
+    if callable(divergence):
+        return divergence
+    if divergence == 'euclidean':
+        return euclidean
+    if divergence == 'wasserstein':
+        if price_bins is None:
+            return wasserstein
+        bin_widths = priceBinWidths(price_bins)
+        if np.allclose(bin_widths, bin_widths[0]):
+            return wasserstein
+        return functools.partial(wasserstein, bin_widths = bin_widths)
+    if divergence == 'kl':
+        return smoothedKL
+    raise ValueError("Unknown divergence: " + str(divergence))
@@ -0,0 +1,107 @@
+import time
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from decisiontree import buildDecisionTree
+
+# The builder used by the worker processes of decisionForest.train. They are forked, so they share its arrays.
+forestBuilder = None
+
+
+def trainTreeTask(rows, max_height, min_leaf_size, wasserstein, seed, divergence):
+    forestBuilder.train(max_height, min_leaf_size, wasserstein, seed = seed, divergence = divergence, rows = rows, verbose = False)
+    return forestBuilder.compile()
+
+
+class decisionForest:
+
+    def __init__(self, data, num_trees = 64, sample_fraction = 1.0, bootstrap = True, seed = None, **builder_args):
+        '''
+        Bagged ensemble of decision trees on the censored records data
+        All trees share one buildDecisionTree: the bins (so the price_bins of every tree are the same),
+        the binned attributes and the prices are computed once. Each tree is trained on its own sample of rows.
+
+        Input type:
+            data: Training data in any format accepted by buildDecisionTree
+            num_trees(int): The number of trees
+            sample_fraction(float): The size of the sample of each tree, as a fraction of the number of records
+            bootstrap(Boolean): Sample with replacement. Without it, each tree gets a subsample without repeated records.
+            seed: Seeds the samples and the 2-means initializations of every tree
+            builder_args: Other parameters of buildDecisionTree, e.g. second_price_auction or num_price_bins
+        '''
+        self.builder = buildDecisionTree(data, **builder_args)
+        self.num_trees = num_trees
+        self.sample_fraction = sample_fraction
+        self.bootstrap = bootstrap
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.trees = []
+
+
+    def sampleRows(self, rng):
+        num_rows = max(1, int(round(self.builder.data_size * self.sample_fraction)))
+        if self.bootstrap:
+            return rng.integers(0, self.builder.data_size, num_rows)
+        return np.sort(rng.choice(self.builder.data_size, min(num_rows, self.builder.data_size), replace = False))
+
+
+    def train(self, max_height = 5, min_leaf_size = 100, wasserstein = False, num_workers = 1, divergence = None):
+        '''
+        Function to train the trees, with num_workers processes
+        The workers are forked after the builder is made, so they read the training arrays of the parent process
+        instead of getting a pickled copy. Only the row samples go to the workers and only the compiled trees come back.
+
+        Return type: list of compiledDecisionTree
+        '''
+        global forestBuilder
+        start_time = time.time()
+        tasks = []
+        # spawn() advances the sequence, so every train() spawns from a copy to get the same trees for the same seed
+        for tree_seed in np.random.SeedSequence(self.seed_sequence.entropy).spawn(self.num_trees):
+            rng = np.random.default_rng(tree_seed)
+            tasks.append((self.sampleRows(rng), max_height, min_leaf_size, wasserstein, int(rng.integers(1 << 32)), divergence))
+        forestBuilder = self.builder
+        try:
+            if num_workers > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('fork')) as executor:
+                    futures = [executor.submit(trainTreeTask, *task) for task in tasks]
+                    self.trees = [k.result() for k in futures]
+            else:
+                self.trees = [trainTreeTask(*task) for task in tasks]
+        finally:
+            forestBuilder = None
+        end_time = time.time()
+        print("Total training time: " + str(end_time - start_time) + "seconds")
+        return self.trees
+
+
+    def predictLeaves(self, X):
+        '''
+        Return type: numpy array (len(X), self.num_trees) int32, the leaf of every row in every tree
+        '''
+        X = np.asarray(X, dtype = float)
+        return np.stack([tree.predictLeaf(X) for tree in self.trees], axis = 1)
+
+
+    def predict(self, X):
+        '''
+        Function to find the average of the leaf CDFs of the trees for every row of X
+
+        Return type: numpy array (len(X), number of price bins)
+        '''
+        X = np.asarray(X, dtype = float)
+        dists = np.zeros((len(X), len(self.builder.price_bins) + 1))
+        for tree in self.trees:
+            dists += tree.leaf_dist[tree.predictLeaf(X)]
+        return dists / len(self.trees)
+
+
+    def winProb(self, X, prices):
+        '''
+        Function to find the probability of winning when bidding prices, averaged over the trees
+        The average of the piecewise linear CDFs of the trees is the piecewise linear average CDF,
+        so it is the same as compiledDecisionTree.winProb on the averaged distribution
+
+        Return type: numpy array (len(X),)
+        '''
+        X = np.asarray(X, dtype = float)
+        return sum(tree.winProb(X, prices) for tree in self.trees) / len(self.trees)
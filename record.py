@@ -0,0 +1,435 @@
+import json
+import os
+import numpy as np
+
+RECORD_FORMAT_VERSION = 1
+
+# The columns holding the bids of every competitor in a bid record
+BID_COLUMNS = ['bidprices', 'pctrs', 'running_bids']
+
+class bidRecordStore:
+
+    def __init__(self, num_attributes, num_competitors, num_integer_attributes = 0, capacity = 1024):
+        '''
+        Columnar storage for auction records. Every column is a typed array that grows by doubling.
+
+        Columns:
+            attributes: (n, num_attributes) float64, the first num_integer_attributes columns hold integers
+            bidprices: (n, num_competitors) float64
+            pctrs: (n, num_competitors) float64
+            running_bids: (n, num_competitors) float64
+            winning_price: (n,) float64
+            winning_id: (n,) int32
+        '''
+        self.num_attributes = num_attributes
+        self.num_competitors = num_competitors
+        self.num_integer_attributes = num_integer_attributes
+        self.size = 0
+        self.allocate(capacity)
+
+
+    def allocate(self, capacity):
+        old_columns = getattr(self, 'columns', None)
+        self.capacity = capacity
+        self.columns = {
+            'attributes': np.empty((capacity, self.num_attributes)),
+            'bidprices': np.empty((capacity, self.num_competitors)),
+            'pctrs': np.empty((capacity, self.num_competitors)),
+            'running_bids': np.empty((capacity, self.num_competitors)),
+            'winning_price': np.empty(capacity),
+            'winning_id': np.empty(capacity, dtype = np.int32)
+        }
+        if old_columns is not None:
+            for name, column in old_columns.items():
+                self.columns[name][:self.size] = column[:self.size]
+
+
+    def reserve(self, num_records):
+        if self.size + num_records > self.capacity:
+            self.allocate(max(self.size + num_records, self.capacity * 2))
+
+
+    def appendRow(self, winning_price, winning_id, attributes, bidprices, pctrs, running_bids):
+        self.reserve(1)
+        i = self.size
+        self.columns['winning_price'][i] = winning_price
+        self.columns['winning_id'][i] = winning_id
+        self.columns['attributes'][i] = attributes
+        self.columns['bidprices'][i] = bidprices
+        self.columns['pctrs'][i] = pctrs
+        self.columns['running_bids'][i] = running_bids
+        self.size += 1
+
+
+    def appendBlock(self, block):
+        '''
+        Append a dict of arrays with the same keys as self.columns, e.g. the output of adExchange.generateBidBlock
+        '''
+        num_records = len(block['winning_price'])
+        self.reserve(num_records)
+        for name, column in self.columns.items():
+            column[self.size:self.size + num_records] = block[name]
+        self.size += num_records
+
+
+    def clear(self):
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __getitem__(self, name):
+        '''
+        Return the view of column name holding the stored records
+        '''
+        return self.columns[name][:self.size]
+
+
+    def view(self):
+        '''
+        Return type: dict of the views of all columns
+        '''
+        return {name: self[name] for name in self.columns}
+
+
+    def attributeList(self, rows = slice(None)):
+        return attributeList(self['attributes'][rows], self.num_integer_attributes)
+
+
+    def legacyRecord(self, rows = slice(None)):
+        return legacyBidRecord(self.view(), self.num_integer_attributes, rows)
+
+
+def attributeList(attributes, num_integer_attributes):
+    '''
+    Return type: list of list
+        attributes of each record, integer attributes are converted back to int
+    '''
+    if num_integer_attributes == 0:
+        return attributes.tolist()
+    integer_part = attributes[:, :num_integer_attributes].astype(np.int64).tolist()
+    float_part = attributes[:, num_integer_attributes:].tolist()
+    return [a + b for a, b in zip(integer_part, float_part)]
+
+
+def legacyBidRecord(columns, num_integer_attributes, rows = slice(None)):
+    '''
+    Return type: list of list, the layout of adExchange.generateOneBid
+        winning_price: float
+        winning_id: int
+        attributes: list
+        competitor_bidprices: list of (price, competitor_idx)
+    '''
+    bidprices = columns['bidprices'][rows].tolist()
+    return [[winning_price, winning_id, attributes, [(price, i) for i, price in enumerate(row_bidprices)]] for winning_price, winning_id, attributes, row_bidprices in zip(columns['winning_price'][rows].tolist(), columns['winning_id'][rows].tolist(), attributeList(columns['attributes'][rows], num_integer_attributes), bidprices)]
+
+
+def legacyCensoredRecord(columns, num_integer_attributes, rows = slice(None)):
+    '''
+    Return type: list of list, the layout of adExchange.getCensoredRecord
+        win or lose: 1 is win, 0 is lose
+        winning_price: -1 if lose
+        bidprice: float
+        attributes: list
+    '''
+    win = columns['win'][rows].tolist()
+    winning_prices = columns['winning_price'][rows].tolist()
+    bidprices = columns['bidprice'][rows].tolist()
+    attributes = attributeList(columns['attributes'][rows], num_integer_attributes)
+    return [[1, winning_price, bidprice, row_attributes] if is_win else [0, -1, bidprice, row_attributes] for is_win, winning_price, bidprice, row_attributes in zip(win, winning_prices, bidprices, attributes)]
+
+
+def censorRecord(columns, competitor_idx):
+    '''
+    Compute the censored record of competitor competitor_idx from bid record columns. attributes is not copied.
+
+    Return type: dict of numpy arrays
+        win: (n,) int8, 1 is win, 0 is lose
+        winning_price: (n,) float64, -1 if lose
+        bidprice: (n,) float64
+        attributes: (n, num_attributes) float64
+    '''
+    win = columns['winning_id'] == competitor_idx
+    return {
+        'win': win.astype(np.int8),
+        'winning_price': np.where(win, columns['winning_price'], -1.0),
+        'bidprice': columns['bidprices'][:, competitor_idx],
+        'attributes': columns['attributes']
+    }
+
+
+def censorRecords(columns, competitor_idxs, full_info = False, block_size = 65536):
+    '''
+    Compute the censored records of several competitors in one pass over bid record columns
+    The columns of all competitors are filled block by block into compact (number of competitors, n) arrays,
+    so the record of each competitor is contiguous. attributes is not copied.
+
+    Input type:
+        competitor_idxs(list of int)
+        full_info(Boolean): Add the pctr and running_bid columns, as adExchange.getFullInfoOfCompetitor
+
+    Return type: dict
+        competitor_idx -> dict of numpy arrays, see censorRecord, plus pctr and running_bid if full_info.
+        Every dict can be given to buildDecisionTree directly.
+    '''
+    competitor_idxs = np.asarray(competitor_idxs, dtype = np.int64)
+    num_records = len(columns['winning_id'])
+    num_selected = len(competitor_idxs)
+    names = [('win', 'winning_id', np.int8), ('winning_price', 'winning_price', np.float64), ('bidprice', 'bidprices', np.float64)]
+    if full_info:
+        names += [('pctr', 'pctrs', np.float64), ('running_bid', 'running_bids', np.float64)]
+    bulk = {name: np.empty((num_selected, num_records), dtype = dtype) for name, _, dtype in names}
+    # A range of competitors is a slice of the bid columns, which saves gathering them
+    if num_selected and np.array_equal(competitor_idxs, np.arange(competitor_idxs[0], competitor_idxs[0] + num_selected)):
+        selected = slice(int(competitor_idxs[0]), int(competitor_idxs[0]) + num_selected)
+    else:
+        selected = competitor_idxs
+    for start in range(0, num_records, block_size):
+        rows = slice(start, start + block_size)
+        win = columns['winning_id'][rows] == competitor_idxs[:, np.newaxis]
+        bulk['win'][:, rows] = win
+        bulk['winning_price'][:, rows] = np.where(win, columns['winning_price'][rows], -1.0)
+        for name, source, _ in names[2:]:
+            bulk[name][:, rows] = columns[source][rows][:, selected].T
+    return {idx: dict({name: bulk[name][i] for name, _, _ in names}, attributes = columns['attributes']) for i, idx in enumerate(competitor_idxs.tolist())}
+
+
+def checkBidRecord(columns, auction_type = None, block_size = 65536):
+    '''
+    Check bid record columns in one vectorized pass and raise AssertionError with the number of bad records
+        The bid of every competitor is running_bid * pctr, or less once its budget is spent
+        The winner has the highest bid, and the winning price is the highest (first price) or the second highest (second price) bid
+    '''
+    num_records = len(columns['winning_id'])
+    num_bad_bids = num_bad_winners = num_bad_prices = 0
+    for start in range(0, num_records, block_size):
+        rows = slice(start, start + block_size)
+        bidprices = columns['bidprices'][rows]
+        unbounded = columns['running_bids'][rows] * columns['pctrs'][rows]
+        num_bad_bids += int(np.count_nonzero((bidprices < 0) | (bidprices > unbounded + 1e-9 * np.abs(unbounded))))
+        winning_id = columns['winning_id'][rows]
+        top = bidprices.max(axis = 1)
+        num_bad_winners += int(np.count_nonzero(bidprices[np.arange(len(bidprices)), winning_id] != top))
+        if auction_type == 'first':
+            num_bad_prices += int(np.count_nonzero(columns['winning_price'][rows] != top))
+        elif auction_type == 'second':
+            num_bad_prices += int(np.count_nonzero(columns['winning_price'][rows] != np.partition(bidprices, bidprices.shape[1] - 2, axis = 1)[:, -2]))
+    if num_bad_bids or num_bad_winners or num_bad_prices:
+        raise AssertionError("Inconsistent bid record: " + str(num_bad_bids) + " bids, " + str(num_bad_winners) + " winners and " + str(num_bad_prices) + " winning prices out of " + str(num_records) + " records")
+
+
+class legacyRecordView:
+
+    def __init__(self, store):
+        '''
+        Read-only list view of a bidRecordStore or a mappedRecord for callers of the old list records
+        Each item is built on access by store.legacyRecord
+        '''
+        self.store = store
+
+
+    def __len__(self):
+        return len(self.store)
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.store.legacyRecord(slice(*idx.indices(len(self.store))))
+        if idx < 0:
+            idx += len(self.store)
+        if not 0 <= idx < len(self.store):
+            raise IndexError("record index out of range")
+        return self.store.legacyRecord(slice(idx, idx + 1))[0]
+
+
+    def __iter__(self):
+        block_size = 65536
+        for start in range(0, len(self.store), block_size):
+            yield from self.store.legacyRecord(slice(start, start + block_size))
+
+
+class competitorRecordView:
+
+    def __init__(self, store, competitor_idx):
+        '''
+        Read-only list view of the (price, pctr, running_bid) tuples of one competitor in a bidRecordStore
+        '''
+        self.store = store
+        self.competitor_idx = competitor_idx
+
+
+    def __len__(self):
+        return len(self.store)
+
+
+    def column(self, name):
+        return self.store[name][:, self.competitor_idx]
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(zip(self.column('bidprices')[idx].tolist(), self.column('pctrs')[idx].tolist(), self.column('running_bids')[idx].tolist()))
+        return (float(self.column('bidprices')[idx]), float(self.column('pctrs')[idx]), float(self.column('running_bids')[idx]))
+
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def recordColumns(kind, num_attributes, num_competitors = 0):
+    '''
+    Return type: dict
+        column name -> (dtype, width), width is 0 for a vector
+        A bid record without bids (num_competitors = 0, see adExchange keep_bids) has no bidprices, pctrs and running_bids
+    '''
+    if kind == 'bid':
+        columns = {'attributes': ('<f8', num_attributes)}
+        if num_competitors:
+            columns.update({name: ('<f8', num_competitors) for name in BID_COLUMNS})
+        columns.update({
+            'winning_price': ('<f8', 0),
+            'winning_id': ('<i4', 0)
+        })
+        return columns
+    elif kind == 'censored':
+        return {
+            'win': ('<i1', 0),
+            'winning_price': ('<f8', 0),
+            'bidprice': ('<f8', 0),
+            'attributes': ('<f8', num_attributes)
+        }
+    raise ValueError("Unknown record kind: " + str(kind))
+
+
+class recordWriter:
+
+    def __init__(self, path, kind, columns, config, append = False):
+        '''
+        Write records to the directory path in chunks
+        The directory holds header.json and one raw little-endian file <column>.bin per column.
+        header.json is rewritten after every chunk, so the files can be mapped while the writer is still appending.
+
+        Input type:
+            kind(str): 'bid' or 'censored'
+            columns(dict): column name -> (dtype, width), see recordColumns
+            config(dict): The configuration of the exchange, e.g. adExchange.getConfig()
+            append(Boolean): Append to an existing record at path instead of overwriting it
+        '''
+        self.path = path
+        if append and os.path.exists(os.path.join(path, "header.json")):
+            with open(os.path.join(path, "header.json")) as f:
+                self.header = json.load(f)
+            if self.header['kind'] != kind:
+                raise ValueError("Cannot append " + kind + " records to a " + self.header['kind'] + " record")
+            mode = "ab"
+        else:
+            os.makedirs(path, exist_ok = True)
+            self.header = {
+                'version': RECORD_FORMAT_VERSION,
+                'kind': kind,
+                'num_records': 0,
+                'columns': {name: {'dtype': dtype, 'width': width} for name, (dtype, width) in columns.items()},
+                'config': config
+            }
+            mode = "wb"
+        self.files = {name: open(os.path.join(path, name + ".bin"), mode) for name in self.header['columns']}
+        self.writeHeader()
+
+
+    def append(self, block):
+        '''
+        Append a chunk given as a dict of arrays, one per column
+        '''
+        num_records = None
+        for name, spec in self.header['columns'].items():
+            column = np.ascontiguousarray(block[name], dtype = spec['dtype'])
+            if num_records is None:
+                num_records = len(column)
+            elif len(column) != num_records:
+                raise ValueError("Columns of a chunk must have the same length")
+            self.files[name].write(column.tobytes())
+        for f in self.files.values():
+            f.flush()
+        self.header['num_records'] += num_records or 0
+        self.writeHeader()
+
+
+    def writeHeader(self):
+        tmp_path = os.path.join(self.path, "header.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.header, f)
+        os.replace(tmp_path, os.path.join(self.path, "header.json"))
+
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class mappedRecord:
+
+    def __init__(self, path):
+        '''
+        Read-only, memory-mapped record written by recordWriter. Nothing is read until a column is used.
+        '''
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        if self.header['version'] != RECORD_FORMAT_VERSION:
+            raise ValueError("Unsupported record format version: " + str(self.header['version']))
+        self.path = path
+        self.kind = self.header['kind']
+        self.config = self.header['config']
+        self.num_integer_attributes = self.config.get('num_integer_attributes', 0)
+        self.size = self.header['num_records']
+        self.columns = {}
+        for name, spec in self.header['columns'].items():
+            shape = (self.size, spec['width']) if spec['width'] else (self.size,)
+            if self.size == 0:
+                self.columns[name] = np.empty(shape, dtype = spec['dtype'])
+            else:
+                self.columns[name] = np.memmap(os.path.join(path, name + ".bin"), dtype = spec['dtype'], mode = "r", shape = shape)
+        if self.kind == 'bid':
+            # A record saved without the bids, as the bid columns of an exchange with keep_bids = False
+            for name in BID_COLUMNS:
+                if name not in self.columns:
+                    self.columns[name] = np.empty((self.size, 0))
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+
+    def view(self):
+        return dict(self.columns)
+
+
+    def legacyRecord(self, rows = slice(None)):
+        if self.kind == 'bid':
+            return legacyBidRecord(self.columns, self.num_integer_attributes, rows)
+        return legacyCensoredRecord(self.columns, self.num_integer_attributes, rows)
+
+
+    def toList(self):
+        '''
+        Return type: list view of the records in the layout of adExchange.bid_record or adExchange.getCensoredRecord
+        It can be given to buildDecisionTree directly
+        '''
+        return legacyRecordView(self)
+
+
+def loadRecord(path):
+    return mappedRecord(path)
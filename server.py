@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import json
+import numpy as np
+from auction import adExchange
+from decisiontree import buildDecisionTree, loadCompiledTree
+
+
+class bidServer:
+
+    def __init__(self, model, target_win_rate = 0.5, max_batch_size = 256, max_wait = 0.001):
+        '''
+        Asyncio bid request service scoring micro-batches of requests with a compiled tree
+        A request waits at most max_wait seconds for other requests to join its batch. The batch is scored
+        with one predictLeaf call and the bid of each request is the price reaching target_win_rate in the CDF of its leaf.
+
+        Input type:
+            model(compiledDecisionTree): Compiled with price_bins, e.g. buildDecisionTree.compile()
+            target_win_rate(float): From 0 to 1
+            max_batch_size(int): A batch is scored as soon as it has this many requests
+            max_wait(float): Seconds. 0 scores the requests already queued without waiting for more
+        '''
+        if model.price_bins is None:
+            raise ValueError("The price tables are not built: compile the tree with price_bins")
+        self.model = model
+        self.target_win_rate = target_win_rate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.batcher = None
+        self.batch_sizes = []
+
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batch_sizes = []
+        self.batcher = asyncio.get_running_loop().create_task(self.runBatcher())
+
+
+    async def stop(self):
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.batcher = None
+
+
+    async def bid(self, attributes, target_win_rate = None):
+        '''
+        Function to answer one bid request
+
+        Input type:
+            attributes(list): The attributes of the impression, in the order of adExchange
+            target_win_rate(float): Replaces the target win rate of the server for this request
+
+        Return type: float, the bid price
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((attributes, self.target_win_rate if target_win_rate is None else target_win_rate, future))
+        return await future
+
+
+    async def runBatcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.scoreBatch(batch)
+
+
+    def scoreBatch(self, batch):
+        '''
+        Function to score a batch in the event loop. It holds the loop for one vectorized call,
+        which is much shorter than the wait window for batches of a few hundred requests.
+        '''
+        try:
+            X = np.array([attributes for attributes, _, _ in batch], dtype = float)
+            targets = np.array([target for _, target, _ in batch], dtype = float)
+            prices = self.model.bidForWinRate(X, targets).tolist()
+        except Exception as error:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.batch_sizes.append(len(batch))
+        for (_, _, future), price in zip(batch, prices):
+            # The caller may have given up on the request
+            if not future.done():
+                future.set_result(price)
+
+
+    async def handleConnection(self, reader, writer):
+        '''
+        One JSON object per line: {"attributes": [...]} with an optional "target_win_rate".
+        The answer is {"bid": price} on one line, or {"error": message}.
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    response = {'bid': await self.bid(request['attributes'], request.get('target_win_rate'))}
+                except Exception as error:
+                    response = {'error': str(error)}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self, host = "127.0.0.1", port = 8765):
+        '''
+        Function to answer bid requests over TCP until cancelled, see handleConnection
+        '''
+        await self.start()
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        print("Serving bid requests on " + host + ":" + str(port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def requestAttributes(exchange, num_requests, block_size = 65536):
+    '''
+    Function to draw the attributes of num_requests bid requests from the auctions of exchange
+
+    Return type: numpy array (num_requests, number of attributes)
+    '''
+    blocks = [block['attributes'] for block in exchange.streamBidBlocks(block_size, num_requests)]
+    if not blocks:
+        return np.empty((0, exchange.num_attributes))
+    return np.concatenate(blocks)
+
+
+async def openLoopLoad(server, attributes, rate, seed = None):
+    '''
+    Function to send the requests with Poisson arrivals at rate requests per second, whatever the response times.
+    The latency of a request is counted from its scheduled arrival, so a server falling behind
+    is not hidden by requests being sent late.
+
+    Input type:
+        attributes(array): (n, number of attributes), one request per row, see requestAttributes
+
+    Return type: tuple
+        latencies(numpy array): (n,) seconds
+        duration(float): Seconds from the first arrival to the last response
+    '''
+    loop = asyncio.get_running_loop()
+    arrivals = np.cumsum(np.random.default_rng(seed).exponential(1 / rate, len(attributes)))
+    latencies = np.empty(len(attributes))
+    requests = attributes.tolist()
+
+    async def send(i, scheduled):
+        await server.bid(requests[i])
+        latencies[i] = loop.time() - scheduled
+
+    tasks = []
+    start_time = loop.time()
+    sent = 0
+    while sent < len(requests):
+        now = loop.time() - start_time
+        # Send every request already due, the sleeps of the loop are coarser than the arrival gaps at high rates
+        while sent < len(requests) and arrivals[sent] <= now:
+            tasks.append(loop.create_task(send(sent, start_time + arrivals[sent])))
+            sent += 1
+        if sent < len(requests):
+            await asyncio.sleep(max(0, arrivals[sent] - (loop.time() - start_time)))
+    await asyncio.gather(*tasks)
+    return latencies, loop.time() - start_time
+
+
+def latencyReport(latencies, duration, batch_sizes = None, slo = 0.010):
+    '''
+    Return type: dict
+        requests(int)
+        throughput(float): Requests per second
+        p50_ms, p99_ms, p999_ms, max_ms(float)
+        slo_violations(float): The fraction of requests slower than slo seconds
+        mean_batch_size(float)
+    '''
+    latencies = np.asarray(latencies)
+    p50, p99, p999 = np.percentile(latencies, [50, 99, 99.9]) * 1000 if len(latencies) else (0.0, 0.0, 0.0)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / duration if duration > 0 else 0.0,
+        'p50_ms': float(p50),
+        'p99_ms': float(p99),
+        'p999_ms': float(p999),
+        'max_ms': float(latencies.max() * 1000) if len(latencies) else 0.0,
+        'slo_violations': float(np.mean(latencies > slo)) if len(latencies) else 0.0,
+        'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0
+    }
+
+
+def runLoadTest(model, exchange, rate = 5000, num_requests = 50000, target_win_rate = 0.5, max_batch_size = 256, max_wait = 0.001, seed = None, slo = 0.010):
+    '''
+    Function to run an open-loop load test of a bidServer on requests drawn from exchange
+
+    Return type: dict, see latencyReport
+    '''
+    attributes = requestAttributes(exchange, num_requests)
+
+    async def run():
+        server = bidServer(model, target_win_rate, max_batch_size, max_wait)
+        await server.start()
+        try:
+            latencies, duration = await openLoopLoad(server, attributes, rate, seed)
+        finally:
+            await server.stop()
+        return latencyReport(latencies, duration, server.batch_sizes, slo)
+
+    report = asyncio.run(run())
+    print("rate " + str(rate) + "/s, batch " + str(max_batch_size) + ", wait " + str(max_wait * 1000) + "ms: " + str(round(report['throughput'])) + " requests/s, p50 " + str(round(report['p50_ms'], 3)) + "ms, p99 " + str(round(report['p99_ms'], 3)) + "ms, p999 " + str(round(report['p999_ms'], 3)) + "ms, mean batch " + str(round(report['mean_batch_size'], 1)))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Bid request service scoring micro-batches with a compiled decision tree")
+    parser.add_argument('--model', help = "Directory of a model saved by compiledDecisionTree.save. By default a tree is trained on simulated records")
+    parser.add_argument('--train-rows', type = int, default = 100000)
+    parser.add_argument('--max-height', type = int, default = 5)
+    parser.add_argument('--auction-type', default = 'second', choices = ['first', 'second'])
+    parser.add_argument('--num-competitors', type = int, default = 20)
+    parser.add_argument('--target-win-rate', type = float, default = 0.5)
+    parser.add_argument('--max-batch-size', type = int, nargs = '+', default = [256], help = "One load test per value")
+    parser.add_argument('--max-wait', type = float, nargs = '+', default = [0.001], help = "Seconds, one load test per value")
+    parser.add_argument('--rate', type = float, nargs = '+', default = [5000], help = "Requests per second, one load test per value")
+    parser.add_argument('--requests', type = int, default = 50000)
+    parser.add_argument('--slo', type = float, default = 0.010, help = "Latency budget in seconds")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--serve', action = 'store_true', help = "Answer bid requests over TCP instead of running load tests")
+    parser.add_argument('--host', default = "127.0.0.1")
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--output', help = "Write the reports to this JSON file")
+    args = parser.parse_args()
+
+    exchange = adExchange(num_competitors = args.num_competitors, auction_type = args.auction_type, seed = args.seed, use_population = True, keep_bids = True)
+    if args.model:
+        model = loadCompiledTree(args.model)
+    else:
+        blocks = list(exchange.streamCensoredBlocks(0, 65536, args.train_rows))
+        builder = buildDecisionTree({name: np.concatenate([k[name] for k in blocks]) for name in blocks[0]}, second_price_auction = args.auction_type == 'second')
+        builder.train(max_height = args.max_height, seed = args.seed)
+        model = builder.compile()
+
+    if args.serve:
+        try:
+            asyncio.run(bidServer(model, args.target_win_rate, args.max_batch_size[0], args.max_wait[0]).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        reports = []
+        for rate in args.rate:
+            for max_batch_size in args.max_batch_size:
+                for max_wait in args.max_wait:
+                    report = runLoadTest(model, exchange, rate, args.requests, args.target_win_rate, max_batch_size, max_wait, args.seed, args.slo)
+                    report.update({'rate': rate, 'max_batch_size': max_batch_size, 'max_wait': max_wait})
+                    reports.append(report)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(reports, f, indent = 1)
@@ -0,0 +1,322 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+import uuid
+from auction import adExchange
+from decisiontree import buildDecisionTree, loadCompiledTree
+from record import censorRecord, loadRecord, recordColumns, recordWriter
+
+# Part of every key. Change it when a stage computes something different for the same inputs.
+CACHE_VERSION = 1
+
+
+def hashKey(stage, inputs):
+    '''
+    Return type: str, the SHA-256 of the stage name and its inputs written as canonical JSON
+    '''
+    text = json.dumps({'version': CACHE_VERSION, 'stage': stage, 'inputs': inputs}, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class resultCache:
+
+    def __init__(self, path, max_bytes = 10 << 30):
+        '''
+        Content-addressed cache of stage outputs on disk, evicted in least recently used order
+        Every entry is the directory path/<key>. An entry is written to a temporary directory and renamed,
+        so a reader never sees a partial entry and two processes computing the same entry do not conflict.
+        The modification time of an entry is its last use.
+
+        Input type:
+            max_bytes(int): The size above which the least recently used entries are removed
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok = True)
+
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key)
+
+
+    def get(self, key):
+        '''
+        Return type: str, the directory of the entry, or None if it is not cached
+        '''
+        path = self.entryPath(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+
+    def put(self, key, write):
+        '''
+        Function to add an entry
+
+        Input type:
+            write(function): write(directory) writes the entry into an empty directory
+
+        Return type: str, the directory of the entry
+        '''
+        tmp_path = os.path.join(self.path, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        try:
+            write(tmp_path)
+            os.rename(tmp_path, self.entryPath(key))
+        except OSError:
+            # Another process added the same entry first, it holds the same content
+            if not os.path.isdir(self.entryPath(key)):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors = True)
+        self.evict(keep = [key])
+        return self.get(key) or self.entryPath(key)
+
+
+    def getOrCompute(self, key, write):
+        '''
+        Return type: tuple
+            path(str): The directory of the entry
+            cached(Boolean): Whether it was already cached
+        '''
+        path = self.get(key)
+        if path is not None:
+            return path, True
+        return self.put(key, write), False
+
+
+    def entries(self):
+        '''
+        Return type: list of (last use, size in bytes, key), the least recently used first
+        '''
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(".tmp-") or not entry.is_dir():
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(entry.path) for name in names)
+                entries.append((entry.stat().st_mtime, size, entry.name))
+            except FileNotFoundError:
+                continue
+        return sorted(entries)
+
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+
+    def evict(self, keep = ()):
+        '''
+        Function to remove the least recently used entries until the cache fits in max_bytes. The entries in keep are not removed.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            shutil.rmtree(self.entryPath(key), ignore_errors = True)
+            total -= size
+
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(self.entryPath(key), ignore_errors = True)
+
+
+# A sweep point is a dict:
+#     exchange(dict): Parameters of adExchange, including seed. use_population and keep_bids are always True
+#     num_records(int): The number of simulated auctions
+#     competitor_idx(int): The competitor of getCensoredRecord
+#     builder(dict): Parameters of buildDecisionTree other than data
+#     train(dict): Parameters of buildDecisionTree.train other than num_workers and verbose, including seed
+# The key of each stage covers the inputs of the stages before it, so a point sharing the exchange and competitor
+# of a cached point only trains.
+
+def simulationKey(point):
+    # Without a seed adExchange draws from the global random module, and the output would not be what the key says
+    if point['exchange'].get('seed') is None:
+        raise ValueError("The exchange of a sweep point needs a seed")
+    # The simulation always runs a population keeping its bids, see simulationStage
+    if 'use_population' in point['exchange'] or 'keep_bids' in point['exchange']:
+        raise ValueError("use_population and keep_bids are set by the sweep, not by the exchange of a sweep point")
+    return hashKey('simulation', {'exchange': point['exchange'], 'num_records': point['num_records']})
+
+
+def censoringKey(point):
+    return hashKey('censoring', {'simulation': simulationKey(point), 'competitor_idx': point['competitor_idx']})
+
+
+def trainingKey(point):
+    # Without a seed the 2-means initializations come from the global random module
+    if point.get('train', {}).get('seed') is None:
+        raise ValueError("The train parameters of a sweep point need a seed")
+    return hashKey('training', {'censoring': censoringKey(point), 'builder': point.get('builder', {}), 'train': point.get('train', {})})
+
+
+def simulationStage(cache, point, block_size = 65536):
+    '''
+    Function to simulate the auctions of point, block by block into a bid record on disk
+
+    Return type: tuple (directory of the record.mappedRecord, cached)
+    '''
+    def write(path):
+        exchange = adExchange(**dict(point['exchange'], use_population = True, keep_bids = True))
+        with recordWriter(path, 'bid', recordColumns('bid', exchange.num_attributes, exchange.num_competitors), exchange.getConfig()) as writer:
+            for block in exchange.streamBidBlocks(block_size, point['num_records']):
+                writer.append(block)
+    return cache.getOrCompute(simulationKey(point), write)
+
+
+def censoringStage(cache, point, block_size = 65536):
+    '''
+    Function to compute the censored record of point from its simulated auctions
+
+    Return type: tuple (directory of the record.mappedRecord, cached)
+    '''
+    def write(path):
+        simulation_path, _ = simulationStage(cache, point, block_size)
+        bid_record = loadRecord(simulation_path)
+        with recordWriter(path, 'censored', recordColumns('censored', bid_record['attributes'].shape[1]), bid_record.config) as writer:
+            for start in range(0, len(bid_record), block_size):
+                rows = slice(start, start + block_size)
+                writer.append(censorRecord({name: bid_record[name][rows] for name in ('winning_id', 'winning_price', 'bidprices', 'attributes')}, point['competitor_idx']))
+    return cache.getOrCompute(censoringKey(point), write)
+
+
+def trainingStage(cache, point):
+    '''
+    Function to train the tree of point on its censored record
+
+    Return type: tuple (directory of the compiled tree, see decisiontree.loadCompiledTree, cached)
+    '''
+    def write(path):
+        censored_path, _ = censoringStage(cache, point)
+        builder = buildDecisionTree(loadRecord(censored_path), **point.get('builder', {}))
+        start_time = time.perf_counter()
+        builder.train(verbose = False, **point.get('train', {}))
+        train_time = time.perf_counter() - start_time
+        builder.compile().save(os.path.join(path, "model"))
+        with open(os.path.join(path, "summary.json"), "w") as f:
+            json.dump({'train_time': train_time, 'num_records': builder.data_size}, f)
+    return cache.getOrCompute(trainingKey(point), write)
+
+
+SWEEP_STAGES = [('simulation', simulationKey, simulationStage), ('censoring', censoringKey, censoringStage), ('training', trainingKey, trainingStage)]
+
+
+def runStageTask(cache_path, max_bytes, stage_idx, point):
+    cache = resultCache(cache_path, max_bytes)
+    start_time = time.perf_counter()
+    path, cached = SWEEP_STAGES[stage_idx][2](cache, point)
+    return path, cached, time.perf_counter() - start_time
+
+
+def sweepGrid(base, **axes):
+    '''
+    Function to make the points of a grid sweep
+
+    Input type:
+        base(dict): A sweep point
+        axes: name -> list of values. A name is a key of the point, or "section.key" for a key inside
+            the exchange, builder or train section, e.g. **{'train.max_height': [3, 5, 7]}
+
+    Return type: list of dict
+    '''
+    points = []
+    for values in itertools.product(*axes.values()):
+        point = json.loads(json.dumps(base))
+        for name, value in zip(axes, values):
+            if "." in name:
+                section, key = name.split(".", 1)
+                point.setdefault(section, {})[key] = value
+            else:
+                point[name] = value
+        points.append(point)
+    return points
+
+
+def runSweep(points, cache_path = "./sweep_cache", max_bytes = 10 << 30, num_workers = 1):
+    '''
+    Function to run the sweep points through the cached stages
+    The stages run one after the other. Within a stage every distinct key is computed once, and the keys run in
+    num_workers processes, so points sharing a simulation do not simulate it twice.
+
+    Return type: list of dict, one per point
+        point(dict)
+        model(str): The directory of the compiled tree, see decisiontree.loadCompiledTree
+        keys(dict): stage -> key
+        cached(dict): stage -> whether it came from the cache
+        train_time(float): The training time of the tree, also when it came from the cache
+    '''
+    cache = resultCache(cache_path, max_bytes)
+    results = [{'point': point, 'keys': {}, 'cached': {}} for point in points]
+    for stage_idx, (stage, key_function, _) in enumerate(SWEEP_STAGES):
+        distinct = {}
+        for result in results:
+            key = key_function(result['point'])
+            result['keys'][stage] = key
+            distinct.setdefault(key, result['point'])
+        start_time = time.perf_counter()
+        if num_workers > 1 and len(distinct) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = min(num_workers, len(distinct))) as executor:
+                futures = {key: executor.submit(runStageTask, cache_path, max_bytes, stage_idx, point) for key, point in distinct.items()}
+                outputs = {key: future.result() for key, future in futures.items()}
+        else:
+            outputs = {key: runStageTask(cache_path, max_bytes, stage_idx, point) for key, point in distinct.items()}
+        for result in results:
+            path, cached, _ = outputs[result['keys'][stage]]
+            result['cached'][stage] = cached
+            if stage == 'training':
+                result['model'] = os.path.join(path, "model")
+                with open(os.path.join(path, "summary.json")) as f:
+                    result['train_time'] = json.load(f)['train_time']
+        num_cached = sum(k[1] for k in outputs.values())
+        print(stage + ": " + str(len(distinct)) + " distinct, " + str(num_cached) + " cached, " + str(round(time.perf_counter() - start_time, 3)) + "s")
+    # The models of this sweep stay even if they alone do not fit
+    cache.evict(keep = set(result['keys']['training'] for result in results))
+    return results
+
+
+def loadSweepModels(results):
+    '''
+    Return type: list of compiledDecisionTree, one per result of runSweep
+    '''
+    return [loadCompiledTree(result['model']) for result in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Sweep of tree hyperparameters with cached simulations and trainings")
+    parser.add_argument('--cache', default = "./sweep_cache")
+    parser.add_argument('--max-gb', type = float, default = 10)
+    parser.add_argument('--num-workers', type = int, default = 1)
+    parser.add_argument('--num-records', type = int, default = 100000)
+    parser.add_argument('--num-competitors', type = int, default = 20)
+    parser.add_argument('--auction-type', default = 'second', choices = ['first', 'second'])
+    parser.add_argument('--seeds', type = int, nargs = '+', default = [0])
+    parser.add_argument('--competitors', type = int, nargs = '+', default = [0])
+    parser.add_argument('--max-heights', type = int, nargs = '+', default = [5])
+    parser.add_argument('--min-leaf-sizes', type = int, nargs = '+', default = [100])
+    parser.add_argument('--output', help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    base = {
+        'exchange': {'num_competitors': args.num_competitors, 'auction_type': args.auction_type},
+        'num_records': args.num_records,
+        'competitor_idx': 0,
+        'builder': {'second_price_auction': args.auction_type == 'second'},
+        'train': {'seed': 0}
+    }
+    points = sweepGrid(base, **{'exchange.seed': args.seeds, 'competitor_idx': args.competitors, 'train.max_height': args.max_heights, 'train.min_leaf_size': args.min_leaf_sizes})
+    results = runSweep(points, args.cache, int(args.max_gb * (1 << 30)), args.num_workers)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 1)
@@ -0,0 +1,118 @@
+import random
+import pytest
+import numpy as np
+from auction import adExchange, competitor, competitorPopulation
+from record import loadRecord
+
+
+def sequentialBids(raw_bids, budgets):
+    '''
+    Charge raw_bids with competitor.bidprice, one auction after the other
+    '''
+    competitors = [competitor(i, 1, budget = budget, rng = random.Random(i)) for i, budget in enumerate(budgets)]
+    bids = np.empty_like(raw_bids)
+    for i, k in enumerate(competitors):
+        k.generatePctr = lambda attributes: 1.0
+        running_bids = iter(raw_bids[:, i].tolist())
+        k.generateRunningBid = lambda: next(running_bids)
+        bids[:, i] = [k.bidprice([0.0]) for _ in range(len(raw_bids))]
+    return bids, np.array([k.remaining_budget for k in competitors])
+
+
+def test_charge_budgets_matches_sequential_bids():
+    rng = np.random.default_rng(0)
+    raw_bids = rng.random((500, 4)) * 10
+    budgets = [float('inf'), 1e12, 300.0, 0.0]
+    expected_bids, expected_remaining = sequentialBids(raw_bids, budgets)
+
+    population = competitorPopulation(4, 1, rng = random.Random(0))
+    population.remaining_budget = np.array(budgets)
+    bids = raw_bids.copy()
+    population.chargeBudgets(bids[:200])
+    population.chargeBudgets(bids[200:])
+
+    # Bids are untouched until the budget runs out
+    assert np.array_equal(bids[:, :2], raw_bids[:, :2])
+    exhausted = np.argmax(np.cumsum(raw_bids[:, 2]) > 300)
+    assert np.array_equal(bids[:exhausted, 2], raw_bids[:exhausted, 2])
+    assert np.allclose(bids, expected_bids)
+    assert np.all(bids[exhausted + 1:, 2:] == 0)
+    assert np.allclose(population.remaining_budget, expected_remaining)
+
+
+def test_large_budget_keeps_bids():
+    exchange = adExchange(num_competitors = 20, seed = 0, use_population = True, keep_bids = True)
+    exchange.getPopulation().remaining_budget[:] = 1e12
+    exchange.generateMultipleBidRecord(20000)
+    assert np.array_equal(exchange.record['bidprices'], exchange.record['running_bids'] * exchange.record['pctrs'])
+    exchange.getCensoredDatasets([0, 1], full_info = True)
+
+
+def test_save_record_without_bids(tmp_path):
+    exchange = adExchange(num_competitors = 5, seed = 0, use_population = True, keep_bids = False)
+    exchange.generateMultipleBidRecord(1000, save = True, save_path = str(tmp_path / "bid_record"))
+    record = loadRecord(str(tmp_path / "bid_record.rec"))
+    assert len(record) == 1000
+    assert record['bidprices'].shape == (1000, 0)
+    assert np.array_equal(record['winning_id'], exchange.record['winning_id'])
+
+
+def test_stream_censored_without_bids(capsys):
+    exchange = adExchange(num_competitors = 5, seed = 0, use_population = True, keep_bids = False)
+    assert list(exchange.streamCensoredRecord(0, 100)) == []
+    assert "keep_bids = False" in capsys.readouterr().out
+
+
+def test_population_drops_bids_by_default():
+    assert not adExchange(num_competitors = 5, seed = 0, use_population = True).keep_bids
+    assert adExchange(num_competitors = 5, seed = 0).keep_bids
+
+
+def test_bidprice_of_exchange_competitor():
+    exchange = adExchange(num_competitors = 3, seed = 0)
+    exchange.generateMultipleBidRecord(10)
+    k = exchange.competitors[0]
+    remaining_budget = k.remaining_budget = 100.0
+    with pytest.raises(ValueError):
+        k.bidprice([1] * exchange.num_attributes)
+    assert k.remaining_budget == remaining_budget
+    assert len(k.bidprice_record) == 10
+    exchange.generateMultipleBidRecord(1)
+    assert len(k.bidprice_record) == 11
+
+
+def test_config_myself_idx():
+    assert adExchange(num_competitors = 5, seed = 0, myself_idx = 3).getConfig()['myself_idx'] == 3
+    assert adExchange(num_competitors = 5, seed = 0, use_population = True).getConfig()['myself_idx'] == -1
+
+
+def parallelRecord(budget_policy, budgets = None):
+    exchange = adExchange(num_competitors = 6, seed = 2, use_population = True, keep_bids = True, auction_type = 'second')
+    if budgets is not None:
+        exchange.setRemainingBudgets(budgets)
+    exchange.generateParallelBidRecord(3001, num_workers = 3, seed = 5, budget_policy = budget_policy, block_size = 500)
+    return exchange
+
+
+@pytest.mark.parametrize('budget_policy', ['partition', 'reconcile'])
+def test_parallel_record_is_reproducible(budget_policy):
+    budgets = [float('inf'), 2000.0, 500.0, 0.0, 1e12, 100.0]
+    exchange1 = parallelRecord(budget_policy, budgets)
+    exchange2 = parallelRecord(budget_policy, budgets)
+    for name, column in exchange1.record.view().items():
+        assert np.array_equal(column, exchange2.record[name]), name
+    assert np.array_equal(exchange1.population.remaining_budget, exchange2.population.remaining_budget)
+
+
+def test_parallel_reconcile_matches_charge_budgets():
+    budgets = [float('inf'), 2000.0, 500.0, 0.0, 1e12, 100.0]
+    exchange = parallelRecord('reconcile', budgets)
+    record = exchange.record.view()
+    population = competitorPopulation(6, 1, rng = random.Random(0))
+    population.remaining_budget = np.array(budgets)
+    bids = record['running_bids'] * record['pctrs']
+    population.chargeBudgets(bids)
+    assert np.array_equal(record['bidprices'], bids)
+    assert np.array_equal(exchange.population.remaining_budget, population.remaining_budget)
+    assert np.array_equal(record['winning_id'], 5 - np.argmax(bids[:, ::-1], axis = 1))
+    assert np.array_equal(record['winning_price'], np.sort(bids, axis = 1)[:, -2])
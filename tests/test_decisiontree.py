@@ -0,0 +1,196 @@
+import random
+import numpy as np
+import pytest
+from auction import adExchange
+from decisiontree import buildDecisionTree, loadCompiledTree, onlineDecisionTree, outOfCoreDecisionTree
+from forest import decisionForest
+
+
+@pytest.fixture(scope = 'module')
+def columns():
+    exchange = adExchange(num_competitors = 10, seed = 1, use_population = True, keep_bids = True)
+    exchange.generateMultipleBidRecord(20000)
+    return exchange.getCensoredDatasets([0])[0]
+
+
+def test_train_after_rows_uses_all_records(columns):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 3, seed = 0, rows = np.arange(100), verbose = False)
+    assert builder.root.data_length == 100
+    builder.train(max_height = 3, seed = 0, verbose = False)
+    assert builder.root.data_length == builder.data_size
+
+
+def test_online_update_skips_unseen_discrete_values(columns):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 3, seed = 0, verbose = False)
+    online = onlineDecisionTree(builder, keep_attribute_counts = True)
+    before = [k.copy() for k in online.attribute_counts]
+    new_records = {name: np.array(column[:50]) for name, column in columns.items()}
+    new_records['attributes'][:, 0] = 99
+    online.update(new_records)
+    assert online.counts.sum() == builder.data_size + 50
+    # Attribute 0 is discrete and 99 is not one of its values
+    assert np.array_equal(online.attribute_counts[0], before[0])
+    assert online.attribute_counts[1].sum() == before[1].sum() + 50
+
+
+def test_discrete_resplit_keeps_unseen_records(columns):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 2, seed = 0, verbose = False)
+    online = onlineDecisionTree(builder, keep_attribute_counts = True)
+    new_records = {name: np.array(column) for name, column in columns.items()}
+    new_records['attributes'][:, :3] = 99
+    online.update(new_records)
+    # Only the discrete attributes can split
+    for attribute_idx in range(3, builder.attributes_size):
+        online.attribute_counts[attribute_idx][:] = 0
+    total = online.counts.sum()
+    assert online.resplit(growth = 1.5, min_leaf_size = 1, rng = random.Random(0)) > 0
+    assert online.counts.sum() == total == 2 * builder.data_size
+
+
+def assertSameModel(model1, model2):
+    for name in ['binning', 'left_mask', 'children', 'leaf_dist']:
+        assert np.array_equal(getattr(model1, name), getattr(model2, name)), name
+
+
+def test_predict_leaf_matches_inference(columns):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 5, seed = 0, verbose = False)
+    model = builder.compile()
+    X = np.array(columns['attributes'][:5000])
+    # Discrete values that no split uses and values outside the bins
+    X[:100, 0] = 99
+    X[100:200, 5] = -1
+    X[200:300, 6] = 1000
+    expected = [builder.root.inferenceLeaf([row]) for row in X.tolist()]
+    assert np.array_equal(model.predictLeaf(X), expected)
+
+
+@pytest.mark.parametrize('second_price_auction', [True, False])
+def test_parallel_train_matches_serial(columns, second_price_auction):
+    data = columns if second_price_auction else {name: column[:3000] for name, column in columns.items()}
+    builder = buildDecisionTree(data, second_price_auction = second_price_auction)
+    builder.train(max_height = 4, seed = 3, verbose = False)
+    serial = builder.compile()
+    # Evaluate the attributes of every node in the workers too
+    builder.parallel_attribute_min_size = 0
+    builder.train(max_height = 4, seed = 3, num_workers = 2, verbose = False)
+    assertSameModel(serial, builder.compile())
+
+
+def test_forest_parallel_matches_serial(columns):
+    forest = decisionForest(columns, num_trees = 4, sample_fraction = 0.5, seed = 0)
+    serial = forest.train(max_height = 3)
+    parallel = forest.train(max_height = 3, num_workers = 2)
+    for tree1, tree2 in zip(serial, parallel):
+        assertSameModel(tree1, tree2)
+
+
+def test_out_of_core_train_accepts_base_parameters(tmp_path, capsys):
+    exchange = adExchange(num_competitors = 10, seed = 1, use_population = True, keep_bids = True)
+    exchange.generateMultipleBidRecord(5000)
+    exchange.saveRecord(exchange.getCensoredColumns(0), str(tmp_path / "censored"))
+    builder = outOfCoreDecisionTree(str(tmp_path / "censored"), chunk_size = 1000)
+    root = builder.train(max_height = 3, seed = 0, verbose = False, max_iterations = 5)
+    assert root.data_length == 5000
+    assert capsys.readouterr().out == ""
+    with pytest.raises(ValueError):
+        builder.train(num_workers = 2)
+
+
+def test_columns_with_integer_attributes(columns):
+    data = dict(columns, attributes = columns['attributes'].astype(np.int64))
+    builder = buildDecisionTree(data)
+    assert builder.attribute_bins[0] == [1, 2]
+    rows = builder.flatten_data
+    assert len(rows) == builder.data_size
+    assert rows[0] == columns['attributes'][0].astype(np.int64).tolist() + [int(columns['win'][0]), float(columns['winning_price'][0]), float(columns['bidprice'][0])]
+
+
+@pytest.mark.parametrize('second_price_auction, divergence', [(True, 'euclidean'), (True, 'wasserstein'), (False, 'euclidean')])
+def test_out_of_core_matches_in_memory(columns, second_price_auction, divergence):
+    data = columns if second_price_auction else {name: column[:3000] for name, column in columns.items()}
+    builder = buildDecisionTree(data, second_price_auction = second_price_auction, binning = 'uniform')
+    builder.train(max_height = 4, seed = 3, divergence = divergence, verbose = False)
+    out_of_core = outOfCoreDecisionTree(data, second_price_auction = second_price_auction, binning = 'uniform', chunk_size = 1500)
+    out_of_core.train(max_height = 4, seed = 3, divergence = divergence, verbose = False)
+    assert np.array_equal(builder.price_bins, out_of_core.price_bins)
+    assertSameModel(builder.compile(), out_of_core.compile())
+
+
+def test_compiled_tree_save_and_load(columns, tmp_path):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 5, seed = 0, verbose = False)
+    model = builder.compile()
+    model.save(str(tmp_path / "model"))
+    loaded = loadCompiledTree(str(tmp_path / "model"))
+    for name in model.node_arrays + model.price_arrays:
+        assert np.array_equal(getattr(model, name), getattr(loaded, name)), name
+        assert getattr(model, name).dtype == getattr(loaded, name).dtype, name
+    assert len(model.binnings) == len(loaded.binnings)
+    for (attribute1, is_discrete1, bins1), (attribute2, is_discrete2, bins2) in zip(model.binnings, loaded.binnings):
+        assert (attribute1, is_discrete1) == (attribute2, is_discrete2)
+        assert np.array_equal(bins1, bins2)
+    for name in ['depth', 'max_bins', 'second_price_auction', 'num_quantiles', 'is_discrete']:
+        assert getattr(model, name) == getattr(loaded, name), name
+    assert all(np.array_equal(bins1, bins2) for bins1, bins2 in zip(model.attribute_bins, loaded.attribute_bins))
+
+    X = np.array(columns['attributes'][:5000])
+    prices = np.random.default_rng(0).random(len(X)) * 20
+    assert np.array_equal(model.predictLeaf(X), loaded.predictLeaf(X))
+    assert np.array_equal(model.winProb(X, prices), loaded.winProb(X, prices))
+    assert np.array_equal(model.bidForWinRate(X, 0.3), loaded.bidForWinRate(X, 0.3))
+    assert np.array_equal(model.expectedCost(X, prices), loaded.expectedCost(X, prices))
+
+    # Without price tables
+    builder.root.compile().save(str(tmp_path / "tree"))
+    loaded = loadCompiledTree(str(tmp_path / "tree"))
+    assert loaded.price_bins is None
+    assert np.array_equal(model.predictLeaf(X), loaded.predictLeaf(X))
+
+
+@pytest.fixture(scope = 'module')
+def price_model(columns):
+    builder = buildDecisionTree(columns)
+    builder.train(max_height = 4, seed = 0, verbose = False)
+    return builder.compile(), np.array(columns['attributes'][:2000])
+
+
+def test_bid_for_win_rate_inverts_win_prob(price_model):
+    model, X = price_model
+    leaf_ids = model.predictLeaf(X)
+    max_win_rate = model.cdf_table[leaf_ids, -1]
+    # On the quantile grid the inverse is exact, between grid points it is interpolated
+    for targets, tolerance in [(np.arange(101)[np.arange(len(X)) % 101] / 100, 1e-9), (np.random.default_rng(0).random(len(X)), 0.02)]:
+        reached = targets <= max_win_rate
+        win_rates = model.winProb(None, model.bidForWinRate(None, targets, leaf_ids), leaf_ids)
+        assert np.allclose(win_rates[reached], targets[reached], rtol = 0, atol = tolerance)
+
+
+def test_win_prob_at_price_bins(price_model):
+    model, _ = price_model
+    leaf_ids = np.repeat(np.arange(len(model.leaf_dist)), len(model.price_bins))
+    prices = np.tile(model.price_bins, len(model.leaf_dist))
+    win_rates = model.winProb(None, prices, leaf_ids).reshape(len(model.leaf_dist), len(model.price_bins))
+    assert np.allclose(win_rates, model.leaf_dist[:, :-1], rtol = 0, atol = 1e-12)
+
+
+def test_expected_cost_matches_leaf_distribution(price_model):
+    model, X = price_model
+    leaf_ids = model.predictLeaf(X)
+    bids = np.random.default_rng(1).random(len(X)) * (model.price_edges[-1] + 1)
+    edges = model.price_edges
+    expected = []
+    for leaf, bid in zip(leaf_ids.tolist(), bids.tolist()):
+        # The winning price is uniform inside each price bin
+        masses = np.diff(np.concatenate([[0], model.leaf_dist[leaf]]))
+        cost = 0.0
+        for j, mass in enumerate(masses.tolist()):
+            high = min(bid, edges[j + 1])
+            if high > edges[j]:
+                covered = (high - edges[j]) / (edges[j + 1] - edges[j])
+                cost += mass * covered * (edges[j] + high) / 2
+        expected.append(cost)
+    assert np.allclose(model.expectedCost(None, bids, leaf_ids), expected, rtol = 1e-9, atol = 1e-12)
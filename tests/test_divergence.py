@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from divergence import euclidean, findDivergence, priceBinWidths, smoothedKL, wasserstein
+
+
+def randomCDFs(num_cdfs, num_price_bins, seed):
+    '''
+    Monotone CDFs reaching 1, with empty bins
+    '''
+    rng = np.random.default_rng(seed)
+    probabilities = rng.random((num_cdfs, num_price_bins)) * (rng.random((num_cdfs, num_price_bins)) < 0.6)
+    probabilities[:, -1] += 1e-3
+    return np.cumsum(probabilities / probabilities.sum(axis = 1, keepdims = True), axis = 1)
+
+
+def test_wasserstein_matches_scipy():
+    stats = pytest.importorskip('scipy.stats')
+    dists = randomCDFs(20, 30, 0)
+    dist = dists[0]
+    expected = [stats.wasserstein_distance(dist, k) for k in dists]
+    assert np.allclose(wasserstein(dist, dists), expected, rtol = 0, atol = 1e-12)
+
+    # With unequal bins, CDF j holds on an interval of width bin_widths[j]
+    price_bins = np.cumsum(np.random.default_rng(1).random(29))
+    bin_widths = priceBinWidths(price_bins)
+    positions = np.concatenate([[0], np.cumsum(bin_widths)])
+    masses = np.maximum(np.diff(np.concatenate([np.zeros((len(dists), 1)), dists, np.ones((len(dists), 1))], axis = 1), axis = 1), 0)
+    expected = [stats.wasserstein_distance(positions, positions, masses[0], k) for k in masses]
+    assert np.allclose(findDivergence('wasserstein', price_bins)(dist, dists), expected, rtol = 0, atol = 1e-12)
+
+
+def test_smoothed_kl_with_empty_bins():
+    dists = randomCDFs(20, 30, 2)
+    # A point mass and a CDF that does not reach 1
+    dists[1] = 1.0
+    dists[2] = np.linspace(0, 0.5, 30)
+    divergences = smoothedKL(dists[1], dists)
+    assert np.all(np.isfinite(divergences))
+    assert np.all(divergences >= 0)
+    assert divergences[1] == 0
+    assert np.all(np.isfinite(smoothedKL(dists[0], dists)))
+
+
+def test_find_divergence():
+    kernel = lambda dist, dists: np.zeros(len(dists))
+    assert findDivergence(kernel) is kernel
+    assert findDivergence('euclidean') is euclidean
+    assert findDivergence('kl') is smoothedKL
+    assert findDivergence('wasserstein') is wasserstein
+    assert findDivergence('wasserstein', [1, 2, 3, 4]) is wasserstein
+    dists = randomCDFs(5, 5, 3)
+    assert np.allclose(findDivergence('wasserstein', [1, 2, 4, 8])(dists[0], dists), wasserstein(dists[0], dists, priceBinWidths([1, 2, 4, 8])))
+    with pytest.raises(ValueError):
+        findDivergence('cosine')
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from auction import adExchange
+from record import checkBidRecord, legacyCensoredRecord, loadRecord, recordColumns, recordWriter
+
+
+def test_bid_record_round_trip(tmp_path):
+    exchange = adExchange(num_competitors = 8, seed = 0, use_population = True, keep_bids = True)
+    exchange.generateMultipleBidRecord(3000)
+    columns = exchange.record.view()
+    path = str(tmp_path / "bid")
+    # Chunks of different sizes, the last one appended after the writer is closed and opened again
+    writer = recordWriter(path, 'bid', recordColumns('bid', exchange.num_attributes, exchange.num_competitors), exchange.getConfig())
+    for start, end in [(0, 1000), (1000, 1001), (1001, 2500)]:
+        writer.append({name: column[start:end] for name, column in columns.items()})
+        assert len(loadRecord(path)) == end
+    writer.close()
+    with recordWriter(path, 'bid', {}, {}, append = True) as writer:
+        writer.append({name: column[2500:] for name, column in columns.items()})
+
+    record = loadRecord(path)
+    assert len(record) == 3000
+    assert record.config == exchange.getConfig()
+    assert set(record.view()) == set(columns)
+    for name, column in columns.items():
+        assert record[name].shape == column.shape, name
+        assert np.array_equal(record[name], column), name
+    assert record['winning_id'].dtype == np.int32
+    assert record.toList()[:] == exchange.bid_record[:]
+
+
+def test_censored_record_round_trip(tmp_path):
+    exchange = adExchange(num_competitors = 8, seed = 0)
+    exchange.generateMultipleBidRecord(2000)
+    columns = exchange.getCensoredColumns(3)
+    writer = exchange.saveRecord(columns, str(tmp_path / "censored"), close = False)
+    writer.append(columns)
+    writer.close()
+    record = loadRecord(str(tmp_path / "censored"))
+    assert len(record) == 4000
+    for name, column in columns.items():
+        assert np.array_equal(record[name], np.concatenate([column, column])), name
+    assert record.toList()[:2000] == exchange.getCensoredRecord(3)
+
+
+@pytest.mark.parametrize('auction_type', ['first', 'second'])
+def test_censored_datasets_match_censored_record(auction_type):
+    exchange = adExchange(num_competitors = 12, seed = 0, auction_type = auction_type)
+    exchange.generateMultipleBidRecord(3000)
+    competitor_idxs = [9, 2, 3, 7]
+    datasets = exchange.getCensoredDatasets(competitor_idxs, full_info = True)
+    assert list(datasets) == competitor_idxs
+    for idx in competitor_idxs:
+        columns = exchange.getCensoredColumns(idx)
+        for name, column in columns.items():
+            assert np.array_equal(datasets[idx][name], column), name
+        assert np.array_equal(datasets[idx]['pctr'], exchange.record['pctrs'][:, idx])
+        assert np.array_equal(datasets[idx]['running_bid'], exchange.record['running_bids'][:, idx])
+        assert legacyCensoredRecord(datasets[idx], exchange.num_integer_attributes) == exchange.getCensoredRecord(idx)
+
+
+def test_check_bid_record_raises_on_corrupted_records():
+    exchange = adExchange(num_competitors = 6, seed = 0, use_population = True, keep_bids = True, auction_type = 'second')
+    exchange.generateMultipleBidRecord(1000)
+    columns = {name: np.array(column) for name, column in exchange.record.view().items()}
+    checkBidRecord(columns, 'second')
+    for name, row, value in [('bidprices', 10, columns['running_bids'][10, 2] * columns['pctrs'][10, 2] * 2 + 1), ('winning_id', 20, (columns['winning_id'][20] + 1) % 6), ('winning_price', 30, columns['winning_price'][30] + 1)]:
+        corrupted = dict(columns, **{name: columns[name].copy()})
+        if name == 'bidprices':
+            corrupted[name][row, 2] = value
+        else:
+            corrupted[name][row] = value
+        with pytest.raises(AssertionError):
+            checkBidRecord(corrupted, 'second')
+    # A second price record is not a valid first price record
+    with pytest.raises(AssertionError):
+        checkBidRecord(columns, 'first')
+    exchange.record['bidprices'][40, 0] = -1
+    with pytest.raises(AssertionError):
+        exchange.getCensoredDatasets([0])
+    exchange.getCensoredDatasets([0], check = False)
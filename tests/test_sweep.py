@@ -0,0 +1,27 @@
+import pytest
+from sweep import resultCache, runSweep, simulationStage, sweepGrid, trainingKey
+
+
+def test_sweep_reuses_simulation(tmp_path):
+    base = {'exchange': {'num_competitors': 5, 'seed': 0}, 'num_records': 2000, 'competitor_idx': 0, 'train': {'seed': 0}}
+    runSweep(sweepGrid(base, **{'train.max_height': [2]}), str(tmp_path))
+    results = runSweep(sweepGrid(base, **{'train.max_height': [2, 3]}), str(tmp_path))
+    assert [k['cached'] for k in results] == [
+        {'simulation': True, 'censoring': True, 'training': True},
+        {'simulation': True, 'censoring': True, 'training': False}
+    ]
+
+
+def test_sweep_needs_seed(tmp_path):
+    point = {'exchange': {'num_competitors': 5}, 'num_records': 100, 'competitor_idx': 0}
+    with pytest.raises(ValueError):
+        simulationStage(resultCache(str(tmp_path)), point)
+
+
+@pytest.mark.parametrize('point', [
+    {'exchange': {'num_competitors': 5, 'seed': 0}, 'num_records': 100, 'competitor_idx': 0, 'train': {}},
+    {'exchange': {'num_competitors': 5, 'seed': 0, 'keep_bids': False}, 'num_records': 100, 'competitor_idx': 0, 'train': {'seed': 0}}
+])
+def test_training_key_rejects_unreproducible_points(point):
+    with pytest.raises(ValueError):
+        trainingKey(point)
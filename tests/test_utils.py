@@ -0,0 +1,101 @@
+import bisect
+import random
+import numpy as np
+from utils import quantileSketch, turnbull, turnbullCache, turnbullFromCounts, kaplanMeierFromCounts
+
+
+def listTurnbull(data, bins, epsilon = 0.01):
+    '''
+    The list implementation of turnbull with bins, before it was vectorized
+    '''
+    num_bins = len(bins) + 1
+    low_price = bins[0] * 2 - bins[1]
+    high_price = bins[-1] * 2 - bins[-2]
+    alpha = []
+    for price, win in data:
+        left, right = (low_price, price) if win else (price, high_price)
+        alpha.append([bisect.bisect_left(bins, left), bisect.bisect_left(bins, right)])
+    density = [1 / num_bins for _ in range(num_bins)]
+    diff = float('inf')
+    n = len(data)
+    while diff > epsilon:
+        denominators = [sum(density[j] for j in range(a[0], a[1] + 1)) for a in alpha]
+        newdensity = [0] * num_bins
+        for i in range(n):
+            if denominators[i] != 0:
+                for j in range(alpha[i][0], alpha[i][1] + 1):
+                    newdensity[j] += density[j] / denominators[i]
+        newdensity = [k / n for k in newdensity]
+        diff = sum(abs(newdensity[j] - density[j]) for j in range(num_bins))
+        density = newdensity
+    dist = [density[0]]
+    for k in density[1:]:
+        dist.append(dist[-1] + k)
+    return dist
+
+
+def listKaplanMeier(counts):
+    '''
+    The list Kaplan-Meier loop of buildDecisionTree.computeDataDistributionByKME, before it used count arrays
+    '''
+    loseprob = [1]
+    ni = sum(win + lose for win, lose in counts)
+    for i in range(len(counts)):
+        di = counts[i][0]
+        if i:
+            ni -= counts[i - 1][0] + counts[i - 1][1]
+        if ni != 0:
+            loseprob.append(loseprob[-1] * (1 - di / ni))
+        else:
+            loseprob.append(loseprob[-1])
+    return [1 - k for k in loseprob][1:]
+
+
+def randomRecords(num_records, seed):
+    rng = random.Random(seed)
+    return [[rng.random() * 10, int(rng.random() < 0.4)] for _ in range(num_records)]
+
+
+def test_turnbull_matches_list_implementation():
+    bins = [0.5 * k for k in range(1, 20)]
+    data = randomRecords(2000, 0)
+    _, dist = turnbull(data, bins = bins)
+    assert np.allclose(dist, listTurnbull(data, bins), rtol = 0, atol = 1e-12)
+
+
+def test_kaplan_meier_matches_list_implementation():
+    counts = np.random.default_rng(0).integers(0, 50, size = (100, 2))
+    counts[90:] = 0
+    assert np.array_equal(kaplanMeierFromCounts(counts), listKaplanMeier(counts.tolist()))
+
+
+def test_turnbull_from_counts_matches_turnbull():
+    bins = [0.5 * k for k in range(1, 20)]
+    data = randomRecords(2000, 1)
+    counts = np.zeros((len(bins) + 1, 2), dtype = np.int64)
+    for price, win in data:
+        counts[bisect.bisect_left(bins, price), 1 - win] += 1
+    _, dist = turnbull(data, bins = bins)
+    assert np.allclose(turnbullFromCounts(counts), dist, rtol = 0, atol = 1e-12)
+    cache = turnbullCache()
+    assert np.array_equal(cache.cdf(counts), turnbullFromCounts(counts))
+    assert np.array_equal(cache.cdf(counts.copy()), turnbullFromCounts(counts))
+    assert cache.hits == 1
+
+
+def test_quantile_sketch_rank_error_after_merge():
+    rng = np.random.default_rng(0)
+    values1 = rng.normal(size = 150000)
+    values2 = rng.exponential(size = 50000) * 3
+    sketch1 = quantileSketch(k = 512, seed = 1)
+    sketch2 = quantileSketch(k = 512, seed = 2)
+    for chunk in np.array_split(values1, 30):
+        sketch1.update(chunk)
+    for chunk in np.array_split(values2, 10):
+        sketch2.update(chunk)
+    sketch1.merge(sketch2)
+    values = np.sort(np.concatenate((values1, values2)))
+    ranks = np.linspace(0, 1, 201)
+    estimated_ranks = np.searchsorted(values, sketch1.quantiles(ranks), side = 'right') / len(values)
+    assert sketch1.count == len(values)
+    assert np.max(np.abs(estimated_ranks - ranks)) < 0.01
@@ -1,6 +1,19 @@
-import bisect
+import collections
+import numpy as np
 
-def turnbull(data, interval_length = float('inf'), bins = [], low_price = 0, high_price = -1, num_bins = 200, epsilon = 0.01):
+def turnbull(data, interval_length = float('inf'), bins = [], low_price = 0, high_price = -1, num_bins = 200, epsilon = 0.01, acceleration = False, initial_density = None):
+    '''
+    Turnbull estimator of the distribution of the winning price from interval censored data
+
+    Input type:
+        data(list): [price, win] of each record. A win means the winning price is at most price, a loss means it is above price
+        acceleration(Boolean): Use SQUAREM steps instead of plain EM steps, see turnbullEM
+        initial_density(array): The density of num_bins bins to start the EM iterations from, see turnbullEM
+
+    Return type: tuple
+        x(list): The left edge of each bin
+        dist(list): The CDF of the winning price on the bins
+    '''
     if not bins:
         if high_price == -1:
             high_price = max([k[0] for k in data])
@@ -11,6 +24,7 @@ def turnbull(data, interval_length = float('inf'), bins = [], low_price = 0, hig
             bins.append(bins[-1] + bin_width)
         bins = bins[1:]
     else:
+        bins = list(bins)
         num_bins = len(bins) + 1
         low_price = bins[0] * 2 - bins[1]
         high_price = bins[-1] * 2 - bins[-2]
@@ -19,38 +33,315 @@ def turnbull(data, interval_length = float('inf'), bins = [], low_price = 0, hig
         x = [bins[0] * 2 - bins[1]] + bins
         return x, [0] * num_bins
 
-    intervals = []
-    for price, win in data:
-        intervals.append((max(price - interval_length, low_price), price) if win else (price, min(price + interval_length, high_price)))
-    
-    alpha = []
-    for left, right in intervals:
-        left_idx = bisect.bisect_left(bins, left)
-        right_idx = bisect.bisect_left(bins, right)
-        alpha.append([left_idx, right_idx])
-
-    density = [1 / num_bins for _ in range(num_bins)]
+    data = np.asarray(data, dtype = float)
+    price, win = data[:, 0], data[:, 1] != 0
+    left = np.where(win, np.maximum(price - interval_length, low_price), price)
+    right = np.where(win, price, np.minimum(price + interval_length, high_price))
+    left_idx = np.searchsorted(bins, left, side = 'left')
+    right_idx = np.searchsorted(bins, right, side = 'left')
+
+    # Records with the same interval are merged into one weighted interval
+    intervals, counts = np.unique(np.stack([left_idx, right_idx], axis = 1), axis = 0, return_counts = True)
+    density, _ = turnbullEM(intervals[:, 0], intervals[:, 1], counts, num_bins, epsilon, acceleration, initial_density)
+
+    x = [bins[0] * 2 - bins[1]] + bins
+    dist = np.cumsum(density).tolist()
+    return x, dist
+
+
+def turnbullEM(left_idx, right_idx, counts, num_bins, epsilon = 0.01, acceleration = False, initial_density = None):
+    '''
+    EM iterations of the Turnbull estimator on bin intervals [left_idx, right_idx]
+    The interval sums use a prefix sum of the density and the mass redistribution uses a difference array,
+    so one iteration is O(number of intervals + num_bins).
+
+    Input type:
+        left_idx, right_idx(array of int): The first and the last bin of each distinct interval
+        counts(array): The number of records with each interval
+        acceleration(Boolean): Use SQUAREM (Varadhan and Roland, 2008) extrapolation between EM steps
+        initial_density(array): Start from this density instead of the uniform one, e.g. the estimate of a parent node.
+            EM never moves mass back to a bin with probability 0, so 1% of uniform density is mixed in.
+
+    Return type: tuple
+        density(numpy array): The probability of each bin
+        num_iterations(int): The number of EM steps
+    '''
+    left_idx = np.asarray(left_idx)
+    right_idx = np.asarray(right_idx)
+    counts = np.asarray(counts, dtype = float)
+    n = counts.sum()
+    density = np.full(num_bins, 1 / num_bins)
+    if n == 0:
+        return np.zeros(num_bins), 0
+    if initial_density is not None:
+        initial_density = np.asarray(initial_density, dtype = float)
+        if initial_density.sum() > 0:
+            density = 0.99 * initial_density / initial_density.sum() + 0.01 * density
+
+    def emStep(density):
+        cumulative = np.concatenate(([0], np.cumsum(density)))
+        denominators = cumulative[right_idx + 1] - cumulative[left_idx]
+        coefficients = np.divide(counts, denominators, out = np.zeros_like(counts), where = denominators > 0)
+        weights = np.bincount(left_idx, coefficients, num_bins + 1) - np.bincount(right_idx + 1, coefficients, num_bins + 1)
+        return density * np.cumsum(weights)[:num_bins] / n
+
+    num_iterations = 0
     diff = float('inf')
-    n, m = len(data), num_bins
     while diff > epsilon:
-        denominators = []
-        for i in range(n):
-            denominators.append(sum([density[j] for j in range(alpha[i][0], alpha[i][1] + 1)]))
-        
-        newdensity = [0] * num_bins
-        for i in range(n):
-            if denominators[i] != 0:
-                for j in range(alpha[i][0], alpha[i][1] + 1):
-                    newdensity[j] += density[j] / denominators[i]
-        for j in range(m):
-            newdensity[j] /= n
-
-        diff = sum([abs(newdensity[j] - density[j]) for j in range(m)])
+        if acceleration:
+            density1 = emStep(density)
+            density2 = emStep(density1)
+            r = density1 - density
+            v = density2 - density1 - r
+            num_iterations += 2
+            if not np.any(v):
+                diff = np.abs(density2 - density1).sum()
+                density = density2
+                continue
+            alpha = min(-np.sqrt((r * r).sum() / (v * v).sum()), -1)
+            extrapolated = np.maximum(density - 2 * alpha * r + alpha * alpha * v, 0)
+            extrapolated /= extrapolated.sum()
+            newdensity = emStep(extrapolated)
+            num_iterations += 1
+            diff = np.abs(newdensity - extrapolated).sum()
+        else:
+            newdensity = emStep(density)
+            num_iterations += 1
+            diff = np.abs(newdensity - density).sum()
         density = newdensity
 
-    x = [bins[0] * 2 - bins[1]] + bins
-    dist = [density[0]]
-    for k in density[1:]:
-        dist.append(dist[-1] + k)
+    return density, num_iterations
+
+
+def kaplanMeierFromCounts(counts):
+    '''
+    Kaplan-Meier estimate of the winning price CDF from win/lose counts per price bin
+    Same result as buildDecisionTree.computeDataDistributionByKME on the records behind the counts
+
+    Input type:
+        counts(array): (..., num_price_bins, 2), the last axis is [win count, lose count]
+
+    Return type: numpy array (..., num_price_bins), the CDF of every leading index
+    '''
+    counts = np.asarray(counts, dtype = float)
+    wins = counts[..., 0]
+    totals = counts.sum(axis = -1)
+    # ni: the number of records whose price is in this bin or a later one
+    at_risk = totals.sum(axis = -1, keepdims = True) - np.cumsum(totals, axis = -1) + totals
+    factors = 1 - np.divide(wins, at_risk, out = np.zeros_like(wins), where = at_risk != 0)
+    return 1 - np.cumprod(factors, axis = -1)
+
+
+def turnbullFromCounts(counts, epsilon = 0.01, acceleration = False, initial_density = None):
+    '''
+    Turnbull estimate of the winning price CDF from win/lose counts per price bin, for first price auctions
+    A win in bin p is the interval [0, p] and a loss in bin p is the interval [p, num_price_bins - 1],
+    the same intervals turnbull builds with bins = price_bins
+
+    Input type:
+        counts(array): (num_price_bins, 2), the last axis is [win count, lose count]
+
+    Return type: numpy array (num_price_bins,)
+    '''
+    density, _ = turnbullDensityFromCounts(counts, epsilon, acceleration, initial_density)
+    return np.cumsum(density)
+
+
+def turnbullDensityFromCounts(counts, epsilon = 0.01, acceleration = False, initial_density = None):
+    '''
+    Same as turnbullFromCounts, but return the density and the number of EM steps
+
+    Return type: tuple
+        density(numpy array): (num_price_bins,)
+        num_iterations(int)
+    '''
+    counts = np.asarray(counts, dtype = float)
+    num_bins = len(counts)
+    positions = np.arange(num_bins)
+    left_idx = np.concatenate((np.zeros(num_bins, dtype = int), positions))
+    right_idx = np.concatenate((positions, np.full(num_bins, num_bins - 1)))
+    interval_counts = np.concatenate((counts[:, 0], counts[:, 1]))
+    used = interval_counts > 0
+    return turnbullEM(left_idx[used], right_idx[used], interval_counts[used], num_bins, epsilon, acceleration, initial_density)
+
+
+class turnbullCache:
+
+    def __init__(self, max_size = 4096, epsilon = 0.01, acceleration = False):
+        '''
+        Bounded LRU cache of Turnbull estimates keyed by the win/lose counts per price bin
+        The counts are everything the estimate depends on, so records with the same counts share one entry
+        whichever node or attribute bin they come from. The entry is the first estimate computed for the counts,
+        so with warm starts it depends on the order of the calls, within epsilon.
+
+        Attributes:
+            hits, misses(int): Lookups that found or did not find the counts
+            num_em_runs(int): turnbullEM calls, one per miss
+            num_em_iterations(int): EM steps of all these calls
+        '''
+        self.max_size = max_size
+        self.epsilon = epsilon
+        self.acceleration = acceleration
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.num_em_runs = 0
+        self.num_em_iterations = 0
+
+
+    def density(self, counts, initial_density = None):
+        '''
+        Return type: numpy array (num_price_bins,), the Turnbull density of counts, see turnbullDensityFromCounts
+        '''
+        counts = np.asarray(counts, dtype = float)
+        key = counts.tobytes()
+        density = self.entries.get(key)
+        if density is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return density
+        self.misses += 1
+        density, num_iterations = turnbullDensityFromCounts(counts, self.epsilon, self.acceleration, initial_density)
+        self.num_em_runs += 1
+        self.num_em_iterations += num_iterations
+        if self.max_size > 0:
+            self.entries[key] = density
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+        return density
+
+
+    def cdf(self, counts, initial_density = None):
+        return np.cumsum(self.density(counts, initial_density))
+
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+    def report(self):
+        '''
+        Return type: dict
+            hits, misses, hit_rate, size, num_em_runs, num_em_iterations, mean_em_iterations
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hitRate(),
+            'size': len(self.entries),
+            'num_em_runs': self.num_em_runs,
+            'num_em_iterations': self.num_em_iterations,
+            'mean_em_iterations': self.num_em_iterations / self.num_em_runs if self.num_em_runs else 0.0
+        }
+
+
+
+def quantileBins(values, num_bins):
+    '''
+    Function to find the inner edges of num_bins bins holding the same number of values
+    Repeated edges are merged, so there can be fewer bins
+
+    Return type: list
+    '''
+    return np.unique(np.quantile(np.asarray(values, dtype = float), np.arange(1, num_bins) / num_bins)).tolist()
+
+
+class quantileSketch:
+
+    def __init__(self, k = 2048, seed = 0):
+        '''
+        Mergeable streaming quantile sketch in the style of KLL (Karnin, Lang and Liberty, 2016)
+        Values are kept in levels, a value at level h stands for 2 ** h values. When a level is over its capacity,
+        it is sorted and every other value, starting at a random offset, moves up one level.
+        The sketch holds O(k log(n / k)) values and the rank error is about 1 / k.
+        The minimum and the maximum are exact.
+
+        Input type:
+            k(int): The capacity of the top level. Lower levels get 2 / 3 of the capacity of the level above.
+            seed: The seed of the random offsets
+        '''
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+
+    def capacity(self, level):
+        return max(8, int(self.k * (2 / 3) ** (len(self.levels) - 1 - level)))
+
+
+    def update(self, values):
+        '''
+        Function to add an array of values, NaN values are ignored
+        '''
+        values = np.asarray(values, dtype = float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+
+
+    def merge(self, other):
+        '''
+        Function to add the values of the sketch other, e.g. the sketch of another chunk or process
+        '''
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], values))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                values = np.sort(self.levels[level])
+                # With an odd number of values, one stays at this level so that the total weight does not change
+                self.levels[level] = values[len(values) - len(values) % 2:]
+                values = values[:len(values) - len(values) % 2]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], values[self.rng.integers(2)::2]))
+            level += 1
+
+
+    def quantiles(self, ranks):
+        '''
+        Input type:
+            ranks(array): Values from 0 to 1
+
+        Return type: numpy array, the estimated quantiles
+        '''
+        ranks = np.asarray(ranks, dtype = float)
+        if self.count == 0:
+            return np.full(ranks.shape, np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(k), 2.0 ** level) for level, k in enumerate(self.levels)])
+        order = np.argsort(values, kind = 'stable')
+        values = values[order]
+        cumulative = np.cumsum(weights[order])
+        position = np.minimum(np.searchsorted(cumulative, ranks * cumulative[-1], side = 'left'), len(values) - 1)
+        result = values[position]
+        result[ranks <= 0] = self.min
+        result[ranks >= 1] = self.max
+        return np.clip(result, self.min, self.max)
+
+
+    def bins(self, num_bins):
+        '''
+        Same as quantileBins, from the sketch
 
-    return x, dist
\ No newline at end of file
+        Return type: list
+        '''
+        return np.unique(self.quantiles(np.arange(1, num_bins) / num_bins)).tolist()